@@ -1,9 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
 from boto3.dynamodb.conditions import Key
-from requests.auth import HTTPBasicAuth
-import requests
+from embedding_codec import EmbeddingCodec
+from embedding_cache import EmbeddingCache
+from vector_store import LocalVectorStore
+from transcripts import get_transcript_store, archive_turns
+from collections import OrderedDict
+from tracing import with_trace
+from tracing import annotate
+from tracing import traced
+from tracing import trace
+from tracing import span
+import threading
+import hashlib
 import logging
 import boto3
 import json
+import math
 import os
 
 
@@ -12,18 +24,33 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
                     datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger('log')
 
-# Create service clients
-dynamodb = boto3.resource('dynamodb')
-sagemaker_runtime = boto3.client('sagemaker-runtime')
+# Service clients are built on first use, so a cold start only pays for those its records need (boto3
+# resources are not thread-safe, so each worker thread builds its own)
+sagemaker_runtime = None
+clients_lock = threading.Lock()
+thread_local = threading.local()
 
-# Reference SageMaker JumpStart endpoints
-domain_endpoint = os.environ['OS_ENDPOINT']
-domain_index = os.environ['OS_INDEX_NAME']
-os_username = os.environ['OS_USERNAME']
-os_password = os.environ['OS_PASSWORD']
+# Optional projection and quantization of stored embeddings, must match the app's embedding_codecs config
+embedding_dimension = os.environ.get('EMBEDDING_DIMENSION')
+int8_scale = os.environ.get('EMBEDDING_INT8_SCALE')
+embedding_codec = EmbeddingCodec(projection=os.environ.get('EMBEDDING_PROJECTION', 'none'),
+                                 dimension=int(embedding_dimension) if embedding_dimension else None,
+                                 pca_file=os.environ.get('EMBEDDING_PCA_FILE'),
+                                 dtype=os.environ.get('EMBEDDING_DTYPE', 'float32'),
+                                 int8_scale=float(int8_scale) if int8_scale else None)
 
-# Reference Amazon OpenSearch endpoint
-URL = f'{domain_endpoint}/{domain_index}'
+# Long term memory goes to Amazon OpenSearch, or to a local vector store (e.g. on EFS) for small deployments
+VECTOR_STORE_BACKEND = os.environ.get('VECTOR_STORE_BACKEND', 'opensearch')
+domain_index = os.environ['OS_INDEX_NAME']
+search_client = None
+local_store = None
+if VECTOR_STORE_BACKEND == 'local':
+    vector_store_dir = os.path.join(os.environ['VECTOR_STORE_DIR'], domain_index)
+else:
+    # Reference Amazon OpenSearch endpoint
+    domain_endpoint = os.environ['OS_ENDPOINT']
+    os_username = os.environ['OS_USERNAME']
+    os_password = os.environ['OS_PASSWORD']
 
 # Set LLM generation configs
 MAX_LENGTH = 512
@@ -34,52 +61,288 @@ DO_SAMPLE = True
 CONTENT_TYPE = 'application/json'
 TEMPERATURE = 0.1
 
+# Set batch pipeline configs
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 8))
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', 16))
+
+# Set map-reduce summarization configs
+CHUNK_TOKENS = int(os.environ.get('SUMMARY_CHUNK_TOKENS', 384))  # conversation tokens per summarization prompt
+TOKENS_PER_WORD = 4 / 3  # rough SentencePiece ratio for English text
+MAX_CACHED_CHUNK_SUMMARIES = 4096
+SUMMARY_CACHE_TABLE = os.environ.get('SUMMARY_CACHE_TABLE')  # optional table keyed by chunk_hash
+
+# Chunk summaries are reused when a session is extended and summarized again
+chunk_summaries = OrderedDict()
+chunk_summaries_lock = threading.Lock()
+# Separate from the per-session pool so that chunk calls never wait on the sessions that submitted them
+summary_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='summary')
 
+# Optionally pack each closed session's turns into one compressed blob, read back through the streaming decoder
+TRANSCRIPT_STORE = os.environ.get('TRANSCRIPT_STORE', 'none')  # none, dynamodb or local
+TRANSCRIPT_TABLE = os.environ.get('TRANSCRIPT_TABLE', 'transcripts')
+TRANSCRIPT_CODEC = os.environ.get('TRANSCRIPT_CODEC', 'gzip')  # gzip, or zstd with the zstandard package
+TRANSCRIPT_DELETE_TURNS = os.environ.get('TRANSCRIPT_DELETE_TURNS', 'false').lower() == 'true'
 
-def lambda_handler(event: dict, context: dict) -> None:
+# Embedding cache lives for the lifetime of a warm container; /tmp can back the on-disk tier
+embedding_cache = EmbeddingCache(max_bytes=int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', 16 * 1024 * 1024)),
+                                 disk_dir=os.environ.get('EMBEDDING_CACHE_DIR'),
+                                 namespace=os.environ['SAGEMAKER_TEXT_EMBED_ENDPOINT'])
+
+
+def lambda_handler(event: dict, context: dict) -> dict:
+    """
+    Persist every ended session in the batch to long term memory. Conversations are read and summarized
+    concurrently, summaries are embedded in batched requests and all documents are indexed with one _bulk call.
+    Records that fail at any stage are reported back as batch item failures so only they are retried
+    (requires ReportBatchItemFailures on the event source mapping).
+    """
     logger.info(f'Received event: {event}')
     logger.info(f'Received context: {context}')
 
-    for record in event['Records']:
-        if record['eventName'] == 'MODIFY':
+    # One trace per invocation, with every span of a session's records also tagged by its session id
+    with trace(trace_id=getattr(context, 'aws_request_id', None)):
+        return process_records(event['Records'])
+
+
+def process_records(records: list) -> dict:
+    failures = {}
+    sessions = []
+    for record in records:
+        if not is_session_end(record):
+            continue
+        sequence_number = record['dynamodb']['SequenceNumber']
+        try:
             session_item = record['dynamodb']['NewImage']
-            session_id = session_item['session_id']['S']
-            end_time = session_item['end_time']['N']
+            sessions.append({'sequence_number': sequence_number,
+                             'session_id': session_item['session_id']['S'],
+                             'user_id': session_item.get('user_id', {}).get('S'),
+                             'end_time': int(session_item['end_time']['N'])})
+        except KeyError as e:
+            failures[sequence_number] = f'Malformed record: missing {e}'
+
+    # Query the conversations table and summarize each session concurrently
+    with span('lambda.summarize', items=len(sessions)), ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(with_trace(summarize_session), session['session_id']) for session in sessions]
+        for session, future in zip(sessions, futures):
+            try:
+                session['summary'] = future.result()
+            except Exception as e:
+                failures[session['sequence_number']] = f'Summarization failed: {e}'
+    sessions = [session for session in sessions if session['sequence_number'] not in failures]
+
+    # Encode all summaries into embeddings with batched requests
+    with span('lambda.embed', items=len(sessions)):
+        embeddings = encode_conversations_batch([session['summary'] for session in sessions])
+    for session, embedding in zip(sessions, embeddings):
+        if isinstance(embedding, Exception):
+            failures[session['sequence_number']] = f'Embedding failed: {embedding}'
+        else:
+            session['embedding'] = embedding_codec.encode(embedding)
+    sessions = [session for session in sessions if session['sequence_number'] not in failures]
+
+    # Write all embeddings to long term memory in a single bulk request
+    with span('lambda.write', items=len(sessions)):
+        errors = write_to_long_term_memory(sessions)
+    for session, error in zip(sessions, errors):
+        if error:
+            failures[session['sequence_number']] = f'Indexing failed: {error}'
+        else:
+            logger.info(f"Session {session['session_id']} was persisted to long term memory")
+
+    for sequence_number, reason in failures.items():
+        logger.error(f'Record {sequence_number}: {reason}')
+    if search_client is not None:
+        logger.info(f'OpenSearch requests: {search_client.metrics.stats()}')
+    return {'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failures]}
+
+
+def is_session_end(record: dict) -> bool:
+    """
+    Every turn also modifies its session (counters and last activity), so only the MODIFY that sets end_time,
+    i.e. takes it from NULL to a number, marks a session end. Needs the NEW_AND_OLD_IMAGES stream view type.
+    """
+    if record['eventName'] != 'MODIFY':
+        return False
+    images = record['dynamodb']
+    new_end_time = images.get('NewImage', {}).get('end_time', {})
+    old_end_time = images.get('OldImage', {}).get('end_time', {'NULL': True})
+    return 'N' in new_end_time and 'N' not in old_end_time
 
-            # Query the conversations table
-            conversation_turns = query_conversations_table(session_id)
 
-            # Flatten the conversation turns into a dict
-            flattened_conversations = flatten_conversations(conversation_turns)
+def summarize_session(session_id: str) -> str:
+    with trace(session_id=session_id), span('lambda.summarize_session'):
+        conversation_turns, archived = read_session_turns(session_id)
+        summary = summarize_turns(conversation_turns)
+        if not archived and conversation_turns:
+            archive_session(session_id, conversation_turns)
+        return summary
 
-            summary = summarize_conversations(flattened_conversations)
 
-            # Encode the dict into an embedding
-            embedding = encode_conversations(summary)
+def get_sagemaker_runtime():
+    global sagemaker_runtime
+    if sagemaker_runtime is None:
+        with clients_lock:
+            if sagemaker_runtime is None:
+                sagemaker_runtime = boto3.client('sagemaker-runtime')
+    return sagemaker_runtime
 
-            # Write the embedding to Elasticsearch
-            write_to_elasticsearch(session_id, embedding, end_time, summary)
 
-            print(f"Session {session_id} was persisted to long term memory")
+def get_search_client():
+    """
+    Pooled keep-alive connection to Amazon OpenSearch, reused across warm invocations.
+    """
+    global search_client
+    if search_client is None:
+        with clients_lock:
+            if search_client is None:
+                # Imported here so that the local backend never loads requests
+                from search_client import OpenSearchClient
+                search_client = OpenSearchClient(domain_endpoint, os_username, os_password,
+                                                 pool_size=int(os.environ.get('OS_POOL_SIZE', 10)),
+                                                 max_retries=int(os.environ.get('OS_MAX_RETRIES', 3)))
+    return search_client
 
 
+def get_local_store():
+    global local_store
+    if local_store is None:
+        with clients_lock:
+            if local_store is None:
+                local_store = LocalVectorStore(vector_store_dir, dimension=embedding_codec.dimension or 4096,
+                                               dtype=embedding_codec.dtype)
+    return local_store
+
+
+def get_dynamodb_resource():
+    if not hasattr(thread_local, 'dynamodb'):
+        thread_local.dynamodb = boto3.session.Session().resource('dynamodb')
+    return thread_local.dynamodb
+
+
+def session_transcript_store():
+    # The DynamoDB store holds a Table of this thread's resource
+    table = get_dynamodb_resource().Table(TRANSCRIPT_TABLE) if TRANSCRIPT_STORE == 'dynamodb' else None
+    return get_transcript_store(TRANSCRIPT_STORE, table, os.environ.get('TRANSCRIPT_DIR'))
+
+
+def read_session_turns(session_id: str) -> tuple:
+    """
+    :return: The session's turns, decoded lazily when it was archived (e.g. by an earlier attempt at this record)
+             or queried from the conversations table otherwise, and whether it was archived
+    """
+    store = session_transcript_store()
+    turns = store.turns(session_id) if store is not None else None
+    if turns is not None:
+        return turns, True
+    return query_conversations_table(session_id), False
+
+
+@traced('lambda.archive_session')
+def archive_session(session_id: str, conversation_turns: list) -> None:
+    """
+    Pack a closed session into its transcript blob and, with TRANSCRIPT_DELETE_TURNS, drop the per-turn items
+    once the blob is stored.
+    """
+    store = session_transcript_store()
+    if store is None:
+        return
+    conversations_table = get_dynamodb_resource().Table('conversations') if TRANSCRIPT_DELETE_TURNS else None
+    blob_bytes = archive_turns(store, session_id, conversation_turns, TRANSCRIPT_CODEC, conversations_table)
+    annotate(items=len(conversation_turns), request_bytes=blob_bytes)
+
+
+@traced('ddb.query_conversations_table')
 def query_conversations_table(session_id: str) -> list:
-    table = dynamodb.Table('conversations')
-    response = table.query(KeyConditionExpression=Key('session_id').eq(session_id))
-    return response['Items']
+    table = get_dynamodb_resource().Table('conversations')
+    kwargs = {'KeyConditionExpression': Key('session_id').eq(session_id)}
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            annotate(items=len(items))
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
 
-def flatten_conversations(conversation_turns: list) -> dict:
-    flattened_conversations = {'conversation': ''}
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text.split()) * TOKENS_PER_WORD)
+
+
+def chunk_conversation(conversation_turns: list, max_tokens: int = CHUNK_TOKENS) -> list:
+    """
+    Greedily pack consecutive turns into chunks of at most `max_tokens`, splitting oversized turns by words.
+    Chunks are cut from the start of the session, so extending a session only changes its last chunk.
+    """
+    max_words = max(1, int(max_tokens / TOKENS_PER_WORD))
+    chunks = []
+    current = []
+    current_tokens = 0
     for turn in conversation_turns:
-        user_message = turn['Me']
-        bot_message = turn['AI']
-        flattened_conversations['conversation'] += f"{user_message} {bot_message} "
-    return flattened_conversations
+        words = f"{turn['Me']} {turn['AI']}".split()
+        for start in range(0, len(words), max_words):
+            piece = ' '.join(words[start:start + max_words])
+            tokens = estimate_tokens(piece)
+            if current and current_tokens + tokens > max_tokens:
+                chunks.append(' '.join(current))
+                current = []
+                current_tokens = 0
+            current.append(piece)
+            current_tokens += tokens
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+
+def get_cached_chunk_summary(chunk_hash: str):
+    with chunk_summaries_lock:
+        summary = chunk_summaries.get(chunk_hash)
+        if summary is not None:
+            chunk_summaries.move_to_end(chunk_hash)
+            return summary
+    if SUMMARY_CACHE_TABLE:
+        response = get_dynamodb_resource().Table(SUMMARY_CACHE_TABLE).get_item(Key={'chunk_hash': chunk_hash})
+        if 'Item' in response:
+            return response['Item']['summary']
+    return None
+
+
+def cache_chunk_summary(chunk_hash: str, summary: str) -> None:
+    with chunk_summaries_lock:
+        chunk_summaries[chunk_hash] = summary
+        while len(chunk_summaries) > MAX_CACHED_CHUNK_SUMMARIES:
+            chunk_summaries.popitem(last=False)
+    if SUMMARY_CACHE_TABLE:
+        get_dynamodb_resource().Table(SUMMARY_CACHE_TABLE).put_item(Item={'chunk_hash': chunk_hash,
+                                                                          'summary': summary})
+
+
+def summarize_chunk(chunk: str) -> str:
+    chunk_hash = hashlib.sha256(chunk.encode('utf-8')).hexdigest()
+    summary = get_cached_chunk_summary(chunk_hash)
+    if summary is None:
+        summary = summarize_conversations(chunk)
+        cache_chunk_summary(chunk_hash, summary)
+    return summary
+
+
+def summarize_turns(conversation_turns: list) -> str:
+    """
+    Map-reduce summarization: summarize token-bounded chunks of the conversation in parallel, then merge the
+    chunk summaries (chunking them again if they do not fit one prompt) until a single summary remains.
+    """
+    summaries = list(summary_executor.map(with_trace(summarize_chunk), chunk_conversation(conversation_turns)))
+    while len(summaries) > 1:
+        groups = chunk_conversation([{'Me': summary, 'AI': ''} for summary in summaries])
+        if len(groups) >= len(summaries):
+            # Every summary already fills a prompt on its own, merge them pairwise to guarantee progress
+            groups = [' '.join(summaries[i:i + 2]) for i in range(0, len(summaries), 2)]
+        summaries = list(summary_executor.map(with_trace(reduce_summaries), groups))
+    return summaries[0] if summaries else ''
 
 
 def summarize_conversations(conversation: str) -> str:
-    logger.info('Conversation: {conversation}')
+    logger.info(f'Conversation: {conversation}')
     prompt = f"""Conversation==hi there! I'm doing well, thank you. what is the meaning of eminent domain? Eminent domain is the power of the government to take private property for public use, with just compensation. 
 Summary==We discussed about the meaning of eminent domain and that it is the government's power to take private property for public use with just compensation. 
 
@@ -94,6 +357,19 @@ Summary==
 
 
 Summarize the above Conversation as a short paragraph in 3 to 4 sentences."""
+    return invoke_text_generation_endpoint(prompt)
+
+
+def reduce_summaries(summaries: str) -> str:
+    prompt = f"""Summaries=={summaries}
+Summary==
+
+
+Combine the above Summaries of parts of one conversation into a short paragraph in 3 to 4 sentences."""
+    return invoke_text_generation_endpoint(prompt)
+
+
+def invoke_text_generation_endpoint(prompt: str) -> str:
     payload = {'text_inputs': prompt,
                'max_length': MAX_LENGTH,
                'temperature': TEMPERATURE,
@@ -102,39 +378,105 @@ Summarize the above Conversation as a short paragraph in 3 to 4 sentences."""
                'top_p': TOP_P,
                'do_sample': DO_SAMPLE}
     payload = json.dumps(payload).encode('utf-8')
-    response = sagemaker_runtime.invoke_endpoint(EndpointName=os.environ['SAGEMAKER_TEXT_GEN_ENDPOINT'],
-                                                 ContentType=CONTENT_TYPE,
-                                                 Body=payload)
-    model_predictions = json.loads(response['Body'].read())
-    generated_text = model_predictions['generated_texts'][0]
+    with span('sagemaker.generate', request_bytes=len(payload), prompt_tokens=estimate_tokens(prompt)) as call:
+        response = get_sagemaker_runtime().invoke_endpoint(EndpointName=os.environ['SAGEMAKER_TEXT_GEN_ENDPOINT'],
+                                                           ContentType=CONTENT_TYPE,
+                                                           Body=payload)
+        body = response['Body'].read()
+        model_predictions = json.loads(body)
+        generated_text = model_predictions['generated_texts'][0]
+        call.set(response_bytes=len(body), completion_tokens=estimate_tokens(generated_text))
     logger.info(f'Summary: {generated_text}')
     return generated_text
 
 
 def encode_conversations(summary: str) -> list:
-    payload = {'text_inputs': [summary]}
+    return encode_conversations_batch([summary])[0]
+
+
+def encode_conversations_batch(summaries: list) -> list:
+    """
+    Embed summaries with as few endpoint calls as possible, skipping those already cached.
+    :return: One embedding per summary, or the exception raised by the request that should have produced it
+    """
+    embeddings = [embedding_cache.get(summary) for summary in summaries]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    for start in range(0, len(missing), EMBED_BATCH_SIZE):
+        batch = missing[start:start + EMBED_BATCH_SIZE]
+        try:
+            vectors = invoke_text_embedding_endpoint([summaries[i] for i in batch])
+        except Exception as e:
+            vectors = [e] * len(batch)
+        for i, vector in zip(batch, vectors):
+            embeddings[i] = vector
+            if not isinstance(vector, Exception):
+                embedding_cache.put(summaries[i], vector)
+    return embeddings
+
+
+def invoke_text_embedding_endpoint(summaries: list) -> list:
+    payload = {'text_inputs': summaries}
     payload = json.dumps(payload).encode('utf-8')
-    response = sagemaker_runtime.invoke_endpoint(EndpointName=os.environ['SAGEMAKER_TEXT_EMBED_ENDPOINT'],
-                                                 ContentType='application/json',
-                                                 Body=payload)
-    body = json.loads(response['Body'].read())
-    embedding = body['embedding'][0]
-    return embedding
-
-
-def write_to_elasticsearch(session_id: str, embedding: list, end_time: int, summary: str) -> None:
-    document = {
-        'session_id': session_id,
-        'embedding': embedding,
-        'created_at': end_time,
-        'conversation_summary': summary
-    }
-    
+    with span('sagemaker.embed', request_bytes=len(payload), items=len(summaries)) as call:
+        response = get_sagemaker_runtime().invoke_endpoint(EndpointName=os.environ['SAGEMAKER_TEXT_EMBED_ENDPOINT'],
+                                                           ContentType='application/json',
+                                                           Body=payload)
+        body = response['Body'].read()
+        call.set(response_bytes=len(body))
+    return json.loads(body)['embedding']
+
+
+def write_to_long_term_memory(sessions: list) -> list:
+    """
+    :return: One entry per session, None when it was stored or the error that prevented it
+    """
+    if VECTOR_STORE_BACKEND != 'local':
+        return bulk_write_to_elasticsearch(sessions)
+    try:
+        get_local_store().add_many([(session['session_id'],
+                                     session['embedding'],
+                                     {'session_id': session['session_id'],
+                                      'user_id': session['user_id'],
+                                      'created_at': session['end_time'],
+                                      'conversation_summary': session['summary']}) for session in sessions])
+    except Exception as e:
+        logger.error(e)
+        return [e] * len(sessions)
+    return [None] * len(sessions)
+
+
+def bulk_write_to_elasticsearch(sessions: list) -> list:
+    """
+    Index one document per session with a single _bulk request.
+    :return: One entry per session, None when it was indexed or the error that prevented it
+    """
+    if not sessions:
+        return []
+    lines = []
+    for session in sessions:
+        document = {
+            'session_id': session['session_id'],
+            'user_id': session['user_id'],
+            'embedding': session['embedding'],
+            'created_at': session['end_time'],
+            'conversation_summary': session['summary']
+        }
+        lines.append(json.dumps({'index': {'_index': domain_index, '_id': session['session_id']}}))
+        lines.append(json.dumps(document))
+    body = '\n'.join(lines) + '\n'
+
     try:
-        response = requests.post(f'{URL}/_doc/{session_id}', auth=HTTPBasicAuth(os_username, os_password),
-                                 json=document)
-        if response.status_code not in [200, 201]:
+        response = get_search_client().bulk(body)
+        if response.status_code != 200:
             logger.error(response.status_code)
             logger.error(response.text)
+            return [f'HTTP {response.status_code}'] * len(sessions)
+        items = response.json()['items']
     except Exception as e:
         logger.error(e)
+        return [e] * len(sessions)
+    errors = []
+    for item in items:
+        result = item['index']
+        errors.append(result.get('error') if result.get('status') not in [200, 201] else None)
+    return errors
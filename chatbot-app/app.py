@@ -1,15 +1,30 @@
 from retrieve import retrieve_top_matching_past_conversations
 from llm import summarize_passages_and_collate_answers
 from retrieve import retrieve_top_matching_passages
-from ddb import get_conversations_by_session_id
-from llm import generate_dialogue_response
+from retrieve import format_past_conversations
+from retrieve import get_ltm_prefetcher
+from retrieve import strip_task_prefix
+from retrieve import select_passages
+from response_cache import context_fingerprint
+from ddb import get_recent_conversations
+from llm import stream_dialogue_response
 from ddb import add_conversation_turn
+from prompt import MAX_PROMPT_TOKENS
 from ddb import create_session
 from ddb import end_session
+from response_cache import response_cache
+from write_buffer import turn_write_buffer
+from prompt import count_tokens
+from retrieve import encode_query_in_background
+from retrieve import encode_query
+from prompt import pack_history
+from llm import endpoint_name
 from llm import detect_task
+from registry import get_resource
+from tracing import trace
+from tracing import span
 import streamlit as st
 import logging
-import boto3
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -20,7 +35,8 @@ logger = logging.getLogger('log')
 # Set Streamlit page configuration
 st.set_page_config(page_title='ai-assistant', layout='wide')
 
-dynamodb = boto3.resource('dynamodb')
+# Built once per process and reused by every rerun of this script
+dynamodb = get_resource('dynamodb')
 
 # Initialize session states
 if 'generated' not in st.session_state:
@@ -53,7 +69,9 @@ def new_session():
     # End current session and update sessions table in DynamoDB
     table_name = 'sessions'
     table = dynamodb.Table(table_name)
-    end_session(table, st.session_state.session_id)
+    end_session(table, st.session_state.session_id, write_buffer=turn_write_buffer)
+    if get_ltm_prefetcher() is not None:
+        get_ltm_prefetcher().drop(st.session_state.session_id)
 
     save = []
     for j in range(len(st.session_state['generated']) - 1, -1, -1):
@@ -71,6 +89,10 @@ with st.sidebar.expander('🛠️', expanded=True):
     max_turns = st.number_input('Number of turns to remember',
                                 min_value=1,
                                 max_value=100)
+    max_prompt_tokens = st.number_input('Prompt token budget',
+                                        min_value=64,
+                                        max_value=4096,
+                                        value=MAX_PROMPT_TOKENS)
 
 # Set up the Streamlit app layout
 st.title('🤖 AI Assistant 🧠')
@@ -86,44 +108,93 @@ sessions_table = dynamodb.Table('sessions')
 conversations_table = dynamodb.Table('conversations')
 
 
-def respond_by_task(query, history):
+def render_stream(chunks, placeholder) -> str:
+    """
+    Render streamed chunks incrementally into the placeholder and return the full completion.
+    """
+    completion = ''
+    for chunk in chunks:
+        completion += chunk
+        placeholder.success(f'{completion}▌', icon='🤖')
+    return completion.strip()
+
+
+def generate_or_reuse_dialogue_response(prompt, history, placeholder, query_embedding=None) -> str:
+    """
+    Stream a fresh completion unless a semantically equivalent query was already answered with the same history.
+    `query_embedding` is the future of the query's embedding, started when the response cache is enabled.
+    """
+    if query_embedding is None:
+        return render_stream(stream_dialogue_response(prompt), placeholder)
+    query_embedding = query_embedding.result()
+    fingerprint = context_fingerprint('stm', endpoint_name, history)
+    completion = response_cache.lookup(query_embedding, fingerprint)
+    if completion is None:
+        completion = render_stream(stream_dialogue_response(prompt), placeholder)
+        response_cache.store(query_embedding, fingerprint, completion)
+    return completion
+
+
+def prefetched_hits(kind, query):
+    """
+    Hits of `kind` the LTM prefetcher already holds for the follow-up `query`, or None.
+    """
+    ltm_prefetcher = get_ltm_prefetcher()
+    if ltm_prefetcher is None:
+        return None
+    text = strip_task_prefix(query)
+    # Prefetches embed the bare message, so the follow-up is compared without its task prefix
+    return ltm_prefetcher.lookup(st.session_state.session_id, kind, text, lambda: encode_query(text))
+
+
+def respond_by_task(query, history, placeholder, query_embedding=None):
     logger.info(f'HISTORY: {history}')
     task_type = detect_task(query)
     logger.info(f'TASK TYPE = {task_type}')
     completion = None
     if task_type == 'STM CHAT':
+        if get_ltm_prefetcher() is not None:
+            # Searched in the background while the reply streams, for a /past or /verified follow-up
+            get_ltm_prefetcher().prefetch(st.session_state.session_id, user_input)
         if len(history) > 0:
             prompt = f"""{history}
 Me: {user_input}
 AI:"""
             logger.info(f'Prompt: {prompt}')
-            completion = generate_dialogue_response(prompt)
+            completion = generate_or_reuse_dialogue_response(prompt, history, placeholder, query_embedding)
         else:
             prompt = f"""Me: {user_input}
 AI:"""
             logger.info(f'Prompt: {prompt}')
-            completion = generate_dialogue_response(prompt)
+            completion = generate_or_reuse_dialogue_response(prompt, history, placeholder, query_embedding)
     elif task_type == 'LTM PAST CONVERSATIONS':
-        completion = retrieve_top_matching_past_conversations(user_input, 'conversations')
+        hits = prefetched_hits('past', user_input)
+        if hits is None:
+            completion = retrieve_top_matching_past_conversations(user_input, 'conversations')
+        else:
+            completion = format_past_conversations(hits)
         completion = '\n\n'.join(completion)
     elif task_type == 'LTM VERIFIED SOURCES':
-        completion = retrieve_top_matching_passages(user_input, 'passages')
-        completion = summarize_passages_and_collate_answers(completion, user_input)
+        hits = prefetched_hits('passages', user_input)
+        if hits is None:
+            completion = retrieve_top_matching_passages(user_input, 'passages')
+        else:
+            completion = select_passages(strip_task_prefix(user_input), hits)
+        # Already cached from retrieval, unless the passages came from a prefetch
+        query_embedding = encode_query(user_input) if response_cache is not None else None
+        completion = summarize_passages_and_collate_answers(completion, user_input, query_embedding=query_embedding)
     return completion
 
 
-def transform_ddb_past_history(history: list, num_turns=10) -> str:
-    past_hist = []
-    for turn in history:
-        me_utterance = turn['Me']
-        bot_utterance = turn['AI']
-        past_hist.append(f'Me: {me_utterance}')
-        past_hist.append(f'AI: {bot_utterance}')
-    past_hist = past_hist[-num_turns*2:]
-    past_hist_str = '\n'.join(past_hist)
+def transform_ddb_past_history(history: list, num_turns=10, token_budget=MAX_PROMPT_TOKENS) -> str:
+    past_hist_str, usage = pack_history(history, num_turns, token_budget)
+    logger.info(f'HISTORY TOKENS: {usage}')
     return past_hist_str
 
 
+# The conversation expander is created up front so a streamed response can render inside it
+conversation_expander = st.expander('Conversation', expanded=True)
+
 if user_input:
     user_utterance = st.session_state['input']
     ai_utterance = st.session_state['generated']
@@ -131,19 +202,36 @@ if user_input:
         # Start a new session
         st.session_state.session_id = create_session(sessions_table)
 
-    past_history = get_conversations_by_session_id(conversations_table, st.session_state.session_id)
-    past_history = transform_ddb_past_history(past_history, max_turns)
-    output = respond_by_task(user_input, past_history)
-
-    st.session_state.past.append(user_input)
-    st.session_state.generated.append(output)
-
-    ai_utterance = st.session_state['generated'][-1]
-    add_conversation_turn(conversations_table, st.session_state.session_id, user_utterance, ai_utterance)
+    # Everything recorded for this turn shares one trace id, tagged with the session
+    with trace(session_id=st.session_state.session_id), span('chat.turn', task=detect_task(user_input)):
+        query_embedding = None
+        if response_cache is not None and detect_task(user_input) == 'STM CHAT':
+            # Keys the response cache; embedded while the history loads, so it adds no round trip of its own
+            query_embedding = encode_query_in_background(user_input)
+        past_history = get_recent_conversations(conversations_table, st.session_state.session_id, max_turns,
+                                                turn_write_buffer)
+        # Whatever the query itself needs is taken out of the budget before history is packed
+        history_budget = max_prompt_tokens - count_tokens(f'Me: {user_input}\nAI:')
+        past_history = transform_ddb_past_history(past_history, max_turns, history_budget)
+        with conversation_expander:
+            # Live view of the pending turn, replaced by the regular history rendering below once complete
+            pending_turn = st.empty()
+            with pending_turn.container():
+                st.info(user_input, icon='🧐')
+                response_placeholder = st.empty()
+        output = respond_by_task(user_input, past_history, response_placeholder, query_embedding)
+        pending_turn.empty()
+
+        st.session_state.past.append(user_input)
+        st.session_state.generated.append(output)
+
+        ai_utterance = st.session_state['generated'][-1]
+        add_conversation_turn(conversations_table, st.session_state.session_id, user_utterance, ai_utterance,
+                              sessions_table, turn_write_buffer)
 
 # Display the conversation history using an expander, and allow the user to download it
 download_str = []
-with st.expander('Conversation', expanded=True):
+with conversation_expander:
     for i in range(len(st.session_state['generated']) - 1, -1, -1):
         st.info(st.session_state['past'][i], icon='🧐')
         st.success(st.session_state['generated'][i], icon='🤖')
@@ -0,0 +1,405 @@
+from llm import parse_generation_response, build_generation_payload, build_passage_prompt
+from retrieve import get_embedding_codec, get_vector_store, strip_task_prefix, get_bm25_query
+from retrieve import format_past_conversations, build_embedding_payload, select_passages
+from retrieve import text_embedding_model_endpoint_name, embedding_cache
+from retrieve import PASSAGES_HYBRID, PASSAGES_K, PASSAGES_CANDIDATES, RRF_K
+from retrieve import RETRIEVAL_BACKEND, get_passage_reranker, past_conversations_search
+from retrieve import EMBEDDING_BATCHER_SETTINGS, LTM_PREFETCH_SETTINGS
+from response_cache import context_fingerprint, response_cache
+from llm import endpoint_name, detect_task, MAX_CONCURRENCY, PASSAGE_TIMEOUT
+from session_store import DynamoDBSessionStore, MemorySessionStore
+from session_store import new_turn
+from embedding_batcher import AsyncEmbeddingBatcher, batcher_settings
+from ltm_prefetch import LTMPrefetcher, prefetcher_settings
+from rerank import reciprocal_rank_fusion
+from vector_store import get_es_query
+from prompt import MAX_PROMPT_TOKENS
+from prompt import count_tokens
+from prompt import pack_history
+from tracing import trace
+from tracing import span
+import contextlib
+import argparse
+import inspect
+import asyncio
+import logging
+import time
+import json
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+class Threaded:
+    """
+    Awaitable facade over a blocking client (a boto3 client or Table, an OpenSearchClient or one of the fakes):
+    every method call runs in a worker thread, so the event loop keeps serving other turns while it waits.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(attribute, *args, **kwargs)
+        return call
+
+
+async def read_body(body) -> bytes:
+    # botocore returns a blocking StreamingBody, aiobotocore one whose read() is a coroutine
+    data = body.read()
+    if inspect.isawaitable(data):
+        data = await data
+    return data
+
+
+class AsyncOpenSearchClient:
+    """
+    aiohttp counterpart of search_client.OpenSearchClient for the search side: one keep-alive connection pool
+    shared by every coroutine, with the same `search` and `msearch` signatures.
+    """
+
+    def __init__(self, endpoint: str, username: str, password: str, pool_size: int = 10, timeout: float = 10.0):
+        import aiohttp
+        self.endpoint = endpoint.rstrip('/')
+        self.session = aiohttp.ClientSession(auth=aiohttp.BasicAuth(username, password),
+                                             connector=aiohttp.TCPConnector(limit=pool_size),
+                                             timeout=aiohttp.ClientTimeout(total=timeout))
+
+    async def search(self, index: str, query: dict) -> dict:
+        async with self.session.post(f'{self.endpoint}/{index}/_search', json=query) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def msearch(self, searches: list) -> list:
+        lines = []
+        for index, query in searches:
+            lines.append(json.dumps({'index': index}))
+            lines.append(json.dumps(query))
+        body = '\n'.join(lines) + '\n'
+        async with self.session.post(f'{self.endpoint}/_msearch', data=body.encode('utf-8'),
+                                     headers={'Content-Type': 'application/x-ndjson'}) as response:
+            response.raise_for_status()
+            return (await response.json())['responses']
+
+    async def close(self) -> None:
+        await self.session.close()
+
+
+class AsyncChatCore:
+    """
+    One chat turn end to end on asyncio, independent of Streamlit. Any I/O a turn needs that does not depend on
+    another call is issued concurrently (history with the query embedding, passage answers with each other), and
+    the turn is written to the session store in the background so the reply does not wait for it. Background write
+    failures are logged and kept in `write_errors`; `drain` waits for every pending write.
+
+    Clients are awaitable: aioboto3 clients/Tables and AsyncOpenSearchClient natively, anything blocking wrapped
+    in `Threaded`.
+    """
+
+    def __init__(self, sagemaker, store, search, max_concurrency: int = MAX_CONCURRENCY,
+                 passage_timeout: float = PASSAGE_TIMEOUT, embedding_batching: dict = EMBEDDING_BATCHER_SETTINGS,
+                 ltm_prefetching: dict = LTM_PREFETCH_SETTINGS):
+        self.sagemaker = sagemaker
+        self.store = store
+        self.search = search
+        self.passage_timeout = passage_timeout
+        self.write_errors = []
+        self.pending_writes = set()
+        self._llm_slots = asyncio.Semaphore(max_concurrency)
+        # Concurrent turns' queries share endpoint calls when batching is configured
+        self.embedding_batcher = None
+        if embedding_batching is not None:
+            self.embedding_batcher = AsyncEmbeddingBatcher(self.embed_batch, **embedding_batching)
+        # STM turns speculatively warm the results of a /past or /verified follow-up when prefetching is configured
+        self.ltm_prefetcher = None
+        if ltm_prefetching is not None:
+            self.ltm_prefetcher = LTMPrefetcher(self.prefetch_ltm, **ltm_prefetching)
+
+    async def embed(self, text: str) -> list:
+        embedding = embedding_cache.get(text)
+        if embedding is not None:
+            return embedding
+        if self.embedding_batcher is not None:
+            embedding = await self.embedding_batcher.embed(text)
+        else:
+            embedding = (await self.embed_batch([text]))[0]
+        embedding_cache.put(text, embedding)
+        return embedding
+
+    async def embed_batch(self, texts: list) -> list:
+        payload = build_embedding_payload(texts)
+        with span('sagemaker.embed', request_bytes=len(payload), items=len(texts)) as call:
+            response = await self.sagemaker.invoke_endpoint(EndpointName=text_embedding_model_endpoint_name,
+                                                             ContentType='application/json',
+                                                             Body=payload)
+            body = await read_body(response['Body'])
+            call.set(response_bytes=len(body))
+        return json.loads(body)['embedding']
+
+    async def generate(self, prompt: str, max_length=256, timeout: float = None) -> str:
+        """
+        :raise asyncio.TimeoutError: If the endpoint does not answer within `timeout` seconds, counted from when
+                                     a concurrency slot frees up, not from when the call was queued
+        """
+        payload = build_generation_payload(prompt, max_length)
+        async with self._llm_slots:
+            return await asyncio.wait_for(self._invoke_generate(payload, prompt), timeout)
+
+    async def _invoke_generate(self, payload: bytes, prompt: str) -> str:
+        with span('sagemaker.generate', request_bytes=len(payload), prompt_tokens=count_tokens(prompt)) as call:
+            response = await self.sagemaker.invoke_endpoint(EndpointName=endpoint_name,
+                                                             ContentType='application/json',
+                                                             Body=payload)
+            body = await read_body(response['Body'])
+            completion = parse_generation_response(body)
+            call.set(response_bytes=len(body), completion_tokens=count_tokens(completion))
+        return completion
+
+    async def search_index(self, index: str, embedding: list, k: int, text: str = None, **search) -> list:
+        """
+        k-NN search of `index`, fused with BM25 over `text` when given. `search` carries the filters, decay and
+        paging arguments of VectorStore.search.
+        """
+        embedding = get_embedding_codec(index).encode(embedding)
+        if RETRIEVAL_BACKEND == 'local':
+            return await asyncio.to_thread(get_vector_store(index).search, embedding, k, **search)
+        if text is None:
+            return (await self.search.search(index, get_es_query(embedding, k, **search)))['hits']['hits']
+        responses = await self.search.msearch([(index, get_es_query(embedding, k)),
+                                               (index, get_bm25_query(text, k, 'passage'))])
+        result_lists = []
+        for response in responses:
+            if 'error' in response:
+                logger.error(f'Hybrid search leg failed: {response["error"]}')
+                continue
+            result_lists.append(response['hits']['hits'])
+        return reciprocal_rank_fusion(result_lists, RRF_K)
+
+    async def search_passages(self, embedding: list, text: str) -> list:
+        """
+        The candidate pool of passages for a /verified query, before selection.
+        """
+        reranked = get_passage_reranker() is not None
+        pool_size = max(PASSAGES_K, PASSAGES_CANDIDATES) if PASSAGES_HYBRID or reranked else PASSAGES_K
+        return await self.search_index('passages', embedding, pool_size, text if PASSAGES_HYBRID else None)
+
+    async def prefetch_ltm(self, session_id: str, text: str) -> dict:
+        """
+        What a /past or /verified follow-up on `text` would retrieve, for the LTM prefetcher.
+        """
+        with span('ltm.prefetch') as call:
+            cached = embedding_cache.get(text) is not None
+            embedding, user_id = await asyncio.gather(self.embed(text), self.store.get_user_id(session_id))
+            past, passages = await asyncio.gather(
+                self.search_index('conversations', embedding, **past_conversations_search(user_id)),
+                self.search_passages(embedding, text))
+            # The embedding, unless cached, and one search per index
+            calls = 2 if cached else 3
+            call.set(calls=calls)
+        return {'embedding': embedding, 'past': past, 'passages': passages, 'calls': calls}
+
+    async def prefetched(self, session_id: str, kind: str, query: str):
+        """
+        Hits of `kind` the LTM prefetcher already holds for the follow-up `query`, or None.
+        """
+        if self.ltm_prefetcher is None:
+            return None
+        text = strip_task_prefix(query)
+        # Prefetches embed the bare message, so the follow-up is compared without its task prefix
+        return await self.ltm_prefetcher.lookup(session_id, kind, text, lambda: self.embed(text))
+
+    async def answer_passages(self, passages: list, query: str):
+        """
+        :return: The collated answers, and whether every passage was answered
+        """
+        if not passages:
+            return 'I could not find a verified source that answers this question.', True
+
+        answers = await asyncio.gather(*(self.generate(build_passage_prompt(passage, query), 256, self.passage_timeout)
+                                         for passage, _, _ in passages), return_exceptions=True)
+        collated_answers = []
+        for answer, (_, doc_id, passage_id) in zip(answers, passages):
+            if isinstance(answer, asyncio.TimeoutError):
+                logger.warning(f'Answer generation timed out for doc = {doc_id} | passage = {passage_id}')
+            elif isinstance(answer, Exception):
+                logger.error(f'Answer generation failed for doc = {doc_id} | passage = {passage_id}: {answer}')
+            else:
+                collated_answers.append(f'{answer}\n\n[doc = {doc_id} | passage = {passage_id}]')
+        return '\n\n'.join(collated_answers), len(collated_answers) == len(passages)
+
+    async def respond(self, session_id: str, query: str, max_turns: int, token_budget: int) -> str:
+        task_type = detect_task(query)
+        logger.info(f'TASK TYPE = {task_type}')
+        if task_type == 'STM CHAT':
+            if self.ltm_prefetcher is not None:
+                self.ltm_prefetcher.prefetch(session_id, query)
+            if response_cache is None:
+                history = await self.store.get_history(session_id, max_turns)
+                embedding = None
+            else:
+                history, embedding = await asyncio.gather(self.store.get_history(session_id, max_turns),
+                                                          self.embed(query))
+            history, usage = pack_history(history, max_turns, token_budget)
+            logger.info(f'HISTORY TOKENS: {usage}')
+            prompt = f'{history}\nMe: {query}\nAI:' if history else f'Me: {query}\nAI:'
+            if embedding is None:
+                return await self.generate(prompt, 256)
+            fingerprint = context_fingerprint('stm', endpoint_name, history)
+            # The DynamoDB backend queries the table, which must not block the other sessions' turns
+            completion = await asyncio.to_thread(response_cache.lookup, embedding, fingerprint)
+            if completion is None:
+                completion = await self.generate(prompt, 256)
+                await asyncio.to_thread(response_cache.store, embedding, fingerprint, completion)
+            return completion
+        if task_type == 'LTM PAST CONVERSATIONS':
+            hits = await self.prefetched(session_id, 'past', query)
+            if hits is None:
+                embedding, user_id = await asyncio.gather(self.embed(query), self.store.get_user_id(session_id))
+                hits = await self.search_index('conversations', embedding, **past_conversations_search(user_id))
+            return '\n\n'.join(format_past_conversations(hits))
+        text = strip_task_prefix(query)
+        hits = await self.prefetched(session_id, 'passages', query)
+        if hits is None:
+            hits = await self.search_passages(await self.embed(query), text)
+        # A cross-encoder reranker loads its model and scores on the CPU
+        passages = await asyncio.to_thread(select_passages, text, hits)
+        fingerprint = context_fingerprint('verified', endpoint_name,
+                                          [(doc_id, passage_id) for _, doc_id, passage_id in passages])
+        embedding = None
+        if response_cache is not None and passages:
+            # Already cached unless the passages came from a prefetch
+            embedding = await self.embed(query)
+            cached = await asyncio.to_thread(response_cache.lookup, embedding, fingerprint)
+            if cached is not None:
+                return cached
+        collated_answers, complete = await self.answer_passages(passages, query)
+        if response_cache is not None and passages and complete:
+            await asyncio.to_thread(response_cache.store, embedding, fingerprint, collated_answers)
+        return collated_answers
+
+    async def handle_turn(self, session_id: str, query: str, max_turns: int = 10,
+                          token_budget: int = MAX_PROMPT_TOKENS) -> str:
+        """
+        Answer `query` within the session and schedule the turn write; returns as soon as the reply is ready.
+        :raise SessionNotFound: If the session is unknown or already ended, before any work is done for the turn
+        """
+        with trace(session_id=session_id), span('chat.turn', task=detect_task(query)):
+            await self.store.get_user_id(session_id)
+            completion = await self.respond(session_id, query, max_turns, token_budget)
+            self.record_turn(session_id, query, completion)
+        return completion
+
+    def record_turn(self, session_id: str, user: str, bot: str) -> None:
+        turn = new_turn(session_id, user, bot)
+        # Visible to the next turn right away, before the background write lands
+        self.store.cache_turn(turn)
+        self._spawn_write(self.store.put_turn(turn), f'turn of session {session_id}')
+
+    def _spawn_write(self, write, description: str) -> None:
+        task = asyncio.ensure_future(write)
+        self.pending_writes.add(task)
+
+        def done(finished):
+            self.pending_writes.discard(finished)
+            if not finished.cancelled() and finished.exception() is not None:
+                self.write_errors.append((description, finished.exception()))
+                logger.error(f'Background write failed for {description}: {finished.exception()}')
+        task.add_done_callback(done)
+
+    async def drain(self) -> None:
+        """
+        Wait until every background write has completed (or failed into `write_errors`).
+        """
+        while self.pending_writes:
+            await asyncio.gather(*self.pending_writes, return_exceptions=True)
+
+    async def create_session(self, user_id: str = None) -> str:
+        return await self.store.create_session(user_id)
+
+    async def end_session(self, session_id: str) -> dict:
+        # Session summaries are computed from the stored turns, so every turn must have landed first
+        await self.drain()
+        if self.ltm_prefetcher is not None:
+            self.ltm_prefetcher.drop(session_id)
+        return await self.store.end_session(session_id)
+
+
+@contextlib.asynccontextmanager
+async def aws_chat_core(search, sessions_table_name: str = 'sessions',
+                        conversations_table_name: str = 'conversations', write_buffer=None):
+    """
+    AsyncChatCore over native aioboto3 SageMaker runtime and DynamoDB clients, writing turns through
+    `write_buffer` when given.
+    """
+    import aioboto3
+    session = aioboto3.Session()
+    async with session.client('sagemaker-runtime') as sagemaker, session.resource('dynamodb') as dynamodb:
+        store = DynamoDBSessionStore(await dynamodb.Table(sessions_table_name),
+                                     await dynamodb.Table(conversations_table_name), write_buffer)
+        core = AsyncChatCore(sagemaker, store, search)
+        try:
+            yield core
+        finally:
+            await core.drain()
+
+
+def fake_chat_core(latency: float = 0.05, store: str = 'dynamodb', write_buffer: bool = False,
+                   embedding_batcher: bool = None, ltm_prefetch: bool = None) -> AsyncChatCore:
+    """
+    AsyncChatCore over the local fakes, for running the core without AWS. `store` is `dynamodb` (fake tables) or
+    `memory`; `write_buffer` batches the fake tables' turn writes. `embedding_batcher` and `ltm_prefetch` turn
+    query batching and LTM prefetching on or off whatever their `enabled` settings say.
+    """
+    embedding_batching = EMBEDDING_BATCHER_SETTINGS
+    if embedding_batcher is not None:
+        embedding_batching = (embedding_batching or batcher_settings({'enabled': True})) if embedding_batcher else None
+    ltm_prefetching = LTM_PREFETCH_SETTINGS
+    if ltm_prefetch is not None:
+        ltm_prefetching = (ltm_prefetching or prefetcher_settings({'enabled': True})) if ltm_prefetch else None
+    from fakes import FakeSageMakerRuntime, FakeDynamoDBTable, FakeDynamoDBResource, FakeOpenSearchClient
+    if store == 'memory':
+        session_store = MemorySessionStore()
+    else:
+        sessions = FakeDynamoDBTable('session_id', latency=latency / 5)
+        conversations = FakeDynamoDBTable('session_id', 'timestamp', latency=latency / 5)
+        buffer = None
+        if write_buffer:
+            from write_buffer import TurnWriteBuffer
+            buffer = TurnWriteBuffer(FakeDynamoDBResource({'sessions': sessions, 'conversations': conversations}))
+        session_store = DynamoDBSessionStore(Threaded(sessions), Threaded(conversations), buffer)
+    return AsyncChatCore(Threaded(FakeSageMakerRuntime(latency=latency)), session_store,
+                         Threaded(FakeOpenSearchClient(latency=latency / 2)), embedding_batching=embedding_batching,
+                         ltm_prefetching=ltm_prefetching)
+
+
+async def run_demo(num_sessions: int, num_turns: int, latency: float) -> None:
+    core = fake_chat_core(latency)
+    queries = ['hi', 'what is court defamation?', '/past defamation', '/verified what is defamation?']
+
+    async def converse():
+        session_id = await core.create_session()
+        for turn in range(num_turns):
+            await core.handle_turn(session_id, queries[turn % len(queries)])
+        await core.end_session(session_id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(converse() for _ in range(num_sessions)))
+    elapsed = time.perf_counter() - start
+    logger.info(f'{num_sessions * num_turns} turns over {num_sessions} sessions in {elapsed:.2f}s '
+                f'({num_sessions * num_turns / elapsed:.1f} turns/s), write errors = {len(core.write_errors)}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run concurrent chat sessions through the async core on fakes')
+    parser.add_argument('--sessions', type=int, default=8)
+    parser.add_argument('--turns', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated per-call latency in seconds')
+    args = parser.parse_args()
+    asyncio.run(run_demo(args.sessions, args.turns, args.latency))
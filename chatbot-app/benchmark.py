@@ -0,0 +1,464 @@
+import os
+
+# The fakes replace every client the modules under test would build; a region keeps any missed one offline-safe
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+from fakes import FakeSageMakerRuntime, FakeDynamoDBTable, FakeDynamoDBResource, FakeOpenSearchClient
+from fakes import fake_embedding
+from prompt import MAX_PROMPT_TOKENS
+from prompt import pack_history
+from transcripts import DynamoDBTranscriptStore, encode_transcript
+from embedding_batcher import EmbeddingBatcher
+from async_chat import AsyncChatCore, Threaded
+from session_store import MemorySessionStore
+from ltm_prefetch import prefetcher_settings
+from write_buffer import TurnWriteBuffer
+from tracing import percentile
+from concurrent.futures import ThreadPoolExecutor
+import importlib.util
+import functools
+import asyncio
+import statistics
+import subprocess
+import argparse
+import platform
+import logging
+import random
+import time
+import json
+import sys
+import registry
+import llm
+import ddb
+import retrieve
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+LAMBDA_HANDLER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '05-lambda-handler.py')
+COLD_START_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cold_start.py')
+WORDS = ('court defamation libel slander contract statute limitations damages plaintiff defendant evidence '
+         'appeal verdict jury negligence liability tort precedent ruling hearing').split()
+
+benchmarks = []
+
+
+def benchmark(name: str, **grid):
+    """
+    Register `function(backends, **params)` once per combination of the parameter grid. The function prepares
+    its data and returns the zero-argument callable that is timed.
+    """
+    def register(function):
+        combinations = [{}]
+        for param, values in grid.items():
+            combinations = [dict(combination, **{param: value}) for combination in combinations for value in values]
+        for params in combinations:
+            benchmarks.append((name, params, function))
+        return function
+    return register
+
+
+class Backends:
+    """
+    A fresh set of fakes per benchmark case, so call counts and stored data never leak between cases. Threads
+    and pools a case starts are registered with `closing` and stopped once it is measured.
+    """
+
+    def __init__(self, latency: float, tokens_per_second: float, dimension: int, seed: int):
+        self.rng = random.Random(seed)
+        self.dimension = dimension
+        self.sagemaker = FakeSageMakerRuntime(latency=latency, tokens_per_second=tokens_per_second,
+                                              embedding_dimension=dimension)
+        self.search = FakeOpenSearchClient(latency=latency / 5)
+        self.sessions = FakeDynamoDBTable('session_id', latency=latency / 10)
+        self.conversations = FakeDynamoDBTable('session_id', 'timestamp', latency=latency / 10, page_size=100)
+        self.transcripts = FakeDynamoDBTable('session_id', 'part', latency=latency / 10)
+        self.dynamodb = FakeDynamoDBResource({'sessions': self.sessions, 'conversations': self.conversations,
+                                              'transcripts': self.transcripts})
+        self.cleanups = []
+
+    def closing(self, resource, close=None):
+        """
+        Register `close` (default `resource.close`) to run when the case is done.
+        :return: `resource`
+        """
+        self.cleanups.append(close or resource.close)
+        return resource
+
+    def close(self) -> None:
+        while self.cleanups:
+            self.cleanups.pop()()
+
+    def all(self) -> list:
+        return [self.sagemaker, self.search, self.sessions, self.conversations, self.transcripts]
+
+    def call_count(self) -> int:
+        return sum(len(backend.calls) for backend in self.all())
+
+    def sentence(self, num_words: int = 12) -> str:
+        return ' '.join(self.rng.choice(WORDS) for _ in range(num_words))
+
+    def turns(self, session_id: str, num_turns: int) -> list:
+        return [{'session_id': session_id, 'timestamp': 1700000000000 + i, 'Me': self.sentence(),
+                 'AI': self.sentence()} for i in range(num_turns)]
+
+    def index_documents(self, index: str, num_documents: int, source) -> None:
+        for i in range(num_documents):
+            document = source(i)
+            self.search.index(index, str(i), dict(document, embedding=fake_embedding(str(i), self.dimension)))
+
+    def install(self) -> None:
+        """
+        Point the app modules at these fakes, dropping whatever they cached from earlier cases.
+        """
+        registry.install_client('sagemaker-runtime', self.sagemaker)
+        registry.install('opensearch', self.search)
+        retrieve.vector_stores.clear()
+        retrieve.embedding_cache.clear()
+        ddb.history_buffers.clear()
+
+
+@benchmark('encode_query', cache=['cold', 'warm'])
+def bench_encode_query(backends: Backends, cache: str):
+    query = backends.sentence()
+    retrieve.encode_query(query)
+
+    def run():
+        if cache == 'cold':
+            retrieve.embedding_cache.clear()
+        retrieve.encode_query(query)
+    return run
+
+
+@benchmark('concurrent_encode_query', callers=[8, 32], batched=[False, True])
+def bench_concurrent_encode_query(backends: Backends, callers: int, batched: bool):
+    """
+    `callers` sessions embedding their queries at the same time, as one endpoint call each or through the
+    micro-batcher.
+    """
+    queries = [backends.sentence() for _ in range(callers)]
+    embed = retrieve.invoke_text_embedding_endpoint
+    if batched:
+        batcher = backends.closing(EmbeddingBatcher(retrieve.invoke_text_embedding_batch, max_batch_size=16,
+                                                    max_wait=0.002))
+        embed = batcher.embed
+    executor = ThreadPoolExecutor(max_workers=callers)
+    backends.closing(executor, executor.shutdown)
+
+    def run():
+        list(executor.map(embed, queries))
+    return run
+
+
+@benchmark('retrieve_top_matching_past_conversations', documents=[100, 1000])
+def bench_retrieve_past_conversations(backends: Backends, documents: int):
+    backends.index_documents('conversations', documents,
+                             lambda i: {'session_id': str(i), 'created_at': 1700000000000 + i * 1000,
+                                        'conversation_summary': backends.sentence(30)})
+    query = backends.sentence()
+
+    def run():
+        retrieve.embedding_cache.clear()
+        retrieve.retrieve_top_matching_past_conversations(query, 'conversations')
+    return run
+
+
+@benchmark('retrieve_top_matching_passages', documents=[100, 1000])
+def bench_retrieve_passages(backends: Backends, documents: int):
+    backends.index_documents('passages', documents,
+                             lambda i: {'doc_id': str(i // 10), 'passage_id': str(i % 10),
+                                        'passage': backends.sentence(60)})
+    query = f'/verified {backends.sentence()}'
+
+    def run():
+        retrieve.embedding_cache.clear()
+        retrieve.retrieve_top_matching_passages(query, 'passages')
+    return run
+
+
+@benchmark('ltm_follow_up', task=['/past', '/verified'], prefetch=[False, True])
+def bench_ltm_follow_up(backends: Backends, task: str, prefetch: bool):
+    """
+    An STM turn, then the same question asked of long-term memory, through the async core. With `prefetch`, the
+    follow-up is served from what the STM turn prefetched. Phases are the two turns' latencies.
+    """
+    backends.index_documents('conversations', 100,
+                             lambda i: {'session_id': str(i), 'created_at': 1700000000000 + i * 1000,
+                                        'conversation_summary': backends.sentence(30)})
+    backends.index_documents('passages', 100,
+                             lambda i: {'doc_id': str(i // 10), 'passage_id': str(i % 10),
+                                        'passage': backends.sentence(60)})
+    question = backends.sentence()
+
+    async def converse():
+        core = AsyncChatCore(Threaded(backends.sagemaker), MemorySessionStore(), Threaded(backends.search),
+                             embedding_batching=None,
+                             ltm_prefetching=prefetcher_settings({'enabled': prefetch}))
+        session_id = await core.create_session()
+        phases = {}
+        for name, query in (('stm', question), ('follow_up', f'{task} {question}')):
+            start = time.perf_counter()
+            await core.handle_turn(session_id, query)
+            phases[name] = (time.perf_counter() - start) * 1000
+        await core.end_session(session_id)
+        return phases
+
+    def run():
+        retrieve.embedding_cache.clear()
+        return asyncio.run(converse())
+    return run
+
+
+@benchmark('summarize_passages_and_collate_answers', passages=[1, 3, 6])
+def bench_summarize_passages(backends: Backends, passages: int):
+    hits = [[backends.sentence(60), str(i), '0'] for i in range(passages)]
+    query = backends.sentence()
+
+    def run():
+        llm.summarize_passages_and_collate_answers(hits, query)
+    return run
+
+
+@benchmark('transform_ddb_past_history', turns=[10, 100, 1000])
+def bench_transform_history(backends: Backends, turns: int):
+    history = backends.turns('session', turns)
+
+    def run():
+        # app.transform_ddb_past_history is pack_history plus logging; app.py cannot be imported outside Streamlit
+        pack_history(history, turns, MAX_PROMPT_TOKENS)
+    return run
+
+
+@benchmark('end_session', turns=[10, 100, 1000])
+def bench_end_session(backends: Backends, turns: int):
+    for turn in backends.turns('session', turns):
+        backends.conversations.put_item(Item=turn)
+
+    def run():
+        # The counters are maintained per turn, so ending costs the same whatever the number of turns
+        backends.sessions.put_item(Item={'session_id': 'session', 'start_time': 1700000000000, 'end_time': None,
+                                         'num_turns': turns, 'user_tokens': 0, 'bot_tokens': 0,
+                                         'last_activity': 1700000000000})
+        ddb.end_session(backends.sessions, 'session')
+    return run
+
+
+@benchmark('write_turns', turns=[25, 100], buffered=[False, True])
+def bench_write_turns(backends: Backends, turns: int, buffered: bool):
+    backends.sessions.put_item(Item={'session_id': 'session', 'start_time': 1700000000000, 'end_time': None,
+                                     'num_turns': 0, 'user_tokens': 0, 'bot_tokens': 0,
+                                     'last_activity': 1700000000000})
+    history = backends.turns('session', turns)
+    write_buffer = None
+    if buffered:
+        write_buffer = backends.closing(TurnWriteBuffer(backends.dynamodb, flush_interval=60))
+
+    def run():
+        for turn in history:
+            # The writes add_conversation_turn makes, without its clock-derived timestamp
+            if write_buffer is not None:
+                write_buffer.add(turn)
+            else:
+                backends.conversations.put_item(Item=turn)
+                backends.sessions.update_item(**ddb.turn_counters_update(turn))
+        if write_buffer is not None:
+            write_buffer.flush()
+    return run
+
+
+@benchmark('read_transcript', turns=[200, 2000], archived=[False, True])
+def bench_read_transcript(backends: Backends, turns: int, archived: bool):
+    history = backends.turns('session', turns)
+    store = DynamoDBTranscriptStore(backends.transcripts)
+    if archived:
+        store.put('session', encode_transcript(history))
+    else:
+        for turn in history:
+            backends.conversations.put_item(Item=turn)
+
+    def run():
+        if archived:
+            for _ in store.turns('session'):
+                pass
+        else:
+            ddb.get_conversations_by_session_id(backends.conversations, 'session')
+    return run
+
+
+@functools.lru_cache(maxsize=None)
+def load_lambda_handler():
+    os.environ.setdefault('OS_ENDPOINT', 'http://localhost:9200')
+    os.environ.setdefault('OS_INDEX_NAME', 'conversations')
+    os.environ.setdefault('OS_USERNAME', 'benchmark')
+    os.environ.setdefault('OS_PASSWORD', 'benchmark')
+    os.environ.setdefault('SAGEMAKER_TEXT_EMBED_ENDPOINT', 'text-embedding')
+    os.environ.setdefault('SAGEMAKER_TEXT_GEN_ENDPOINT', 'text-generation')
+    spec = importlib.util.spec_from_file_location('lambda_handler', LAMBDA_HANDLER_FILE)
+    handler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(handler)
+    return handler
+
+
+def session_end_record(session_id: str, sequence_number: int) -> dict:
+    return {'eventName': 'MODIFY',
+            'dynamodb': {'SequenceNumber': str(sequence_number),
+                         'OldImage': {'session_id': {'S': session_id}, 'end_time': {'NULL': True}},
+                         'NewImage': {'session_id': {'S': session_id}, 'end_time': {'N': '1700000000000'}}}}
+
+
+@benchmark('lambda_handler', batch=[1, 10, 50], turns=[20, 200])
+def bench_lambda_handler(backends: Backends, batch: int, turns: int):
+    handler = load_lambda_handler()
+    handler.sagemaker_runtime = backends.sagemaker
+    handler.search_client = backends.search
+    handler.get_dynamodb_resource = lambda: backends.dynamodb
+    event = {'Records': []}
+    for i in range(batch):
+        for turn in backends.turns(f'session-{i}', turns):
+            backends.conversations.put_item(Item=turn)
+        event['Records'].append(session_end_record(f'session-{i}', i))
+
+    def run():
+        handler.chunk_summaries.clear()
+        handler.embedding_cache.clear()
+        response = handler.lambda_handler(event, None)
+        if response['batchItemFailures']:
+            raise RuntimeError(f'lambda_handler reported failures: {response["batchItemFailures"]}')
+    return run
+
+
+@benchmark('cold_start', target=['app', 'core', 'lambda'])
+def bench_cold_start(backends: Backends, target: str):
+    """
+    Every run is a fresh interpreter (see cold_start.py), timed end to end, with the medians of its import,
+    client construction and first versus warm request phases reported alongside.
+    """
+    def run():
+        completed = subprocess.run([sys.executable, COLD_START_FILE, target, '--json'], capture_output=True,
+                                   text=True, check=True, cwd=os.path.dirname(COLD_START_FILE))
+        return json.loads(completed.stdout)
+    return run
+
+
+def measure(run, backends: Backends, repeat: int, warmup: int) -> dict:
+    """
+    Time `run`. When it returns a dict of phase timings in milliseconds, their medians are reported as `phases_ms`.
+    """
+    for _ in range(warmup):
+        run()
+    samples = []
+    phases = {}
+    calls_before = backends.call_count()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        samples.append(time.perf_counter() - start)
+        if isinstance(result, dict):
+            for phase, ms in result.items():
+                phases.setdefault(phase, []).append(ms)
+    ordered = sorted(samples)
+    return {'repeat': repeat,
+            'min_ms': ordered[0] * 1000,
+            'median_ms': statistics.median(ordered) * 1000,
+            'mean_ms': statistics.fmean(ordered) * 1000,
+            'p95_ms': percentile(ordered, 0.95) * 1000,
+            'max_ms': ordered[-1] * 1000,
+            # Backend calls are deterministic, so unlike timings any change in them is a real change
+            'backend_calls': (backends.call_count() - calls_before) / repeat,
+            'phases_ms': {phase: statistics.median(values) for phase, values in phases.items()}}
+
+
+def case_name(name: str, params: dict) -> str:
+    if not params:
+        return name
+    return f'{name}[{",".join(f"{param}={value}" for param, value in params.items())}]'
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(selected: list, repeat: int, warmup: int, latency: float, tokens_per_second: float,
+                   dimension: int, seed: int) -> dict:
+    results = {}
+    log_level = logger.level
+    for name, params, function in benchmarks:
+        if selected and not any(pattern in name for pattern in selected):
+            continue
+        backends = Backends(latency, tokens_per_second, dimension, seed)
+        backends.install()
+        # The code under test logs every prompt and answer at INFO
+        logger.setLevel(logging.WARNING)
+        try:
+            result = measure(function(backends, **params), backends, repeat, warmup)
+        finally:
+            backends.close()
+            logger.setLevel(log_level)
+        results[case_name(name, params)] = result
+        logger.info(f'{case_name(name, params):<60} median {result["median_ms"]:9.2f} ms  '
+                    f'p95 {result["p95_ms"]:9.2f} ms  calls {result["backend_calls"]:g}'
+                    + ''.join(f'  {phase} {ms:.2f} ms' for phase, ms in result['phases_ms'].items()))
+    return {'meta': {'revision': git_revision(),
+                     'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'repeat': repeat,
+                     'latency': latency,
+                     'tokens_per_second': tokens_per_second,
+                     'dimension': dimension,
+                     'seed': seed},
+            'results': results}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float = 1.0) -> list:
+    """
+    :return: Cases whose median time grew by more than `tolerance` (a fraction) and `min_delta_ms`, or that make
+    more backend calls than in the baseline
+    """
+    regressions = []
+    for case, result in results['results'].items():
+        previous = baseline['results'].get(case)
+        if previous is None:
+            continue
+        ratio = result['median_ms'] / previous['median_ms'] if previous['median_ms'] else 1.0
+        logger.info(f'{case:<60} {previous["median_ms"]:9.2f} -> {result["median_ms"]:9.2f} ms ({ratio - 1:+.1%})'
+                    f'  calls {previous["backend_calls"]:g} -> {result["backend_calls"]:g}')
+        slower = ratio > 1 + tolerance and result['median_ms'] - previous['median_ms'] > min_delta_ms
+        if slower or result['backend_calls'] > previous['backend_calls']:
+            regressions.append(case)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths against local fake backends')
+    parser.add_argument('--only', nargs='*', default=[], help='run benchmarks whose name contains any of these')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.01, help='simulated SageMaker latency in seconds; '
+                                                                    'OpenSearch and DynamoDB get a fraction of it')
+    parser.add_argument('--tokens-per-second', type=float, default=None, help='simulated decode rate')
+    parser.add_argument('--dimension', type=int, default=256, help='fake embedding dimension')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='results JSON of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed median slowdown vs. the baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=1.0, help='slowdowns below this are noise')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only, args.repeat, args.warmup, args.latency, args.tokens_per_second,
+                             args.dimension, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_delta_ms)
+        if regressions:
+            logger.error(f'Regressions: {", ".join(regressions)}')
+            sys.exit(1)
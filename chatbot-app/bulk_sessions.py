@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor
+from ddb import get_conversations_by_session_id
+from transcripts import get_transcript_store, archive_turns
+from write_buffer import batch_put_items
+from prompt import count_tokens
+from decimal import Decimal
+import argparse
+import logging
+import boto3
+import json
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+# Sessions read from the export file between two rounds of batch writes
+IMPORT_CHUNK_SESSIONS = 200
+
+
+def to_json(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+
+def session_turns(conversations, transcript_store, session_id: str) -> list:
+    """
+    Turns of a session, read through the transcript decoder when the session was archived.
+    """
+    turns = transcript_store.turns(session_id) if transcript_store is not None else None
+    if turns is not None:
+        return list(turns)
+    return get_conversations_by_session_id(conversations, session_id)
+
+
+def export_sessions(dynamodb, path: str, sessions_table: str = 'sessions',
+                    conversations_table: str = 'conversations', max_workers: int = 8, transcript_store=None) -> int:
+    """
+    Write every session, with its turns in chronological order, as one JSON line `{"session": ..., "turns": [...]}`.
+    :return: Number of sessions exported
+    """
+    sessions = dynamodb.Table(sessions_table)
+    conversations = dynamodb.Table(conversations_table)
+    exported = 0
+    kwargs = {}
+    with open(path, 'w') as f, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            response = sessions.scan(**kwargs)
+            page = response['Items']
+            turns = executor.map(lambda session: session_turns(conversations, transcript_store,
+                                                               session['session_id']), page)
+            for session, turns_ in zip(page, turns):
+                f.write(json.dumps({'session': session, 'turns': turns_}, default=to_json) + '\n')
+            exported += len(page)
+            if 'LastEvaluatedKey' not in response:
+                return exported
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def with_counters(session: dict, turns: list) -> dict:
+    """
+    Sessions exported before the tables kept per-session counters get them computed from their turns.
+    """
+    session = dict(session)
+    session.setdefault('num_turns', len(turns))
+    session.setdefault('user_tokens', sum(count_tokens(turn['Me']) for turn in turns))
+    session.setdefault('bot_tokens', sum(count_tokens(turn['AI']) for turn in turns))
+    session.setdefault('last_activity', max((turn['timestamp'] for turn in turns), default=session['start_time']))
+    return session
+
+
+def import_sessions(dynamodb, path: str, sessions_table: str = 'sessions',
+                    conversations_table: str = 'conversations', max_retries: int = 8) -> tuple:
+    """
+    Backfill sessions and turns from a file written by `export_sessions`, with BatchWriteItem calls of 25 items.
+    Turns are written before their sessions, so a session never appears without its turns.
+    :return: Numbers of sessions and turns imported
+    :raise RuntimeError: If DynamoDB still leaves items unprocessed after the retries
+    """
+    def write(session_items, turn_items):
+        for table_name, items in ((conversations_table, turn_items), (sessions_table, session_items)):
+            unwritten = batch_put_items(dynamodb, table_name, items, max_retries)
+            if unwritten:
+                raise RuntimeError(f'{len(unwritten)} items left unprocessed in {table_name}, first: {unwritten[0]}')
+
+    imported_sessions, imported_turns = 0, 0
+    session_items, turn_items = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            # boto3 rejects floats, numbers must be Decimal
+            record = json.loads(line, parse_float=Decimal)
+            session_items.append(with_counters(record['session'], record['turns']))
+            turn_items.extend(record['turns'])
+            if len(session_items) == IMPORT_CHUNK_SESSIONS:
+                write(session_items, turn_items)
+                imported_sessions += len(session_items)
+                imported_turns += len(turn_items)
+                session_items, turn_items = [], []
+    write(session_items, turn_items)
+    return imported_sessions + len(session_items), imported_turns + len(turn_items)
+
+
+def archive_sessions(dynamodb, transcript_store, codec: str = 'gzip', delete_turns: bool = False,
+                     sessions_table: str = 'sessions', conversations_table: str = 'conversations',
+                     max_workers: int = 8) -> int:
+    """
+    Pack every closed session not archived yet into its transcript blob, as the session-end Lambda does for
+    sessions closed from now on, dropping the per-turn items with `delete_turns`.
+    :return: Number of sessions archived
+    """
+    sessions = dynamodb.Table(sessions_table)
+    conversations = dynamodb.Table(conversations_table)
+
+    def archive(session_id):
+        if transcript_store.chunks(session_id) is not None:
+            return False
+        turns = get_conversations_by_session_id(conversations, session_id)
+        if not turns:
+            return False
+        archive_turns(transcript_store, session_id, turns, codec, conversations if delete_turns else None)
+        return True
+
+    kwargs = {'FilterExpression': 'attribute_type(end_time, :number_type)',
+              'ExpressionAttributeValues': {':number_type': 'N'},
+              'ProjectionExpression': 'session_id'}
+    archived = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            response = sessions.scan(**kwargs)
+            archived += sum(executor.map(archive, [session['session_id'] for session in response['Items']]))
+            if 'LastEvaluatedKey' not in response:
+                return archived
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export sessions and their turns to JSON lines, backfill them, or '
+                                                 'pack closed sessions into compressed transcripts')
+    parser.add_argument('command', choices=['export', 'import', 'archive'])
+    parser.add_argument('path', nargs='?', help='JSON lines file, one session with its turns per line')
+    parser.add_argument('--sessions-table', default='sessions')
+    parser.add_argument('--conversations-table', default='conversations')
+    parser.add_argument('--transcript-store', default='none', choices=['none', 'dynamodb', 'local'],
+                        help='where archived sessions are kept, as TRANSCRIPT_STORE of the Lambda')
+    parser.add_argument('--transcript-table', default='transcripts')
+    parser.add_argument('--transcript-dir', help='directory of the local transcript store')
+    parser.add_argument('--codec', default='gzip', choices=['gzip', 'zstd'])
+    parser.add_argument('--delete-turns', action='store_true', help='drop per-turn items of archived sessions')
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource('dynamodb')
+    store = get_transcript_store(args.transcript_store, dynamodb.Table(args.transcript_table), args.transcript_dir)
+    if args.command == 'archive':
+        if store is None:
+            parser.error('archive needs --transcript-store')
+        count = archive_sessions(dynamodb, store, args.codec, args.delete_turns, args.sessions_table,
+                                 args.conversations_table)
+        logger.info(f'Archived {count} sessions')
+    elif args.path is None:
+        parser.error(f'{args.command} needs a path')
+    elif args.command == 'export':
+        count = export_sessions(dynamodb, args.path, args.sessions_table, args.conversations_table,
+                                transcript_store=store)
+        logger.info(f'Exported {count} sessions to {args.path}')
+    else:
+        num_sessions, num_turns = import_sessions(dynamodb, args.path, args.sessions_table, args.conversations_table)
+        logger.info(f'Imported {num_sessions} sessions and {num_turns} turns from {args.path}')
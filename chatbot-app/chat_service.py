@@ -0,0 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor
+from async_chat import AsyncOpenSearchClient
+from async_chat import fake_chat_core
+from async_chat import aws_chat_core
+from session_store import SessionNotFound
+from registry import config_section
+from prompt import MAX_PROMPT_TOKENS
+from llm import detect_task
+import contextlib
+import argparse
+import asyncio
+import logging
+import time
+import json
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def non_negative_int(payload: dict, name: str, default: int) -> int:
+    """
+    :return: The integer `payload[name]`, or `default` when it is absent
+    :raise HTTPError: 400 if it is not a non-negative integer
+    """
+    value = payload.get(name, default)
+    try:
+        if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+            raise ValueError
+        value = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, f'"{name}" must be a non-negative integer')
+    if value < 0:
+        raise HTTPError(400, f'"{name}" must be a non-negative integer')
+    return value
+
+
+class ChatService:
+    """
+    JSON-over-HTTP front end of an AsyncChatCore, with no state of its own so that any number of replicas can
+    share one session store:
+
+    - `POST /sessions` with an optional `{"user_id": ...}` starts a session: `{"session_id": ...}`. Its /past
+      turns only search conversations of that user.
+    - `POST /sessions/<id>/turns` with `{"query": ..., "max_turns": 10, "token_budget": 512}` answers one turn:
+      `{"session_id", "task_type", "response", "latency_ms"}`
+    - `DELETE /sessions/<id>` ends a session once its turns are stored: `{"end_time", "num_turns",
+      "conversation_duration"}`
+    - `GET /health` reports pending and failed background writes
+
+    Connections are kept alive between requests.
+    """
+
+    def __init__(self, core):
+        self.core = core
+
+    async def dispatch(self, method: str, path: str, payload: dict):
+        parts = [part for part in path.split('?', 1)[0].split('/') if part]
+        if parts == ['health']:
+            if method != 'GET':
+                raise HTTPError(405, f'{method} not allowed on /health')
+            return 200, {'status': 'ok',
+                         'pending_writes': len(self.core.pending_writes),
+                         'write_errors': len(self.core.write_errors)}
+        if parts == ['sessions']:
+            if method != 'POST':
+                raise HTTPError(405, f'{method} not allowed on /sessions')
+            user_id = payload.get('user_id')
+            if user_id is not None and not isinstance(user_id, str):
+                raise HTTPError(400, '"user_id" must be a string')
+            return 201, {'session_id': await self.core.create_session(user_id)}
+        if len(parts) == 2 and parts[0] == 'sessions':
+            if method != 'DELETE':
+                raise HTTPError(405, f'{method} not allowed on /sessions/<id>')
+            return 200, await self.core.end_session(parts[1])
+        if len(parts) == 3 and parts[0] == 'sessions' and parts[2] == 'turns':
+            if method != 'POST':
+                raise HTTPError(405, f'{method} not allowed on /sessions/<id>/turns')
+            query = payload.get('query')
+            if not isinstance(query, str) or not query.strip():
+                raise HTTPError(400, 'Body must carry a non-empty "query"')
+            max_turns = non_negative_int(payload, 'max_turns', 10)
+            token_budget = non_negative_int(payload, 'token_budget', MAX_PROMPT_TOKENS)
+            start = time.perf_counter()
+            response = await self.core.handle_turn(parts[1], query, max_turns=max_turns, token_budget=token_budget)
+            return 200, {'session_id': parts[1],
+                         'task_type': detect_task(query),
+                         'response': response,
+                         'latency_ms': (time.perf_counter() - start) * 1000}
+        raise HTTPError(404, f'No route for {path}')
+
+    async def handle(self, method: str, path: str, body: bytes):
+        try:
+            payload = json.loads(body) if body else {}
+            if not isinstance(payload, dict):
+                raise HTTPError(400, 'Body must be a JSON object')
+            return await self.dispatch(method, path, payload)
+        except json.JSONDecodeError as e:
+            return 400, {'error': f'Invalid JSON: {e}'}
+        except HTTPError as e:
+            return e.status, {'error': str(e)}
+        except SessionNotFound as e:
+            return 404, {'error': str(e)}
+        except Exception as e:
+            logger.exception(f'{method} {path} failed')
+            return 500, {'error': str(e)}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > MAX_BODY_BYTES:
+                    status, payload = 400, {'error': 'Body too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.handle(method, path, body)
+                    keep_alive = (headers.get('connection', '').lower() != 'close'
+                                  and version.upper() == 'HTTP/1.1')
+                data = json.dumps(payload).encode('utf-8')
+                writer.write(f'HTTP/1.1 {status} {REASONS.get(status, "")}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1'))
+                writer.write(data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080) -> asyncio.AbstractServer:
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+@contextlib.asynccontextmanager
+async def chat_core_from_args(args):
+    if args.backend == 'fake':
+        core = fake_chat_core(args.latency, args.store, args.write_buffer, args.embedding_batcher,
+                              args.ltm_prefetch)
+        try:
+            yield core
+        finally:
+            await core.drain()
+        return
+    opensearch_config = config_section('opensearch')
+    search = AsyncOpenSearchClient(opensearch_config['domain']['endpoint'],
+                                   opensearch_config['credentials']['username'],
+                                   opensearch_config['credentials']['password'],
+                                   pool_size=(opensearch_config.get('connection') or {}).get('pool_size', 10))
+    from write_buffer import write_buffer_from_config
+    turn_write_buffer = write_buffer_from_config(config_section('write_buffer'))
+    try:
+        async with aws_chat_core(search, write_buffer=turn_write_buffer) as core:
+            yield core
+    finally:
+        if turn_write_buffer is not None:
+            await asyncio.to_thread(turn_write_buffer.close)
+        await search.close()
+
+
+async def serve(args) -> None:
+    # Blocking clients (fakes, boto3 wrapped in Threaded) each hold a worker thread per call in flight
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.threads))
+    async with chat_core_from_args(args) as core:
+        server = await ChatService(core).start(args.host, args.port)
+        logger.info(f'Chat service listening on {args.host}:{server.sockets[0].getsockname()[1]} '
+                    f'(backend = {args.backend})')
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the chat engine over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--backend', default='fake', choices=['fake', 'aws'],
+                        help='local fakes, or SageMaker/DynamoDB via aioboto3 and OpenSearch via aiohttp')
+    parser.add_argument('--store', default='dynamodb', choices=['dynamodb', 'memory'],
+                        help='session store of the fake backend')
+    parser.add_argument('--write-buffer', action='store_true', help='batch turn writes to the fake tables')
+    parser.add_argument('--embedding-batcher', action='store_true', default=None,
+                        help='batch concurrent query embeddings into shared endpoint calls')
+    parser.add_argument('--ltm-prefetch', action='store_true', default=None,
+                        help='search long-term memory during STM turns for /past and /verified follow-ups')
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated per-call latency of the fakes')
+    parser.add_argument('--threads', type=int, default=64)
+    asyncio.run(serve(parser.parse_args()))
@@ -0,0 +1,167 @@
+import os
+
+# Clients are built for real (offline) to time their construction, then replaced by the fakes before any call
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import importlib.util
+import argparse
+import logging
+import asyncio
+import time
+import json
+import sys
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+TARGETS = ('app', 'core', 'lambda')
+LAMBDA_HANDLER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '05-lambda-handler.py')
+QUERIES = ('/verified what is court defamation?', '/verified what is libel?')
+
+
+class Phases:
+    """
+    Wall-clock milliseconds of consecutive phases of a cold start.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self._last = time.perf_counter()
+
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self.phases[name] = (now - self._last) * 1000
+        self._last = now
+
+    def skip(self) -> None:
+        self._last = time.perf_counter()
+
+
+def cold_start_app(phases: Phases) -> None:
+    """
+    The Streamlit app's modules, then /verified turns as app.py runs them.
+    """
+    # Everything app.py imports besides streamlit
+    import response_cache
+    import write_buffer
+    import retrieve
+    import registry
+    import prompt
+    import llm
+    import ddb
+    phases.mark('import')
+    registry.get_client('sagemaker-runtime')
+    registry.get_resource('dynamodb')
+    phases.mark('clients')
+
+    from fakes import FakeSageMakerRuntime, FakeOpenSearchClient, FakeDynamoDBTable, fake_embedding
+    sagemaker = FakeSageMakerRuntime(embedding_dimension=256)
+    search = FakeOpenSearchClient()
+    for i in range(10):
+        search.index('passages', str(i), {'passage': f'Passage {i} on defamation', 'doc_id': str(i),
+                                          'passage_id': str(i), 'embedding': fake_embedding(str(i), 256)})
+    registry.install_client('sagemaker-runtime', sagemaker)
+    registry.install('opensearch', search)
+    sessions = FakeDynamoDBTable('session_id')
+    conversations = FakeDynamoDBTable('session_id', 'timestamp')
+    session_id = ddb.create_session(sessions)
+    phases.skip()
+
+    for name, query in zip(('first_request', 'warm_request'), QUERIES):
+        ddb.get_recent_conversations(conversations, session_id, 10)
+        passages = retrieve.retrieve_top_matching_passages(query, 'passages')
+        completion = llm.summarize_passages_and_collate_answers(passages, query)
+        ddb.add_conversation_turn(conversations, session_id, query, completion, sessions)
+        phases.mark(name)
+
+
+def cold_start_core(phases: Phases) -> None:
+    """
+    The async chat core behind chat_service.py, then turns over its fakes.
+    """
+    from async_chat import fake_chat_core
+    phases.mark('import')
+
+    async def converse():
+        core = fake_chat_core(latency=0.0)
+        session_id = await core.create_session()
+        phases.skip()
+        for name, query in zip(('first_request', 'warm_request'), QUERIES):
+            await core.handle_turn(session_id, query)
+            phases.mark(name)
+        await core.drain()
+    asyncio.run(converse())
+
+
+def cold_start_lambda(phases: Phases) -> None:
+    """
+    The session-end Lambda module, then one batch of a single closed session per invocation.
+    """
+    os.environ.setdefault('OS_ENDPOINT', 'http://localhost:9200')
+    os.environ.setdefault('OS_INDEX_NAME', 'conversations')
+    os.environ.setdefault('OS_USERNAME', 'cold-start')
+    os.environ.setdefault('OS_PASSWORD', 'cold-start')
+    os.environ.setdefault('SAGEMAKER_TEXT_EMBED_ENDPOINT', 'text-embedding')
+    os.environ.setdefault('SAGEMAKER_TEXT_GEN_ENDPOINT', 'text-generation')
+    spec = importlib.util.spec_from_file_location('lambda_handler', LAMBDA_HANDLER_FILE)
+    handler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(handler)
+    phases.mark('import')
+    handler.get_sagemaker_runtime()
+    handler.get_dynamodb_resource()
+    phases.mark('clients')
+
+    from fakes import FakeSageMakerRuntime, FakeOpenSearchClient, FakeDynamoDBTable, FakeDynamoDBResource
+    conversations = FakeDynamoDBTable('session_id', 'timestamp')
+    dynamodb = FakeDynamoDBResource({'conversations': conversations})
+    handler.sagemaker_runtime = FakeSageMakerRuntime(embedding_dimension=256)
+    handler.search_client = FakeOpenSearchClient()
+    handler.get_dynamodb_resource = lambda: dynamodb
+    records = []
+    for i in range(2):
+        session_id = f'session-{i}'
+        for turn in range(4):
+            conversations.put_item(Item={'session_id': session_id, 'timestamp': 1700000000000 + turn,
+                                         'Me': f'question {turn} of {session_id}', 'AI': f'answer {turn}'})
+        records.append({'eventName': 'MODIFY',
+                        'dynamodb': {'SequenceNumber': str(i),
+                                     'OldImage': {'session_id': {'S': session_id}, 'end_time': {'NULL': True}},
+                                     'NewImage': {'session_id': {'S': session_id},
+                                                  'end_time': {'N': '1700000000000'}}}})
+    phases.skip()
+
+    for name, record in zip(('first_request', 'warm_request'), records):
+        response = handler.lambda_handler({'Records': [record]}, None)
+        if response['batchItemFailures']:
+            raise RuntimeError(f'lambda_handler reported failures: {response["batchItemFailures"]}')
+        phases.mark(name)
+
+
+def cold_start(target: str) -> dict:
+    """
+    Time, in this fresh process, importing the `target`'s modules, building its AWS clients (offline), and its
+    first request against the local fakes next to a warm one.
+    :return: Milliseconds per phase
+    """
+    phases = Phases()
+    logging.getLogger('log').setLevel(logging.WARNING)
+    {'app': cold_start_app, 'core': cold_start_core, 'lambda': cold_start_lambda}[target](phases)
+    return phases.phases
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure import time and first-request latency of a fresh process')
+    parser.add_argument('target', choices=TARGETS)
+    parser.add_argument('--json', action='store_true', help='print the phases as one JSON object on stdout')
+    args = parser.parse_args()
+
+    results = cold_start(args.target)
+    if args.json:
+        json.dump(results, sys.stdout)
+    else:
+        logging.getLogger('log').setLevel(logging.INFO)
+        for phase, ms in results.items():
+            logger.info(f'{args.target:<8} {phase:<14} {ms:9.2f} ms')
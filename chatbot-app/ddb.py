@@ -1,6 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
 from boto3.dynamodb.conditions import Key
+from collections import OrderedDict
+from tracing import payload_size
+from collections import deque
+from tracing import annotate
+from prompt import count_tokens
+from registry import config_section
+from registry import get_resource
+from tracing import traced
+import threading
+import argparse
 import logging
-import boto3
 import time
 import uuid
 
@@ -9,29 +20,215 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
                     datefmt='%Y-%m-%d %H:%M:%S')
 logger = logging.getLogger('log')
 
-client = boto3.resource('dynamodb')
+# Rolling short-term memory kept per session in this process, so a turn does not re-read the whole session
+HISTORY_BUFFER_TURNS = 100
+MAX_BUFFERED_SESSIONS = 1024
 
+history_buffers = OrderedDict()
+# Sessions whose buffer holds every turn; the others were loaded with only as many turns as the prompt asked for
+complete_history_buffers = set()
+history_buffers_lock = threading.Lock()
 
-def add_conversation_turn(table, session_id, user, bot):
-    timestamp = int(time.time() * 1000)
-    table.put_item(
-        Item={
-            'session_id': session_id,
-            'timestamp': timestamp,
-            'Me': user,
-            'AI': bot
+# Per-session counters kept current by every turn, so closing a session never has to read its turns
+TURN_COUNTERS_UPDATE = 'ADD num_turns :turns, user_tokens :user_tokens, bot_tokens :bot_tokens ' \
+                       'SET last_activity = :timestamp'
+END_SESSION_UPDATE = 'SET end_time = :end_time, conversation_duration = :end_time - start_time'
+# Turns only count into an open session: a closed one must not emit another MODIFY for the session-end Lambda
+TURN_COUNTERS_CONDITION = 'attribute_exists(session_id) AND attribute_type(end_time, :null_type)'
+# Only an open session can be ended, which also makes ending idempotent
+END_SESSION_CONDITION = 'attribute_exists(session_id) AND attribute_type(end_time, :null_type)'
+
+
+def buffer_session(session_id, turns=(), complete=True):
+    """
+    Buffer the session's latest `turns`; `complete` when they are all of its turns.
+    """
+    with history_buffers_lock:
+        history_buffers[session_id] = deque(turns, maxlen=HISTORY_BUFFER_TURNS)
+        history_buffers.move_to_end(session_id)
+        if complete:
+            complete_history_buffers.add(session_id)
+        else:
+            complete_history_buffers.discard(session_id)
+        while len(history_buffers) > MAX_BUFFERED_SESSIONS:
+            evicted, _ = history_buffers.popitem(last=False)
+            complete_history_buffers.discard(evicted)
+
+
+def drop_session_buffer(session_id):
+    with history_buffers_lock:
+        history_buffers.pop(session_id, None)
+        complete_history_buffers.discard(session_id)
+
+
+def buffered_turns(session_id, num_turns):
+    """
+    :return: The session's last `num_turns` turns in chronological order, or None when the buffer cannot serve
+             them (never loaded, evicted, or loaded with fewer turns than now asked for)
+    """
+    with history_buffers_lock:
+        buffer = history_buffers.get(session_id)
+        if buffer is None or (len(buffer) < num_turns and session_id not in complete_history_buffers):
+            return None
+        history_buffers.move_to_end(session_id)
+        return list(buffer)[len(buffer) - min(num_turns, len(buffer)):]
+
+
+def turns_counters_update(turns: list) -> dict:
+    """
+    update_item arguments that count `turns`, all of one session, into the session's counters.
+    """
+    return {
+        'Key': {'session_id': turns[0]['session_id']},
+        'UpdateExpression': TURN_COUNTERS_UPDATE,
+        'ConditionExpression': TURN_COUNTERS_CONDITION,
+        'ExpressionAttributeValues': {
+            ':null_type': 'NULL',
+            ':turns': len(turns),
+            ':user_tokens': sum(count_tokens(turn['Me']) for turn in turns),
+            ':bot_tokens': sum(count_tokens(turn['AI']) for turn in turns),
+            ':timestamp': max(turn['timestamp'] for turn in turns)
         }
-    )
+    }
 
 
+def turn_counters_update(turn: dict) -> dict:
+    """
+    update_item arguments that count `turn` into its session's counters.
+    """
+    return turns_counters_update([turn])
+
+
+def end_session_update(session_id: str, end_time: int, last_activity: int = None) -> dict:
+    """
+    update_item arguments that close an open session at `end_time` and return its final attributes. With
+    `last_activity`, the session is only closed if no turn has been counted since.
+    """
+    update = {
+        'Key': {'session_id': session_id},
+        'UpdateExpression': END_SESSION_UPDATE,
+        'ConditionExpression': END_SESSION_CONDITION,
+        'ExpressionAttributeValues': {':end_time': end_time, ':null_type': 'NULL'},
+        'ReturnValues': 'ALL_NEW'
+    }
+    if last_activity is not None:
+        update['ConditionExpression'] += ' AND last_activity = :last_activity'
+        update['ExpressionAttributeValues'][':last_activity'] = last_activity
+    return update
+
+
+def is_conditional_check_failure(error: ClientError) -> bool:
+    return error.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+@traced('ddb.add_conversation_turn')
+def add_conversation_turn(table, session_id, user, bot, sessions_table=None, write_buffer=None):
+    """
+    Store one turn and, given the sessions table, count it into the session's num_turns, user_tokens,
+    bot_tokens and last_activity with one atomic ADD/SET update. Given a `write_buffer.TurnWriteBuffer`, the turn
+    is queued instead and both writes happen when the buffer is flushed.
+    """
+    timestamp = int(time.time() * 1000)
+    item = {
+        'session_id': session_id,
+        'timestamp': timestamp,
+        'Me': user,
+        'AI': bot
+    }
+    annotate(request_bytes=payload_size(item), buffered=write_buffer is not None)
+    if write_buffer is not None:
+        write_buffer.add(item)
+    else:
+        table.put_item(Item=item)
+        if sessions_table is not None:
+            try:
+                sessions_table.update_item(**turn_counters_update(item))
+            except ClientError as e:
+                if not is_conditional_check_failure(e):
+                    raise
+                logger.warning(f'Turn stored for unknown or closed session {session_id}, its counters were not '
+                               f'updated')
+    with history_buffers_lock:
+        # Only extend a warm buffer; a cold one is loaded from the table (including this turn) on next read
+        if session_id in history_buffers:
+            history_buffers[session_id].append(item)
+
+
+@traced('ddb.get_conversations_by_session_id')
 def get_conversations_by_session_id(table, session_id, descending=True):
-    response = table.query(
-        KeyConditionExpression=Key('session_id').eq(session_id),
-        ScanIndexForward=descending
-    )
-    return response['Items']
+    kwargs = {
+        'KeyConditionExpression': Key('session_id').eq(session_id),
+        'ScanIndexForward': descending
+    }
+    items = []
+    while True:
+        response = table.query(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            annotate(items=len(items))
+            return items
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
 
+@traced('ddb.get_latest_conversations')
+def get_latest_conversations(table, session_id, num_turns):
+    """
+    Fetch only the last `num_turns` turns of a session with a descending, limited query.
+    :return: Turns in chronological order
+    """
+    kwargs = {
+        'KeyConditionExpression': Key('session_id').eq(session_id),
+        'ScanIndexForward': False,
+        'Limit': num_turns
+    }
+    items = []
+    while len(items) < num_turns:
+        response = table.query(**kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        kwargs['Limit'] = num_turns - len(items)
+    items.reverse()
+    annotate(items=len(items))
+    return items
 
+
+def merge_queued_turns(turns: list, queued: list) -> list:
+    """
+    Turns read from the table followed by those still queued in a write buffer, without duplicates, in
+    chronological order and at most HISTORY_BUFFER_TURNS of them.
+    """
+    by_timestamp = {turn['timestamp']: turn for turn in turns}
+    by_timestamp.update((turn['timestamp'], turn) for turn in queued)
+    return [by_timestamp[timestamp] for timestamp in sorted(by_timestamp)][-HISTORY_BUFFER_TURNS:]
+
+
+@traced('ddb.get_recent_conversations')
+def get_recent_conversations(table, session_id, num_turns, write_buffer=None):
+    """
+    Serve the last `num_turns` turns from the session's rolling buffer, loading it from DynamoDB on a cold start.
+    Turns still queued in `write_buffer` are not in the table yet, and are merged into what a cold start loads.
+    :return: Turns in chronological order
+    """
+    num_turns = min(num_turns, HISTORY_BUFFER_TURNS)
+    if num_turns <= 0:
+        return []
+    turns = buffered_turns(session_id, num_turns)
+    if turns is not None:
+        annotate(buffered=True)
+        return turns
+    # Only what this prompt needs; a later request for more turns loads again
+    turns = get_latest_conversations(table, session_id, num_turns)
+    complete = len(turns) < num_turns
+    if write_buffer is not None:
+        turns = merge_queued_turns(turns, write_buffer.queued_turns(session_id))
+    annotate(buffered=False)
+    buffer_session(session_id, turns, complete)
+    return turns[len(turns) - min(num_turns, len(turns)):]
+
+
+@traced('ddb.delete_conversation')
 def delete_conversation(table, session_id, timestamp):
     table.delete_item(
         Key={
@@ -39,61 +236,149 @@ def delete_conversation(table, session_id, timestamp):
             'timestamp': timestamp
         }
     )
+    drop_session_buffer(session_id)
+
 
+def new_session_item(session_id: str, start_time: int, user_id: str = None) -> dict:
+    """
+    Item of a session just opened. `user_id`, when known, is indexed with the session's summary so /past only
+    searches the conversations of the same user.
+    """
+    item = {
+        'session_id': session_id,
+        'start_time': start_time,
+        'end_time': None,
+        'num_turns': 0,
+        'user_tokens': 0,
+        'bot_tokens': 0,
+        'last_activity': start_time
+    }
+    if user_id is not None:
+        item['user_id'] = user_id
+    return item
 
-def create_session(table):
+
+@traced('ddb.create_session')
+def create_session(table, user_id=None):
     session_id = str(uuid.uuid4())
-    start_time = int(time.time() * 1000)
-    table.put_item(
-        Item={
-            'session_id': session_id,
-            'start_time': start_time,
-            'end_time': None,
-            'num_turns': 0
-        }
-    )
+    table.put_item(Item=new_session_item(session_id, int(time.time() * 1000), user_id))
+    # A brand-new session has no history, so its buffer is complete from the start
+    buffer_session(session_id)
     return session_id
 
 
-def end_session(table, session_id):
-    end_time = int(time.time() * 1000)
-    start_time_response = table.get_item(
-        Key={'session_id': session_id}
-    )
-    start_time = start_time_response['Item']['start_time']
-    num_turns = len(get_conversations_by_session_id(table, session_id))
-    conversation_duration = end_time - start_time  # Compute duration in milliseconds
-
-    table.update_item(
-        Key={'session_id': session_id},
-        UpdateExpression="SET end_time = :end_time, num_turns = :num_turns, conversation_duration = "
-                         ":conversation_duration",
-        ExpressionAttributeValues={
-            ':end_time': end_time,
-            ':num_turns': num_turns,
-            ':conversation_duration': conversation_duration
-        }
-    )
+@traced('ddb.end_session')
+def end_session(table, session_id, end_time=None, last_activity=None, write_buffer=None):
+    """
+    Close a session with a single conditional update, its turn count and token totals having been maintained by
+    add_conversation_turn. Ending a session that is already closed (or unknown), or that has seen a turn after
+    `last_activity` when given, is a no-op. Turns queued in `write_buffer` are flushed first, so the stream record
+    of the close follows every turn of the session.
+    :return: The closed session's attributes, or None if it was not closed
+    """
+    if write_buffer is not None:
+        write_buffer.flush()
+    end_time = end_time or int(time.time() * 1000)
+    try:
+        response = table.update_item(**end_session_update(session_id, end_time, last_activity))
+    except ClientError as e:
+        if not is_conditional_check_failure(e):
+            raise
+        logger.warning(f'Session {session_id} is not open or no longer idle, nothing to end')
+        return None
+    finally:
+        drop_session_buffer(session_id)
+    return response['Attributes']
+
+
+def write_buffer_delay(buffer_config: dict) -> float:
+    """
+    :return: Seconds a turn queued in a TurnWriteBuffer configured by `buffer_config` may wait before it is counted
+             into its session: one flush interval, plus every resend of a throttled batch. 0 when buffering is
+             disabled.
+    """
+    buffer_config = buffer_config or {}
+    if not buffer_config.get('enabled'):
+        return 0.0
+    max_retries = buffer_config.get('max_retries', 8)
+    return buffer_config.get('flush_interval', 0.2) + buffer_config.get('backoff_factor', 0.05) * (2 ** max_retries - 1)
+
+
+@traced('ddb.end_idle_sessions')
+def end_idle_sessions(table, idle_seconds, index_name=None, max_workers=8, grace_seconds=None):
+    """
+    Close, in bulk, every open session without activity for `idle_seconds`, each at its last activity time.
+    Open sessions are found with a filtered scan of the table, or of `index_name` when a sparse index over open
+    sessions exists. A session that sees a new turn between the scan and the close is left open.
+
+    Turns queued in the write buffers of running processes are only counted once flushed, so the close waits
+    `grace_seconds` after the scan (by default the `write_buffer` delay of the config, 0 when buffering is off).
+    A turn queued before the scan has then moved its session's `last_activity` and keeps the session open.
+    :return: Ids of the sessions that were closed
+    """
+    if grace_seconds is None:
+        grace_seconds = write_buffer_delay(config_section('write_buffer'))
+    cutoff = int((time.time() - idle_seconds) * 1000)
+    kwargs = {
+        'FilterExpression': 'attribute_type(end_time, :null_type) AND last_activity < :cutoff',
+        'ExpressionAttributeValues': {':null_type': 'NULL', ':cutoff': cutoff},
+        'ProjectionExpression': 'session_id, last_activity'
+    }
+    if index_name:
+        kwargs['IndexName'] = index_name
+    idle_sessions = []
+    while True:
+        response = table.scan(**kwargs)
+        idle_sessions.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    if idle_sessions and grace_seconds > 0:
+        time.sleep(grace_seconds)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        closed = list(executor.map(lambda session: end_session(table, session['session_id'],
+                                                               end_time=int(session['last_activity']),
+                                                               last_activity=session['last_activity']),
+                                   idle_sessions))
+    annotate(items=len(idle_sessions))
+    return [session['session_id'] for session, attributes in zip(idle_sessions, closed) if attributes is not None]
 
 
 if __name__ == '__main__':
-    # Start a new session
-    table_name = 'sessions'
-
-    # Get the table instance
-    table_ = client.Table(table_name)
-    session_id_ = create_session(table_)
-
-    # Add conversation turns
-    table_name = 'conversations'
-    table_ = client.Table(table_name)
-    add_conversation_turn(table_, session_id_, 'hi', 'hello')
-    add_conversation_turn(table_, session_id_, 'how are you?', 'i am fine')
-    add_conversation_turn(table_, session_id_, 'what is the definition of court defamation?',
-                          'Court defamation is a type of '
-                          'civil wrong.')
-
-    # End the session
-    table_name = 'sessions'
-    table_ = client.Table(table_name)
-    end_session(table_, session_id_)
+    parser = argparse.ArgumentParser(description='Run the session demo, or close idle sessions in bulk')
+    parser.add_argument('--end-idle', type=int, metavar='SECONDS', help='close sessions idle for this long')
+    parser.add_argument('--index-name', help='sparse index over open sessions to scan instead of the table')
+    parser.add_argument('--grace', type=float, metavar='SECONDS',
+                        help='wait between the scan and the close for buffered turns to land (default: the '
+                             'write_buffer delay of the config)')
+    args = parser.parse_args()
+
+    client = get_resource('dynamodb')
+    if args.end_idle is not None:
+        closed_sessions = end_idle_sessions(client.Table('sessions'), args.end_idle, args.index_name,
+                                            grace_seconds=args.grace)
+        logger.info(f'Closed {len(closed_sessions)} idle sessions')
+    else:
+        # Start a new session
+        table_name = 'sessions'
+
+        # Get the table instance
+        table_ = client.Table(table_name)
+        session_id_ = create_session(table_)
+
+        # Add conversation turns, queued and written together in one BatchWriteItem call
+        from write_buffer import TurnWriteBuffer
+        write_buffer_ = TurnWriteBuffer(client)
+        table_name = 'conversations'
+        table_ = client.Table(table_name)
+        sessions_table_ = client.Table('sessions')
+        add_conversation_turn(table_, session_id_, 'hi', 'hello', sessions_table_, write_buffer_)
+        add_conversation_turn(table_, session_id_, 'how are you?', 'i am fine', sessions_table_, write_buffer_)
+        add_conversation_turn(table_, session_id_, 'what is the definition of court defamation?',
+                              'Court defamation is a type of '
+                              'civil wrong.', sessions_table_, write_buffer_)
+
+        # End the session, which flushes the queued turns first
+        table_name = 'sessions'
+        table_ = client.Table(table_name)
+        end_session(table_, session_id_, write_buffer=write_buffer_)
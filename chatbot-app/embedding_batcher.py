@@ -0,0 +1,301 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future
+from collections import deque
+import concurrent.futures
+import threading
+import logging
+import asyncio
+import time
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+class EmbeddingRequest:
+    __slots__ = ('text', 'deadline', 'future')
+
+    def __init__(self, text: str, deadline: float, future):
+        self.text = text
+        self.deadline = deadline
+        self.future = future
+
+
+class BatchStats:
+    """
+    Counters shared by both batchers, so the batch sizes the endpoint actually sees can be checked under load.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.batches = 0
+        self.texts = 0
+        self.expired = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return {'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': self.texts / self.batches if self.batches else 0.0,
+                'expired': self.expired,
+                'failed': self.failed}
+
+
+def live_requests(batch: list, now: float, stats: BatchStats) -> list:
+    """
+    Drop requests whose caller gave up (cancelled) and fail those past their deadline, so no endpoint capacity
+    is spent on vectors nobody is waiting for. Both count as expired.
+    """
+    live = []
+    for request in batch:
+        if request.future.cancelled():
+            stats.expired += 1
+            continue
+        if request.deadline <= now:
+            stats.expired += 1
+            request.future.set_exception(TimeoutError('Embedding request expired before it was sent'))
+            continue
+        live.append(request)
+    return live
+
+
+def batch_texts(batch: list) -> list:
+    """
+    Distinct texts of a batch in arrival order; concurrent requests for the same text share one vector.
+    """
+    return list(dict.fromkeys(request.text for request in batch))
+
+
+def fan_out(batch: list, texts: list, vectors: list) -> None:
+    if len(vectors) != len(texts):
+        raise ValueError(f'Endpoint returned {len(vectors)} embeddings for {len(texts)} texts')
+    by_text = dict(zip(texts, vectors))
+    for request in batch:
+        if not request.future.done():
+            request.future.set_result(by_text[request.text])
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching front of a text embedding endpoint for threaded callers (Streamlit sessions, the Lambda's
+    workers). Requests that arrive within `max_wait` seconds of the first one waiting, up to `max_batch_size`,
+    go out as one `invoke_batch(texts)` call, and each caller gets its own vector back.
+
+    - Backpressure: at most `max_pending` requests wait to be batched and `max_in_flight` batches are
+      outstanding. Beyond that, `embed` blocks the caller, up to its deadline.
+    - Deadlines: every request has `timeout` seconds, from submission to its vector. A request that expires
+      before its batch is sent is left out of the batch.
+    """
+
+    def __init__(self, invoke_batch, max_batch_size: int = 16, max_wait: float = 0.005, max_pending: int = 256,
+                 max_in_flight: int = 4, timeout: float = 10.0):
+        self.invoke_batch = invoke_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.stats = BatchStats()
+        self._pending = deque()
+        self._pending_changed = threading.Condition()
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._senders = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='embedding-batch')
+        self._thread = None
+        self._closed = False
+
+    def submit(self, text: str, timeout: float = None) -> Future:
+        """
+        Queue `text`, waiting for room while the queue is full.
+        :return: Future of its embedding
+        :raise TimeoutError: If the queue stays full past the request's deadline
+        """
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        request = EmbeddingRequest(text, deadline, Future())
+        with self._pending_changed:
+            if self._closed:
+                raise RuntimeError('Embedding batcher is closed')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='embedding-batcher', daemon=True)
+                self._thread.start()
+            while len(self._pending) >= self.max_pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f'Embedding queue stayed full ({self.max_pending} requests)')
+                self._pending_changed.wait(remaining)
+            self._pending.append(request)
+            self.stats.requests += 1
+            self._pending_changed.notify_all()
+        return request.future
+
+    def embed(self, text: str, timeout: float = None) -> list:
+        """
+        :return: Embedding of `text`, computed in a batch with whatever other requests arrive meanwhile
+        :raise TimeoutError: If it is not ready within `timeout` seconds (default `self.timeout`)
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        future = self.submit(text, timeout)
+        try:
+            return future.result(timeout=max(0.0, start + timeout - time.monotonic()))
+        except concurrent.futures.TimeoutError:
+            # Not sent yet: dropped from its batch. Already sent: the vector is discarded on arrival.
+            future.cancel()
+            raise TimeoutError(f'No embedding within {timeout} seconds')
+
+    def _next_batch(self) -> list:
+        """
+        :return: The next batch to send, or None once the batcher is closed and nothing is pending
+        """
+        with self._pending_changed:
+            while not self._pending:
+                if self._closed:
+                    return None
+                self._pending_changed.wait()
+            # The oldest request waits at most max_wait for the batch to fill
+            flush_at = time.monotonic() + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._pending_changed.wait(remaining)
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+            # Room for callers blocked on a full queue
+            self._pending_changed.notify_all()
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            # With every sender busy the queue fills up, which in turn holds back new callers
+            self._in_flight.acquire()
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch: list) -> None:
+        try:
+            batch = live_requests(batch, time.monotonic(), self.stats)
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                return
+            texts = batch_texts(batch)
+            self.stats.batches += 1
+            self.stats.texts += len(texts)
+            fan_out(batch, texts, self.invoke_batch(texts))
+        except Exception as e:
+            self.stats.failed += 1
+            logger.error(f'Batched embedding of {len(batch)} requests failed: {e}')
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self._in_flight.release()
+
+    def close(self) -> None:
+        """
+        Send what is still pending, wait for the batches in flight and stop the batcher's threads.
+        """
+        with self._pending_changed:
+            self._closed = True
+            self._pending_changed.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self._senders.shutdown()
+
+
+class AsyncEmbeddingBatcher:
+    """
+    asyncio counterpart of EmbeddingBatcher for the async chat core, batching the `embed` calls of concurrent
+    coroutines into `await invoke_batch(texts)`. Its collector task only runs while requests are waiting, so
+    there is nothing to shut down. It must be used from a single event loop.
+    """
+
+    def __init__(self, invoke_batch, max_batch_size: int = 16, max_wait: float = 0.005, max_pending: int = 256,
+                 max_in_flight: int = 4, timeout: float = 10.0):
+        self.invoke_batch = invoke_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.stats = BatchStats()
+        self._queue = None
+        self._in_flight = None
+        self._collector = None
+        self._senders = set()
+
+    async def embed(self, text: str, timeout: float = None) -> list:
+        """
+        :return: Embedding of `text`, computed in a batch with whatever other requests arrive meanwhile
+        :raise TimeoutError: If the queue stays full, or no vector arrives, within `timeout` seconds
+        """
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = loop.time() + timeout
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_pending)
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        request = EmbeddingRequest(text, deadline, loop.create_future())
+        try:
+            await asyncio.wait_for(self._queue.put(request), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'Embedding queue stayed full ({self.max_pending} requests)')
+        self.stats.requests += 1
+        if self._collector is None or self._collector.done():
+            self._collector = asyncio.ensure_future(self._collect())
+        try:
+            # Cancels the future on timeout, which drops the request from its batch if not sent yet
+            return await asyncio.wait_for(request.future, max(0.0, deadline - loop.time()))
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'No embedding within {timeout} seconds')
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self._queue.empty():
+            batch = [self._queue.get_nowait()]
+            flush_at = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = flush_at - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._in_flight.acquire()
+            sender = asyncio.ensure_future(self._send(batch))
+            self._senders.add(sender)
+            sender.add_done_callback(self._senders.discard)
+
+    async def _send(self, batch: list) -> None:
+        try:
+            batch = live_requests(batch, asyncio.get_running_loop().time(), self.stats)
+            if not batch:
+                return
+            texts = batch_texts(batch)
+            self.stats.batches += 1
+            self.stats.texts += len(texts)
+            fan_out(batch, texts, await self.invoke_batch(texts))
+        except Exception as e:
+            self.stats.failed += 1
+            logger.error(f'Batched embedding of {len(batch)} requests failed: {e}')
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self._in_flight.release()
+
+
+def batcher_settings(batcher_config: dict) -> dict:
+    """
+    :return: Keyword arguments of either batcher from the `embedding_batcher` config section, or None when
+             batching is disabled
+    """
+    batcher_config = batcher_config or {}
+    if not batcher_config.get('enabled'):
+        return None
+    return {'max_batch_size': batcher_config.get('max_batch_size', 16),
+            'max_wait': batcher_config.get('max_wait_ms', 5) / 1000,
+            'max_pending': batcher_config.get('max_pending', 256),
+            'max_in_flight': batcher_config.get('max_in_flight', 4),
+            'timeout': batcher_config.get('timeout', 10)}
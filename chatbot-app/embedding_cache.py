@@ -0,0 +1,145 @@
+from collections import OrderedDict
+from array import array
+import threading
+import hashlib
+import logging
+import os
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+FLOAT32_BYTES = 4
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapse whitespace so that trivially different spellings of the same query share a cache entry.
+    """
+    return ' '.join(text.split())
+
+
+def content_hash(text: str, namespace: str = '') -> str:
+    """
+    Hash the normalized text together with a namespace (e.g. the embedding endpoint name) so that
+    vectors from different models never collide.
+    """
+    digest = hashlib.sha256()
+    digest.update(namespace.encode('utf-8'))
+    digest.update(b'\x00')
+    digest.update(normalize_text(text).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Content-hashed embedding cache: an in-process LRU bounded by the bytes held in float32 vectors,
+    backed by an optional on-disk tier that stores each vector as a raw float32 file.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_dir: str = None, namespace: str = ''):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.namespace = namespace
+        self.current_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, key[:2], f'{key}.f32')
+
+    def _read_disk(self, key: str):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        vector = array('f')
+        with open(path, 'rb') as f:
+            vector.frombytes(f.read())
+        return vector
+
+    def _write_disk(self, key: str, vector: array) -> None:
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(vector.tobytes())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f'Failed to persist embedding {key}: {e}')
+
+    def _put_memory(self, key: str, vector: array) -> None:
+        size = len(vector) * FLOAT32_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = vector
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted) * FLOAT32_BYTES
+
+    def get(self, text: str):
+        key = content_hash(text, self.namespace)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return vector.tolist()
+        vector = self._read_disk(key)
+        if vector is not None:
+            self._put_memory(key, vector)
+            with self._lock:
+                self.disk_hits += 1
+            return vector.tolist()
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, text: str, embedding: list) -> None:
+        key = content_hash(text, self.namespace)
+        vector = array('f', embedding)
+        self._put_memory(key, vector)
+        self._write_disk(key, vector)
+
+    def get_or_compute(self, text: str, compute) -> list:
+        """
+        Return the cached embedding for `text`, calling `compute(text)` and caching its result on a miss.
+        """
+        embedding = self.get(text)
+        if embedding is None:
+            embedding = compute(text)
+            self.put(text, embedding)
+        return embedding
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self.current_bytes
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
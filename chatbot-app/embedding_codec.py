@@ -0,0 +1,137 @@
+import argparse
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+PROJECTIONS = ('none', 'truncate', 'pca')
+DTYPES = ('float32', 'float16', 'int8')
+BYTES_PER_VALUE = {'float32': 4, 'float16': 2, 'int8': 1}
+
+
+class EmbeddingCodec:
+    """
+    Shrinks embeddings before they are stored or searched: an optional projection (Matryoshka-style truncation
+    to the first `dimension` values, or a PCA fitted offline with `fit_pca`) followed by fp16 or int8
+    quantization. The same codec must be applied at write time (Lambda) and at query time (retrieve.py),
+    and the index mapping must match `knn_vector_mapping()`. fp16 only saves index memory (faiss SQ): the
+    vectors are still sent to OpenSearch as JSON floats, so request payloads keep their size.
+    """
+
+    def __init__(self, projection: str = 'none', dimension: int = None, pca_file: str = None,
+                 dtype: str = 'float32', int8_scale: float = None):
+        if projection not in PROJECTIONS:
+            raise ValueError(f'Unsupported projection: {projection}')
+        if dtype not in DTYPES:
+            raise ValueError(f'Unsupported dtype: {dtype}')
+        if (projection != 'none' or dtype != 'float32') and np is None:
+            raise ImportError('EmbeddingCodec requires numpy for projection or quantization')
+        self.projection = projection
+        self.dtype = dtype
+        self.mean = None
+        self.components = None
+        self.int8_scale = int8_scale
+        if projection == 'pca':
+            pca = np.load(pca_file)
+            self.mean = pca['mean']
+            self.components = pca['components']
+            dimension = len(self.components)
+            if self.int8_scale is None:
+                self.int8_scale = float(pca['int8_scale'])
+        if projection == 'truncate' and not dimension:
+            raise ValueError('Truncation needs a target dimension')
+        if dtype == 'int8' and not self.int8_scale:
+            raise ValueError('int8 quantization needs int8_scale (fit_pca computes one)')
+        self.dimension = dimension
+
+    @property
+    def is_identity(self) -> bool:
+        return self.projection == 'none' and self.dtype == 'float32'
+
+    def project(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.projection == 'truncate':
+            vectors = vectors[..., :self.dimension]
+            # Renormalize so that truncated vectors keep comparable magnitudes
+            norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+        elif self.projection == 'pca':
+            vectors = (vectors - self.mean) @ self.components.T
+        return vectors
+
+    def quantize(self, vectors):
+        if self.dtype == 'float16':
+            return vectors.astype(np.float16)
+        if self.dtype == 'int8':
+            return np.clip(np.rint(vectors * self.int8_scale), -128, 127).astype(np.int8)
+        return vectors.astype(np.float32)
+
+    def encode_array(self, vectors):
+        return self.quantize(self.project(vectors))
+
+    def encode(self, embedding: list) -> list:
+        """
+        Encode one embedding into the JSON-ready list stored in or sent to the index.
+        """
+        if self.is_identity:
+            return embedding
+        return self.encode_array(embedding).tolist()
+
+    def bytes_per_vector(self, input_dimension: int = 4096) -> int:
+        return (self.dimension or input_dimension) * BYTES_PER_VALUE[self.dtype]
+
+    def knn_vector_mapping(self, input_dimension: int = 4096) -> dict:
+        """
+        Mapping of the `embedding` field for an OpenSearch index holding vectors produced by this codec.
+        """
+        mapping = {'type': 'knn_vector', 'dimension': self.dimension or input_dimension}
+        if self.dtype == 'int8':
+            mapping['data_type'] = 'byte'
+            mapping['method'] = {'name': 'hnsw', 'engine': 'lucene', 'space_type': 'l2'}
+        elif self.dtype == 'float16':
+            mapping['method'] = {'name': 'hnsw', 'engine': 'faiss', 'space_type': 'l2',
+                                 'parameters': {'encoder': {'name': 'sq', 'parameters': {'type': 'fp16'}}}}
+        return mapping
+
+
+def codec_from_config(codec_config: dict) -> EmbeddingCodec:
+    codec_config = codec_config or {}
+    return EmbeddingCodec(projection=codec_config.get('projection') or 'none',
+                          dimension=codec_config.get('dimension'),
+                          pca_file=codec_config.get('pca_file'),
+                          dtype=codec_config.get('dtype') or 'float32',
+                          int8_scale=codec_config.get('int8_scale'))
+
+
+def fit_pca(embeddings, dimension: int, clip_percentile: float = 99.9) -> dict:
+    """
+    Fit a PCA projection to `dimension` components, plus the int8 scale that maps the `clip_percentile`
+    of absolute projected values onto 127.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    mean = embeddings.mean(axis=0)
+    _, _, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+    components = vt[:dimension]
+    projected = (embeddings - mean) @ components.T
+    int8_scale = 127 / max(float(np.percentile(np.abs(projected), clip_percentile)), 1e-12)
+    return {'mean': mean, 'components': components, 'int8_scale': np.float32(int8_scale)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit a PCA projection for EmbeddingCodec')
+    parser.add_argument('embeddings', help='.npy file of float32 embeddings, one row per document')
+    parser.add_argument('--dimension', type=int, default=512)
+    parser.add_argument('--out', default='pca.npz')
+    args = parser.parse_args()
+
+    pca_ = fit_pca(np.load(args.embeddings), args.dimension)
+    np.savez(args.out, **pca_)
+    logger.info(f'Saved {args.dimension}-component PCA to {args.out} (int8_scale = {float(pca_["int8_scale"]):.3f})')
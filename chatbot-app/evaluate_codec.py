@@ -0,0 +1,94 @@
+from embedding_codec import EmbeddingCodec
+from embedding_codec import fit_pca
+import numpy as np
+import tempfile
+import argparse
+import logging
+import json
+import os
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+def exact_top_k(documents, queries, k: int):
+    """
+    Ground-truth neighbours by L2 distance, the space the conversations index uses.
+    """
+    distances = (np.einsum('ij,ij->i', queries, queries)[:, None] - 2 * queries @ documents.T
+                 + np.einsum('ij,ij->i', documents, documents)[None, :])
+    k = min(k, len(documents))
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    return top
+
+
+def recall_at_k(codec: EmbeddingCodec, documents, queries, truth, k: int) -> float:
+    encoded_documents = codec.encode_array(documents).astype(np.float32)
+    encoded_queries = codec.encode_array(queries).astype(np.float32)
+    found = exact_top_k(encoded_documents, encoded_queries, k)
+    hits = sum(len(set(row_truth) & set(row_found)) for row_truth, row_found in zip(truth, found))
+    return hits / truth.size
+
+
+def payload_bytes(codec: EmbeddingCodec, documents) -> float:
+    sample = documents[:min(len(documents), 100)]
+    return np.mean([len(json.dumps(codec.encode(vector.tolist()))) for vector in sample])
+
+
+def evaluate(documents, queries, dimensions: list, dtypes: list, projections: list, k: int) -> list:
+    truth = exact_top_k(documents, queries, k)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for projection in projections:
+            for dimension in (dimensions if projection != 'none' else [documents.shape[1]]):
+                pca_file = None
+                if projection == 'pca':
+                    pca_file = os.path.join(directory, f'pca-{dimension}.npz')
+                    np.savez(pca_file, **fit_pca(documents, dimension))
+                for dtype in dtypes:
+                    int8_scale = None
+                    if dtype == 'int8' and projection != 'pca':
+                        projected = EmbeddingCodec(projection=projection, dimension=dimension).project(documents)
+                        int8_scale = 127 / float(np.percentile(np.abs(projected), 99.9))
+                    codec = EmbeddingCodec(projection=projection, dimension=dimension, pca_file=pca_file,
+                                           dtype=dtype, int8_scale=int8_scale)
+                    results.append({'projection': projection,
+                                    'dimension': codec.dimension or documents.shape[1],
+                                    'dtype': dtype,
+                                    'int8_scale': int8_scale if int8_scale else codec.int8_scale,
+                                    f'recall@{k}': recall_at_k(codec, documents, queries, truth, k),
+                                    'index_bytes_per_vector': codec.bytes_per_vector(documents.shape[1]),
+                                    'json_bytes_per_vector': payload_bytes(codec, documents)})
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure recall versus size of embedding codecs')
+    parser.add_argument('embeddings', help='.npy file of float32 embeddings, one row per document')
+    parser.add_argument('--queries', help='.npy file of query embeddings (default: held-out documents)')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--dimensions', type=int, nargs='+', default=[256, 512, 1024, 2048])
+    parser.add_argument('--dtypes', nargs='+', default=['float32', 'float16', 'int8'])
+    parser.add_argument('--projections', nargs='+', default=['none', 'truncate', 'pca'])
+    parser.add_argument('--out', help='write the results as JSON lines to this file')
+    args = parser.parse_args()
+
+    embeddings = np.load(args.embeddings).astype(np.float32)
+    if args.queries:
+        documents_, queries_ = embeddings, np.load(args.queries).astype(np.float32)
+    else:
+        documents_, queries_ = embeddings[args.num_queries:], embeddings[:args.num_queries]
+
+    results_ = evaluate(documents_, queries_, args.dimensions, args.dtypes, args.projections, args.k)
+    for result in results_:
+        logger.info(json.dumps(result))
+    if 'float16' in args.dtypes:
+        logger.info('float16 saves index memory only (faiss SQ fp16): its vectors are still sent as JSON floats, '
+                    'so json_bytes_per_vector does not shrink')
+    if args.out:
+        with open(args.out, 'w') as f:
+            for result in results_:
+                f.write(json.dumps(result) + '\n')
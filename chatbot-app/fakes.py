@@ -0,0 +1,453 @@
+from botocore.exceptions import ClientError
+from vector_store import matches_filters, decay_multiplier, page_hits
+from search_client import RequestMetrics
+from decimal import Decimal
+import threading
+import hashlib
+import logging
+import random
+import json
+import copy
+import time
+import io
+import re
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+DEFAULT_COMPLETION = 'Defamation is a false statement that harms the reputation of a person or an entity.'
+
+
+def fake_embedding(text: str, dimension: int = 4096) -> list:
+    """
+    Deterministic unit-length pseudo-embedding derived from the text, so equal texts get equal vectors.
+    """
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+    rng = random.Random(seed)
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimension)]
+    norm = sum(x * x for x in vector) ** 0.5
+    return [x / norm for x in vector]
+
+
+class FakeSageMakerRuntime:
+    """
+    Local stand-in for the `sagemaker-runtime` boto3 client. Embedding requests (`text_inputs` as a list) get
+    deterministic vectors, generation requests get `completion_fn(prompt)`. `latency` is added to every call
+    and, when set, `tokens_per_second` paces generation the way a real endpoint decodes.
+    """
+
+    def __init__(self, latency: float = 0.0, tokens_per_second: float = None, completion_fn=None,
+                 embedding_dimension: int = 4096):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.completion_fn = completion_fn or (lambda prompt: DEFAULT_COMPLETION)
+        self.embedding_dimension = embedding_dimension
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _record(self, operation: str, endpoint_name: str, payload: dict) -> None:
+        with self._lock:
+            self.calls.append((operation, endpoint_name, payload))
+
+    def _tokens(self, prompt: str) -> list:
+        completion = self.completion_fn(prompt)
+        return [token + ' ' for token in completion.split(' ')]
+
+    def _decode_delay(self, num_tokens: int) -> float:
+        if not self.tokens_per_second:
+            return 0.0
+        return num_tokens / self.tokens_per_second
+
+    def invoke_endpoint(self, EndpointName: str, ContentType: str, Body: bytes, **kwargs) -> dict:
+        payload = json.loads(Body)
+        self._record('invoke_endpoint', EndpointName, payload)
+        text_inputs = payload.get('text_inputs', payload.get('inputs'))
+        if isinstance(text_inputs, list):
+            time.sleep(self.latency)
+            body = {'embedding': [fake_embedding(text, self.embedding_dimension) for text in text_inputs]}
+        else:
+            tokens = self._tokens(text_inputs)
+            time.sleep(self.latency + self._decode_delay(len(tokens)))
+            body = {'generated_texts': [''.join(tokens).strip()]}
+        return {'Body': io.BytesIO(json.dumps(body).encode('utf-8')), 'ContentType': ContentType}
+
+    def invoke_endpoint_with_response_stream(self, EndpointName: str, ContentType: str, Body: bytes,
+                                             **kwargs) -> dict:
+        payload = json.loads(Body)
+        self._record('invoke_endpoint_with_response_stream', EndpointName, payload)
+        tokens = self._tokens(payload.get('inputs', payload.get('text_inputs')))
+        time.sleep(self.latency)
+
+        def events():
+            for token in tokens:
+                time.sleep(self._decode_delay(1))
+                line = 'data:' + json.dumps({'token': {'text': token, 'special': False}}) + '\n'
+                data = line.encode('utf-8')
+                # Split each line across two PayloadParts, as the service is free to do
+                middle = len(data) // 2
+                yield {'PayloadPart': {'Bytes': data[:middle]}}
+                yield {'PayloadPart': {'Bytes': data[middle:]}}
+
+        return {'Body': events(), 'ContentType': ContentType}
+
+
+def key_condition_value(condition, name: str):
+    """
+    Pull the value compared against `name` out of a boto3 Key(...).eq(...) condition (possibly combined with &).
+    """
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        for sub_condition in expression['values']:
+            value = key_condition_value(sub_condition, name)
+            if value is not None:
+                return value
+        return None
+    key, value = expression['values']
+    return value if key.name == name and expression['operator'] == '=' else None
+
+
+def dynamodb_type(value) -> str:
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'BOOL'
+    if isinstance(value, (int, float, Decimal)):
+        return 'N'
+    if isinstance(value, str):
+        return 'S'
+    if isinstance(value, (bytes, bytearray)):
+        return 'B'
+    if isinstance(value, dict):
+        return 'M'
+    if isinstance(value, list):
+        return 'L'
+    return 'SS' if all(isinstance(member, str) for member in value) else 'NS'
+
+
+class FakeDynamoDBTable:
+    """
+    In-memory stand-in for a boto3 DynamoDB Table supporting the calls this app makes: put/get/delete/update_item
+    (SET, ADD and REMOVE actions; attribute_exists/attribute_not_exists/attribute_type and comparison conditions),
+    query on the partition key with ScanIndexForward, Limit and pagination, filtered scans and batch_writer.
+    `latency` is added to every call.
+    """
+
+    def __init__(self, hash_key: str, range_key: str = None, latency: float = 0.0, page_size: int = None):
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.latency = latency
+        self.page_size = page_size
+        self.items = {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _key(self, item: dict) -> tuple:
+        return item[self.hash_key], item.get(self.range_key) if self.range_key else None
+
+    def _record(self, operation: str) -> None:
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls.append(operation)
+
+    def put_item(self, Item: dict, **kwargs) -> dict:
+        self._record('put_item')
+        with self._lock:
+            self.items[self._key(Item)] = copy.deepcopy(Item)
+        return {}
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        self._record('get_item')
+        with self._lock:
+            item = self.items.get(self._key(Key))
+        return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def delete_item(self, Key: dict, **kwargs) -> dict:
+        self._record('delete_item')
+        with self._lock:
+            self.items.pop(self._key(Key), None)
+        return {}
+
+    def batch_writer(self, **kwargs) -> 'FakeBatchWriter':
+        return FakeBatchWriter(self)
+
+    def query(self, KeyConditionExpression, ScanIndexForward: bool = True, Limit: int = None,
+              ExclusiveStartKey: dict = None, **kwargs) -> dict:
+        self._record('query')
+        hash_value = key_condition_value(KeyConditionExpression, self.hash_key)
+        with self._lock:
+            items = [copy.deepcopy(item) for (hash_key, _), item in self.items.items() if hash_key == hash_value]
+        if self.range_key:
+            items.sort(key=lambda item: item[self.range_key], reverse=not ScanIndexForward)
+        if ExclusiveStartKey is not None:
+            start_key = self._key(ExclusiveStartKey)
+            position = [self._key(item) for item in items].index(start_key)
+            items = items[position + 1:]
+        page_size = min(filter(None, [Limit, self.page_size]), default=None)
+        response = {'Items': items[:page_size] if page_size else items}
+        if page_size and len(items) > page_size:
+            last = response['Items'][-1]
+            response['LastEvaluatedKey'] = {k: last[k] for k in (self.hash_key, self.range_key) if k}
+        response['Count'] = len(response['Items'])
+        return response
+
+    def scan(self, FilterExpression: str = None, ExpressionAttributeValues: dict = None,
+             ExpressionAttributeNames: dict = None, ProjectionExpression: str = None, ExclusiveStartKey: dict = None,
+             Limit: int = None, **kwargs) -> dict:
+        self._record('scan')
+        values = ExpressionAttributeValues or {}
+        names = ExpressionAttributeNames or {}
+        with self._lock:
+            keys = sorted(self.items, key=str)
+            if ExclusiveStartKey is not None:
+                keys = keys[keys.index(self._key(ExclusiveStartKey)) + 1:]
+            # As in DynamoDB, a page is cut before the filter is applied
+            page_size = min(filter(None, [Limit, self.page_size]), default=None)
+            page = keys[:page_size] if page_size else keys
+            items = [copy.deepcopy(self.items[key]) for key in page]
+        if FilterExpression:
+            items = [item for item in items if self._check(FilterExpression, item, True, names, values)]
+        if ProjectionExpression:
+            attributes = [names.get(name.strip(), name.strip()) for name in ProjectionExpression.split(',')]
+            items = [{name: item[name] for name in attributes if name in item} for item in items]
+        response = {'Items': items, 'Count': len(items)}
+        if page_size and len(keys) > page_size:
+            last = self.items[page[-1]]
+            response['LastEvaluatedKey'] = {k: last[k] for k in (self.hash_key, self.range_key) if k}
+        return response
+
+    def update_item(self, Key: dict, UpdateExpression: str, ExpressionAttributeValues: dict = None,
+                    ConditionExpression: str = None, ExpressionAttributeNames: dict = None, **kwargs) -> dict:
+        self._record('update_item')
+        values = ExpressionAttributeValues or {}
+        names = ExpressionAttributeNames or {}
+        with self._lock:
+            exists = self._key(Key) in self.items
+            item = self.items.get(self._key(Key), dict(Key))
+            if ConditionExpression and not self._check(ConditionExpression, item, exists, names, values):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'UpdateItem')
+            for action, clauses in re.findall(r'(SET|ADD|REMOVE)\s+(.*?)(?=\s+(?:SET|ADD|REMOVE)\s|$)',
+                                              UpdateExpression):
+                for clause in clauses.split(','):
+                    clause = clause.strip()
+                    if action == 'SET':
+                        path, operand = [part.strip() for part in clause.split('=', 1)]
+                        item[names.get(path, path)] = self._evaluate(operand, item, names, values)
+                    elif action == 'ADD':
+                        path, placeholder = clause.split()
+                        path = names.get(path, path)
+                        item[path] = item.get(path, 0) + values[placeholder]
+                    else:
+                        item.pop(names.get(clause, clause), None)
+            self.items[self._key(Key)] = item
+        return {'Attributes': copy.deepcopy(item)}
+
+    @staticmethod
+    def _evaluate(operand: str, item: dict, names: dict, values: dict):
+        for operator in (' - ', ' + '):
+            if operator in operand:
+                left, right = [FakeDynamoDBTable._evaluate(part.strip(), item, names, values)
+                               for part in operand.split(operator, 1)]
+                return left - right if operator == ' - ' else left + right
+        if operand.startswith(':'):
+            return values[operand]
+        return item.get(names.get(operand, operand))
+
+    @staticmethod
+    def _check(condition: str, item: dict, exists: bool, names: dict, values: dict) -> bool:
+        for clause in re.split(r'\s+AND\s+', condition):
+            clause = clause.strip()
+            if clause.startswith('(') and clause.endswith(')'):
+                clause = clause[1:-1]
+            alternatives = [alternative.strip() for alternative in re.split(r'\s+OR\s+', clause)]
+            if not any(FakeDynamoDBTable._check_one(alternative, item, exists, names, values)
+                       for alternative in alternatives):
+                return False
+        return True
+
+    @staticmethod
+    def _check_one(clause: str, item: dict, exists: bool, names: dict, values: dict) -> bool:
+        match = re.fullmatch(r'attribute_type\((.+?),\s*(:\w+)\)', clause)
+        if match:
+            path = names.get(match.group(1), match.group(1))
+            return exists and path in item and dynamodb_type(item[path]) == values[match.group(2)]
+        match = re.fullmatch(r'(attribute_exists|attribute_not_exists)\((.+)\)', clause)
+        if match:
+            path = names.get(match.group(2), match.group(2))
+            present = exists and path in item
+            return present if match.group(1) == 'attribute_exists' else not present
+        match = re.fullmatch(r'(.+?)\s*(=|<>|<=|>=|<|>)\s*(.+)', clause)
+        left = FakeDynamoDBTable._evaluate(match.group(1).strip(), item, names, values)
+        right = FakeDynamoDBTable._evaluate(match.group(3).strip(), item, names, values)
+        if left is None or right is None:
+            return match.group(2) == '=' and left is right or match.group(2) == '<>' and left is not right
+        return {'=': left == right, '<>': left != right, '<': left < right, '<=': left <= right,
+                '>': left > right, '>=': left >= right}[match.group(2)]
+
+
+class FakeBatchWriter:
+    """
+    Stand-in for `Table.batch_writer()`: queues puts and deletes and applies them 25 at a time, each group
+    recorded as one batch_write_item call.
+    """
+
+    def __init__(self, table: FakeDynamoDBTable):
+        self.table = table
+        self.requests = []
+
+    def __enter__(self) -> 'FakeBatchWriter':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+
+    def put_item(self, Item: dict) -> None:
+        self.requests.append(('put', copy.deepcopy(Item)))
+        if len(self.requests) == 25:
+            self.flush()
+
+    def delete_item(self, Key: dict) -> None:
+        self.requests.append(('delete', Key))
+        if len(self.requests) == 25:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.requests:
+            return
+        self.table._record('batch_write_item')
+        with self.table._lock:
+            for action, item in self.requests:
+                if action == 'put':
+                    self.table.items[self.table._key(item)] = item
+                else:
+                    self.table.items.pop(self.table._key(item), None)
+        self.requests = []
+
+
+class FakeDynamoDBResource:
+    """
+    Stand-in for `boto3.resource('dynamodb')` handing out the given fake tables by name. batch_write_item leaves
+    each put unprocessed with probability `unprocessed_rate`, as DynamoDB does when a partition is throttled.
+    """
+
+    def __init__(self, tables: dict, unprocessed_rate: float = 0.0, seed: int = 0):
+        self.tables = tables
+        self.unprocessed_rate = unprocessed_rate
+        self.rng = random.Random(seed)
+
+    def Table(self, name: str) -> FakeDynamoDBTable:
+        return self.tables[name]
+
+    def batch_write_item(self, RequestItems: dict, **kwargs) -> dict:
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise ClientError({'Error': {'Code': 'ValidationException',
+                                         'Message': 'Too many items requested for the BatchWriteItem call'}},
+                              'BatchWriteItem')
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            table = self.tables[name]
+            table._record('batch_write_item')
+            for request in requests:
+                if self.rng.random() < self.unprocessed_rate:
+                    unprocessed.setdefault(name, []).append(request)
+                    continue
+                with table._lock:
+                    if 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        table.items[table._key(item)] = copy.deepcopy(item)
+                    else:
+                        table.items.pop(table._key(request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': unprocessed}
+
+
+class FakeOpenSearchClient:
+    """
+    In-process stand-in for search_client.OpenSearchClient: brute-force k-NN (OpenSearch l2 scores, with k-NN
+    filters, an `exp` function_score decay and search_after paging) and a simple term-match score over the
+    indexed documents. `latency` is added to every request.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.indices = {}
+        self.calls = []
+        self.metrics = RequestMetrics()
+        self._lock = threading.Lock()
+
+    def index(self, index: str, doc_id: str, document: dict) -> None:
+        with self._lock:
+            self.indices.setdefault(index, {})[doc_id] = copy.deepcopy(document)
+
+    def _search(self, index: str, query: dict) -> dict:
+        documents = self.indices.get(index, {})
+        size = query.get('size', 10)
+        clause = query['query']
+        decay = None
+        if 'function_score' in clause:
+            decay = clause['function_score']['functions'][0]
+            clause = clause['function_score']['query']
+        if 'knn' in clause:
+            knn = clause['knn']['embedding']
+            filters = knn.get('filter', {}).get('bool', {}).get('filter')
+            vector = knn['vector']
+            scored = [(1 / (1 + sum((a - b) ** 2 for a, b in zip(vector, document['embedding']))), doc_id)
+                      for doc_id, document in documents.items() if matches_filters(document, filters)]
+            scored.sort(key=lambda pair: pair[0], reverse=True)
+            scored = scored[:knn['k']]
+            if decay:
+                scored = [(score * decay_multiplier(documents[doc_id], decay), doc_id) for score, doc_id in scored]
+        else:
+            field, text = next(iter(clause['match'].items()))
+            terms = set(text.lower().split())
+            scored = [(float(len(terms & set(str(document.get(field, '')).lower().split()))), doc_id)
+                      for doc_id, document in documents.items()]
+            scored = [(score, doc_id) for score, doc_id in scored if score > 0]
+        scored.sort(key=lambda pair: pair[0], reverse=True)
+        hits = [{'_index': index, '_id': doc_id, '_score': score,
+                 '_source': {k: v for k, v in documents[doc_id].items() if k != 'embedding'}}
+                for score, doc_id in scored]
+        tiebreaker = next(iter(query['sort'][1])) if 'sort' in query else None
+        hits = page_hits(hits, size, query.get('search_after'), tiebreaker)
+        return {'hits': {'total': {'value': len(hits)}, 'hits': hits}}
+
+    def search(self, index: str, query: dict) -> dict:
+        time.sleep(self.latency)
+        self.calls.append('search')
+        self.metrics.record('search', self.latency)
+        return self._search(index, query)
+
+    def msearch(self, searches: list) -> list:
+        time.sleep(self.latency)
+        self.calls.append('msearch')
+        self.metrics.record('msearch', self.latency)
+        return [self._search(index, query) for index, query in searches]
+
+    def bulk(self, body: str):
+        time.sleep(self.latency)
+        self.calls.append('bulk')
+        self.metrics.record('bulk', self.latency)
+        lines = body.strip().split('\n')
+        items = []
+        for action_line, document_line in zip(lines[::2], lines[1::2]):
+            action = json.loads(action_line)['index']
+            self.index(action['_index'], action['_id'], json.loads(document_line))
+            items.append({'index': {'_id': action['_id'], 'status': 201}})
+        return FakeResponse(200, {'errors': False, 'items': items})
+
+
+class FakeResponse:
+
+    def __init__(self, status_code: int, body: dict):
+        self.status_code = status_code
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self) -> dict:
+        return self.body
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise RuntimeError(f'HTTP {self.status_code}: {self.text}')
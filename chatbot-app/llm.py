@@ -1,7 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from response_cache import context_fingerprint
+from response_cache import response_cache
+from registry import config_section
+from tracing import with_trace
+from registry import get_client
+from tracing import traced
+from prompt import count_tokens
+from tracing import span
 import logging
-import boto3
 import json
-import yaml
+import time
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -9,20 +18,25 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger('log')
 
 
-with open('./config/config.yml', 'r') as f:
-    config = yaml.safe_load(f)
-
-endpoint_name = config['jumpstart']['text_gen_endpoint_name']
+jumpstart_config = config_section('jumpstart')
+endpoint_name = jumpstart_config['text_gen_endpoint_name']
+# Response streaming needs a container that supports it (e.g. TGI); otherwise the full completion is yielded at once
+STREAM = jumpstart_config.get('text_gen_stream', False)
 CONTENT_TYPE = 'application/json'
 
-client = boto3.client('sagemaker-runtime')
-
 NUM_RETURN_SEQUENCES = 1
 TOP_K = 0
 TOP_P = 0.7
 DO_SAMPLE = True
 TEMPERATURE = 0.1
 
+llm_config = config_section('llm')
+MAX_CONCURRENCY = llm_config.get('max_concurrency', 3)
+PASSAGE_TIMEOUT = llm_config.get('passage_timeout', 30)  # in seconds
+
+# Shared across turns so that the concurrency cap also holds for simultaneous users
+executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY, thread_name_prefix='llm')
+
 
 def detect_task(query: str) -> str:
     if query.startswith('\\verified') or query.startswith('/verified'):
@@ -33,7 +47,7 @@ def detect_task(query: str) -> str:
         return 'STM CHAT'
 
 
-def generate(prompt: str, max_length=256) -> str:
+def build_generation_payload(prompt: str, max_length=256) -> bytes:
     payload = {'text_inputs': prompt,
                'max_length': max_length,
                'num_return_sequences': NUM_RETURN_SEQUENCES,
@@ -41,25 +55,153 @@ def generate(prompt: str, max_length=256) -> str:
                'top_p': TOP_P,
                'temperature': TEMPERATURE,
                'do_sample': DO_SAMPLE}
-    payload = json.dumps(payload).encode('utf-8')
-    response = client.invoke_endpoint(EndpointName=ENDPOINT_NAME,
-                                      ContentType=CONTENT_TYPE,
-                                      Body=payload)
-    model_predictions = json.loads(response['Body'].read())
+    return json.dumps(payload).encode('utf-8')
+
+
+def parse_generation_response(body: bytes) -> str:
+    model_predictions = json.loads(body)
     generated_text = model_predictions['generated_texts'][0]
     completion = generated_text.strip()
     return completion
 
 
-def summarize_passages_and_collate_answers(passages: list, query: str) -> str:
+def generate(prompt: str, max_length=256) -> str:
+    payload = build_generation_payload(prompt, max_length)
+    with span('sagemaker.generate', request_bytes=len(payload), prompt_tokens=count_tokens(prompt)) as call:
+        response = get_client('sagemaker-runtime').invoke_endpoint(EndpointName=endpoint_name,
+                                                                   ContentType=CONTENT_TYPE,
+                                                                   Body=payload)
+        body = response['Body'].read()
+        completion = parse_generation_response(body)
+        call.set(response_bytes=len(body), completion_tokens=count_tokens(completion))
+    return completion
+
+
+def parse_stream_event_lines(event_stream):
+    """
+    Reassemble the PayloadPart byte chunks of a SageMaker response stream into complete lines.
+    A single line may be split across several PayloadParts, or one PayloadPart may carry several lines.
+    """
+    buffer = bytearray()
+    for event in event_stream:
+        if 'PayloadPart' not in event:
+            continue
+        # What is left of the buffer holds no newline, so only the new bytes are scanned, and consumed lines are
+        # dropped once per event rather than re-copying the tail per line
+        scanned = len(buffer)
+        buffer.extend(event['PayloadPart']['Bytes'])
+        start = 0
+        end = buffer.find(b'\n', scanned)
+        while end != -1:
+            line = buffer[start:end]
+            if line.strip():
+                yield line.decode('utf-8')
+            start = end + 1
+            end = buffer.find(b'\n', start)
+        del buffer[:start]
+    if buffer.strip():
+        yield buffer.decode('utf-8')
+
+
+def parse_stream_token(line: str) -> str:
+    """
+    Extract the text of one streamed line. Server-sent-event lines (`data:{"token": {"text": ...}}`) carry a
+    token each; anything else is treated as a raw text chunk.
+    """
+    if line.startswith('data:'):
+        event = json.loads(line[len('data:'):])
+        if event.get('token', {}).get('special'):
+            return ''
+        return event.get('token', {}).get('text', '')
+    return line
+
+
+def generate_stream(prompt: str, max_length=256):
+    """
+    Yield the completion for `prompt` chunk by chunk as the endpoint produces it.
+    """
+    if not STREAM:
+        yield generate(prompt, max_length)
+        return
+    payload = {'inputs': prompt,
+               'parameters': {'max_new_tokens': max_length,
+                              'top_p': TOP_P,
+                              'temperature': TEMPERATURE,
+                              'do_sample': DO_SAMPLE},
+               'stream': True}
+    payload = json.dumps(payload).encode('utf-8')
+    with span('sagemaker.generate_stream', request_bytes=len(payload), prompt_tokens=count_tokens(prompt)) as call:
+        start = time.perf_counter()
+        client = get_client('sagemaker-runtime')
+        response = client.invoke_endpoint_with_response_stream(EndpointName=endpoint_name,
+                                                               ContentType=CONTENT_TYPE,
+                                                               Body=payload)
+        started = False
+        chunks = []
+        for line in parse_stream_event_lines(response['Body']):
+            token = parse_stream_token(line)
+            if not started:
+                # Match generate(), which strips leading whitespace from the completion
+                token = token.lstrip()
+                started = bool(token)
+                if started:
+                    call.set(first_token_ms=(time.perf_counter() - start) * 1000)
+            if token:
+                chunks.append(token)
+                yield token
+        completion = ''.join(chunks)
+        call.set(response_bytes=len(completion.encode('utf-8')), completion_tokens=count_tokens(completion))
+
+
+def build_passage_prompt(passage: str, query: str) -> str:
+    prompt = f'Passage=={passage}\n\nQuestion=={query}\n\nAnswer==\n\nGiven a passage and a question, generate ' \
+             f'a clean answer in 2 to 3 short complete sentences. '
+    return prompt
+
+
+def answer_passage(passage: str, query: str) -> str:
+    return generate(build_passage_prompt(passage, query), 256)
+
+
+@traced('llm.summarize_passages_and_collate_answers')
+def summarize_passages_and_collate_answers(passages: list, query: str, timeout: float = PASSAGE_TIMEOUT,
+                                           query_embedding: list = None) -> str:
+    """
+    Generate one answer per passage concurrently (at most MAX_CONCURRENCY calls in flight) and collate them in
+    the original passage order. Passages whose call fails or exceeds `timeout` seconds are left out, so the turn
+    still returns the answers that did arrive. With a query embedding, a semantically equivalent question over
+    the same passages is answered from the response cache.
+    """
+    if not passages:
+        return 'I could not find a verified source that answers this question.'
+    passage_ids = [(doc_id, passage_id) for _, doc_id, passage_id in passages]
+    fingerprint = context_fingerprint('verified', endpoint_name, passage_ids)
+    if response_cache is not None and query_embedding is not None:
+        cached = response_cache.lookup(query_embedding, fingerprint)
+        if cached is not None:
+            return cached
+    start = time.monotonic()
+    futures = [executor.submit(with_trace(answer_passage), passage, query) for passage, _, _ in passages]
     collated_answers = []
-    for passage, doc_id, passage_id in passages:
-        prompt = f'Passage=={passage}\n\nQuestion=={query}\n\nAnswer==\n\nGiven a passage and a question, generate ' \
-                 f'a clean answer in 2 to 3 short complete sentences. '
-        answer = generate(prompt, 256)
+    for i, (future, (_, doc_id, passage_id)) in enumerate(zip(futures, passages)):
+        # A call cannot start before the calls queued ahead of it have had their own timeout
+        deadline = start + timeout * (i // MAX_CONCURRENCY + 1)
+        try:
+            answer = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            future.cancel()
+            logger.warning(f'Answer generation timed out for doc = {doc_id} | passage = {passage_id}')
+            continue
+        except Exception as e:
+            logger.error(f'Answer generation failed for doc = {doc_id} | passage = {passage_id}: {e}')
+            continue
         collated_answers.append(f'{answer}\n\n[doc = {doc_id} | passage = {passage_id}]')
+    # Only complete answer sets are cached, a partial one would outlive the timeout that caused it
+    complete = len(collated_answers) == len(passages)
     collated_answers = '\n\n'.join(collated_answers)
     logger.info(f'ANSWERS: {collated_answers}')
+    if response_cache is not None and query_embedding is not None and complete:
+        response_cache.store(query_embedding, fingerprint, collated_answers)
     return collated_answers
 
 
@@ -69,6 +211,14 @@ def generate_dialogue_response(prompt: str) -> str:
     return completion
 
 
+def stream_dialogue_response(prompt: str):
+    chunks = []
+    for chunk in generate_stream(prompt, 256):
+        chunks.append(chunk)
+        yield chunk
+    logger.info(f'DIALOGUE RESPONSE: {"".join(chunks).strip()}')
+
+
 if __name__ == '__main__':
     completion_ = detect_task('definition of bribery by indian law ')
     logging.info(completion_)
@@ -0,0 +1,189 @@
+from concurrent.futures import ThreadPoolExecutor
+from search_client import RequestMetrics
+from urllib.parse import urlsplit
+from async_chat import fake_chat_core
+from chat_service import ChatService
+import argparse
+import asyncio
+import logging
+import random
+import time
+import json
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+QUERIES = {
+    'STM': ['hi', 'what is court defamation?', 'can you give me an example?', 'how is it different from libel?',
+            'thanks, that helps'],
+    '/past': ['/past defamation', '/past what did we discuss about contracts?', '/past court cases'],
+    '/verified': ['/verified what is defamation?', '/verified what are the elements of a valid contract?',
+                  '/verified what is the statute of limitations for libel?']
+}
+
+
+class Connection:
+    """
+    One keep-alive HTTP/1.1 connection to the chat service, as a single simulated user holds it.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method: str, path: str, payload: dict = None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+        self.writer.write(f'{method} {path} HTTP/1.1\r\n'
+                          f'Host: {self.host}:{self.port}\r\n'
+                          f'Content-Type: application/json\r\n'
+                          f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if not line.strip():
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        data = await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status, json.loads(data) if data else {}
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            self.reader, self.writer = None, None
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(','):
+        task, _, weight = part.partition('=')
+        task = {'stm': 'STM', 'past': '/past', 'verified': '/verified'}[task.strip().lower()]
+        weights[task] = float(weight)
+    return weights
+
+
+async def run_user(host: str, port: int, turns: int, weights: dict, rng: random.Random,
+                   metrics: RequestMetrics) -> None:
+    connection = Connection(host, port)
+    try:
+        status, body = await connection.request('POST', '/sessions')
+        if status != 201:
+            raise RuntimeError(f'Could not start a session: {status} {body}')
+        session_id = body['session_id']
+        for _ in range(turns):
+            task = rng.choices(list(weights), weights=list(weights.values()))[0]
+            start = time.perf_counter()
+            try:
+                status, _ = await connection.request('POST', f'/sessions/{session_id}/turns',
+                                                     {'query': rng.choice(QUERIES[task])})
+                error = status != 200
+            except (ConnectionError, asyncio.IncompleteReadError):
+                await connection.close()
+                error = True
+            metrics.record(task, time.perf_counter() - start, error=error)
+        start = time.perf_counter()
+        status, _ = await connection.request('DELETE', f'/sessions/{session_id}')
+        metrics.record('end_session', time.perf_counter() - start, error=status != 200)
+    finally:
+        await connection.close()
+
+
+async def run_load(host: str, port: int, users: int, turns: int, weights: dict, seed: int) -> dict:
+    """
+    Drive `users` concurrent sessions of `turns` turns each, drawing each turn's task from `weights`.
+    :return: Per task type request counts, errors, throughput and latency percentiles
+    """
+    metrics = RequestMetrics(window=users * turns + users)
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(run_user(host, port, turns, weights, random.Random(rng.random()), metrics)
+                                     for _ in range(users)), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f'Simulated user failed: {result}')
+    stats = metrics.stats()
+    for task_stats in stats.values():
+        task_stats['throughput_rps'] = task_stats['count'] / elapsed
+    return {'elapsed_s': elapsed,
+            'users': users,
+            'turns_per_user': turns,
+            'failed_users': sum(isinstance(result, Exception) for result in results),
+            'tasks': stats}
+
+
+def report(results: dict) -> None:
+    logger.info(f'{results["users"]} users x {results["turns_per_user"]} turns in {results["elapsed_s"]:.2f}s')
+    if 'embedding_batches' in results:
+        batches = results['embedding_batches']
+        logger.info(f'{batches["requests"]} query embeddings in {batches["batches"]} endpoint calls '
+                    f'(mean batch {batches["mean_batch_size"]:.1f}, expired {batches["expired"]})')
+    if 'ltm_prefetch' in results:
+        prefetch = results['ltm_prefetch']
+        logger.info(f'{prefetch["prefetches"]} LTM prefetches ({prefetch["skipped"]} skipped), /past hit rate '
+                    f'{prefetch["past_hit_rate"]:.0%}, /verified hit rate {prefetch["passages_hit_rate"]:.0%}, '
+                    f'{prefetch["wasted"]} wasted with {prefetch["wasted_calls"]} of {prefetch["calls"]} calls')
+    logger.info(f'{"task":<12}{"count":>8}{"errors":>8}{"req/s":>9}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+                f'{"max ms":>10}')
+    for task, stats in results['tasks'].items():
+        logger.info(f'{task:<12}{stats["count"]:>8}{stats["errors"]:>8}{stats["throughput_rps"]:>9.1f}'
+                    f'{stats["p50_ms"]:>10.1f}{stats["p95_ms"]:>10.1f}{stats["p99_ms"]:>10.1f}{stats["max_ms"]:>10.1f}')
+
+
+async def main(args) -> dict:
+    weights = parse_mix(args.mix)
+    if args.url:
+        url = urlsplit(args.url)
+        return await run_load(url.hostname, url.port or 80, args.users, args.turns, weights, args.seed)
+    # No target given: serve the engine over the local fakes in this process, on an ephemeral port
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=args.threads))
+    core = fake_chat_core(args.latency, args.store, args.write_buffer, args.embedding_batcher,
+                          args.ltm_prefetch)
+    server = await ChatService(core).start('127.0.0.1', 0)
+    async with server:
+        results = await run_load('127.0.0.1', server.sockets[0].getsockname()[1], args.users, args.turns,
+                                 weights, args.seed)
+    await core.drain()
+    results['write_errors'] = len(core.write_errors)
+    if core.embedding_batcher is not None:
+        results['embedding_batches'] = core.embedding_batcher.stats.stats()
+    if core.ltm_prefetcher is not None:
+        results['ltm_prefetch'] = core.ltm_prefetcher.stats()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test the chat service and report latency per task type')
+    parser.add_argument('--url', help='running chat service to target, e.g. http://127.0.0.1:8080; '
+                                      'by default one is started in-process over the local fakes')
+    parser.add_argument('--users', type=int, default=32, help='concurrent sessions')
+    parser.add_argument('--turns', type=int, default=8, help='turns per session')
+    parser.add_argument('--mix', default='stm=0.6,past=0.2,verified=0.2', help='task weights')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.05, help='simulated per-call latency of the fakes')
+    parser.add_argument('--store', default='dynamodb', choices=['dynamodb', 'memory'])
+    parser.add_argument('--write-buffer', action='store_true', help='batch turn writes to the fake tables')
+    parser.add_argument('--embedding-batcher', action='store_true', default=None,
+                        help='batch concurrent query embeddings into shared endpoint calls')
+    parser.add_argument('--ltm-prefetch', action='store_true', default=None,
+                        help='search long-term memory during STM turns for /past and /verified follow-ups')
+    parser.add_argument('--threads', type=int, default=64)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results = asyncio.run(main(args))
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,252 @@
+from response_cache import normalize, cosine_similarity
+from embedding_cache import normalize_text
+from collections import OrderedDict
+import contextvars
+import threading
+import logging
+import asyncio
+import time
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+KINDS = ('past', 'passages')
+
+
+def prefetch_key(text: str) -> str:
+    return normalize_text(text).lower()
+
+
+class PrefetchEntry:
+    __slots__ = ('key', 'task', 'created', 'used', 'discarded')
+
+    def __init__(self, key: str, task: asyncio.Task, created: float):
+        self.key = key
+        self.task = task
+        self.created = created
+        self.used = False
+        self.discarded = False
+
+    def result(self):
+        """
+        :return: What the prefetch fetched, or None while it runs or when it failed
+        """
+        if not self.task.done() or self.task.cancelled() or self.task.exception() is not None:
+            return None
+        return self.task.result()
+
+
+class LTMPrefetcher:
+    """
+    Speculative long-term-memory retrieval for the async chat core. While an STM turn generates, `prefetch` runs
+    `fetch(session_id, text)` in the background: it embeds the user's message and searches past conversations and
+    passages with it, returning `{'embedding': ..., 'past': hits, 'passages': hits, 'calls': backend calls}`. A
+    later `/past` or `/verified` of the session is served from those hits by `lookup` when its text is the same
+    message (waiting for the prefetch if it is still running), or when its query embedding is within `threshold`
+    cosine similarity of the message's.
+
+    Each session keeps its `max_entries_per_session` latest prefetches for `ttl` seconds, and the
+    `max_sessions` most recently active sessions are kept. At most `max_in_flight` prefetches run at once, further
+    ones are skipped. A prefetch that is dropped without serving any lookup is counted as wasted, along with the
+    backend calls it made.
+    """
+
+    def __init__(self, fetch, max_sessions: int = 1024, max_entries_per_session: int = 2, threshold: float = 0.9,
+                 ttl: float = 300.0, max_in_flight: int = 8, min_words: int = 3):
+        self.fetch = fetch
+        self.max_sessions = max_sessions
+        self.max_entries_per_session = max_entries_per_session
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_in_flight = max_in_flight
+        self.min_words = min_words
+        self.sessions = OrderedDict()
+        self.in_flight = 0
+        self.prefetches = 0
+        self.skipped = 0
+        self.failed = 0
+        self.calls = 0
+        self.wasted = 0
+        self.wasted_calls = 0
+        self.lookups = {kind: 0 for kind in KINDS}
+        self.hits = {kind: 0 for kind in KINDS}
+
+    def prefetch(self, session_id: str, text: str) -> None:
+        """
+        Start fetching long-term memory for the session's latest message, unless it is already prefetched, too
+        short to be worth a search, or too many prefetches are running.
+        """
+        key = prefetch_key(text)
+        if len(key.split()) < self.min_words:
+            return
+        entries = self.sessions.setdefault(session_id, OrderedDict())
+        self.sessions.move_to_end(session_id)
+        entry = entries.get(key)
+        if entry is not None:
+            if not entry.task.done() or entry.result() is not None:
+                entries.move_to_end(key)
+                return
+            # Failed earlier, worth another try
+            self._discard(entries.pop(key))
+        if self.in_flight >= self.max_in_flight:
+            self.skipped += 1
+            return
+        self.in_flight += 1
+        self.prefetches += 1
+        entry = PrefetchEntry(key, asyncio.ensure_future(self.fetch(session_id, text)), time.monotonic())
+        entry.task.add_done_callback(lambda _: self._fetched(entry))
+        entries[key] = entry
+        while len(entries) > self.max_entries_per_session:
+            self._discard(entries.popitem(last=False)[1])
+        while len(self.sessions) > self.max_sessions:
+            self.drop(next(iter(self.sessions)))
+
+    def _fetched(self, entry: PrefetchEntry) -> None:
+        self.in_flight -= 1
+        result = entry.result()
+        if result is None:
+            self.failed += 1
+            if not entry.task.cancelled():
+                logger.warning(f'LTM prefetch failed: {entry.task.exception()}')
+            return
+        calls = result['calls']
+        self.calls += calls
+        if entry.discarded:
+            self.wasted_calls += calls
+
+    def _discard(self, entry: PrefetchEntry) -> None:
+        if entry.used:
+            return
+        self.wasted += 1
+        result = entry.result()
+        if result is not None:
+            self.wasted_calls += result['calls']
+        elif not entry.task.done():
+            # Left to finish, so that its calls are counted when it does
+            entry.discarded = True
+
+    def _entries(self, session_id: str) -> OrderedDict:
+        entries = self.sessions.get(session_id)
+        if entries is None:
+            return OrderedDict()
+        now = time.monotonic()
+        for key in [key for key, entry in entries.items() if now - entry.created > self.ttl]:
+            self._discard(entries.pop(key))
+        return entries
+
+    async def lookup(self, session_id: str, kind: str, text: str, embed=None):
+        """
+        Hits prefetched for `kind` (`past` or `passages`) that answer the session's follow-up `text`.
+        `embed()`, awaited only when no prefetch has the same text, returns the follow-up's query embedding for
+        the similarity match.
+        :return: The hits, or None on a miss
+        """
+        self.lookups[kind] += 1
+        entries = self._entries(session_id)
+        entry = entries.get(prefetch_key(text))
+        if entry is not None:
+            try:
+                # Shielded: a follow-up that gives up must not cancel a prefetch another lookup may use
+                result = await asyncio.shield(entry.task)
+            except Exception:
+                result = None
+        else:
+            result = None
+            if entries and embed is not None and self.threshold is not None:
+                query = normalize(await embed())
+                candidates = [(entry, entry.result()) for entry in reversed(entries.values())]
+                for candidate, candidate_result in candidates:
+                    if candidate_result is not None and cosine_similarity(
+                            query, normalize(candidate_result['embedding'])) >= self.threshold:
+                        entry, result = candidate, candidate_result
+                        break
+        if result is None:
+            return None
+        entry.used = True
+        self.hits[kind] += 1
+        return result[kind]
+
+    def drop(self, session_id: str) -> None:
+        """
+        Forget the session's prefetches, e.g. when it ends.
+        """
+        for entry in self.sessions.pop(session_id, {}).values():
+            self._discard(entry)
+
+    def stats(self) -> dict:
+        stats = {'prefetches': self.prefetches,
+                 'skipped': self.skipped,
+                 'failed': self.failed,
+                 'calls': self.calls,
+                 'wasted': self.wasted,
+                 'wasted_calls': self.wasted_calls}
+        for kind in KINDS:
+            stats[f'{kind}_lookups'] = self.lookups[kind]
+            stats[f'{kind}_hits'] = self.hits[kind]
+            stats[f'{kind}_hit_rate'] = self.hits[kind] / self.lookups[kind] if self.lookups[kind] else 0.0
+        return stats
+
+
+class BackgroundLTMPrefetcher:
+    """
+    LTMPrefetcher for threaded callers such as the Streamlit app. `fetch(session_id, text)` is blocking here: the
+    prefetches run it in worker threads of an event loop of their own, served by a daemon thread. Built once per
+    process, it outlives Streamlit reruns.
+    """
+
+    def __init__(self, fetch, **settings):
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name='ltm-prefetch', daemon=True).start()
+
+        async def fetch_in_thread(session_id, text):
+            return await asyncio.to_thread(fetch, session_id, text)
+        self.prefetcher = LTMPrefetcher(fetch_in_thread, **settings)
+
+    def prefetch(self, session_id: str, text: str) -> None:
+        """
+        Start prefetching for the session's latest message without waiting for it.
+        """
+        # Run in the caller's context, so the prefetch's spans join the turn's trace
+        self._loop.call_soon_threadsafe(self.prefetcher.prefetch, session_id, text,
+                                        context=contextvars.copy_context())
+
+    def lookup(self, session_id: str, kind: str, text: str, embed=None):
+        """
+        LTMPrefetcher.lookup with a blocking `embed()`, called in a worker thread when needed.
+        :return: The hits, or None on a miss
+        """
+        embed_in_thread = None
+        if embed is not None:
+            context = contextvars.copy_context()
+
+            async def embed_in_thread():
+                return await asyncio.to_thread(context.run, embed)
+        return asyncio.run_coroutine_threadsafe(self.prefetcher.lookup(session_id, kind, text, embed_in_thread),
+                                                self._loop).result()
+
+    def drop(self, session_id: str) -> None:
+        self._loop.call_soon_threadsafe(self.prefetcher.drop, session_id)
+
+    def stats(self) -> dict:
+        async def stats():
+            return self.prefetcher.stats()
+        return asyncio.run_coroutine_threadsafe(stats(), self._loop).result()
+
+
+def prefetcher_settings(prefetch_config: dict) -> dict:
+    """
+    :return: Keyword arguments of LTMPrefetcher from the `ltm_prefetch` config section, or None when prefetching
+             is disabled
+    """
+    prefetch_config = prefetch_config or {}
+    if not prefetch_config.get('enabled'):
+        return None
+    return {'max_sessions': prefetch_config.get('max_sessions', 1024),
+            'max_entries_per_session': prefetch_config.get('max_entries_per_session', 2),
+            'threshold': prefetch_config.get('threshold', 0.9),
+            'ttl': prefetch_config.get('ttl', 300),
+            'max_in_flight': prefetch_config.get('max_in_flight', 8),
+            'min_words': prefetch_config.get('min_words', 3)}
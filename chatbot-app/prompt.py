@@ -0,0 +1,73 @@
+from registry import config_section
+from functools import lru_cache
+import logging
+import math
+import re
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+prompt_config = config_section('prompt')
+MAX_PROMPT_TOKENS = prompt_config.get('max_prompt_tokens', 512)
+TOKENIZER_FILE = prompt_config.get('tokenizer_file')
+
+# Rough SentencePiece ratio for English text, used only when no local tokenizer file is available
+TOKENS_PER_WORD = 4 / 3
+WORD_PATTERN = re.compile(r'\w+|[^\w\s]')
+
+tokenizer = None
+if TOKENIZER_FILE:
+    if Tokenizer is None:
+        logger.warning('tokenizers is not installed, falling back to approximate token counts')
+    else:
+        tokenizer = Tokenizer.from_file(TOKENIZER_FILE)
+
+
+@lru_cache(maxsize=16384)
+def count_tokens(text: str) -> int:
+    """
+    Count tokens with the local tokenizer if one is configured, else estimate them from the word count.
+    Cached so that a stored turn is only tokenized once across the turns that re-read it.
+    """
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False).ids)
+    return math.ceil(len(WORD_PATTERN.findall(text)) * TOKENS_PER_WORD)
+
+
+def format_turn(turn: dict) -> str:
+    return f"Me: {turn['Me']}\nAI: {turn['AI']}"
+
+
+def pack_history(history: list, max_turns: int, token_budget: int):
+    """
+    Pack turns newest-first into the token budget, stopping at the first turn that no longer fits.
+    :return: History string in chronological order and a dict of tokens/turns used versus dropped
+    """
+    packed = []
+    tokens_used = 0
+    tokens_dropped = 0
+    for turn in reversed(history):
+        text = format_turn(turn)
+        # +1 accounts for the newline separating turns
+        tokens = count_tokens(text) + 1
+        if len(packed) < max_turns and not tokens_dropped and tokens_used + tokens <= token_budget:
+            packed.append(text)
+            tokens_used += tokens
+        else:
+            tokens_dropped += tokens
+    packed.reverse()
+    usage = {
+        'tokens_used': tokens_used,
+        'tokens_dropped': tokens_dropped,
+        'turns_used': len(packed),
+        'turns_dropped': len(history) - len(packed)
+    }
+    return '\n'.join(packed), usage
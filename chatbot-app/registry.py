@@ -0,0 +1,168 @@
+import threading
+import logging
+import yaml
+import os
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+CONFIG_FILE = os.environ.get('CHATBOT_CONFIG_FILE', './config/config.yml')
+
+# Settings with a fixed set of values, by path in the config file
+CHOICES = {
+    ('retrieval', 'backend'): ('opensearch', 'local'),
+    ('retrieval', 'space'): ('l2', 'cosinesimil', 'innerproduct'),
+    ('retrieval', 'passages', 'mode'): ('knn', 'hybrid'),
+    ('retrieval', 'passages', 'reranker'): ('none', 'overlap', 'cross-encoder'),
+    ('response_cache', 'backend'): ('local', 'dynamodb'),
+}
+# Numeric settings that must be above zero when set
+POSITIVE = (
+    ('opensearch', 'connection', 'pool_size'),
+    ('opensearch', 'connection', 'timeout'),
+    ('retrieval', 'dimension'),
+    ('retrieval', 'nprobe'),
+    ('retrieval', 'passages', 'k'),
+    ('retrieval', 'passages', 'candidates'),
+    ('retrieval', 'past', 'k'),
+    ('retrieval', 'past', 'candidates'),
+    ('retrieval', 'past', 'half_life_days'),
+    ('retrieval', 'past', 'window_days'),
+    ('llm', 'max_concurrency'),
+    ('llm', 'passage_timeout'),
+    ('prompt', 'max_prompt_tokens'),
+    ('embedding_cache', 'max_bytes'),
+    ('embedding_batcher', 'max_batch_size'),
+    ('embedding_batcher', 'max_wait_ms'),
+    ('embedding_batcher', 'max_pending'),
+    ('embedding_batcher', 'max_in_flight'),
+    ('embedding_batcher', 'timeout'),
+    ('ltm_prefetch', 'max_sessions'),
+    ('ltm_prefetch', 'max_entries_per_session'),
+    ('ltm_prefetch', 'threshold'),
+    ('ltm_prefetch', 'ttl'),
+    ('ltm_prefetch', 'max_in_flight'),
+    ('response_cache', 'ttl'),
+    ('response_cache', 'max_entries'),
+    ('response_cache', 'max_entries_per_context'),
+    ('write_buffer', 'flush_interval'),
+    ('write_buffer', 'max_pending'),
+)
+
+config = None
+config_lock = threading.Lock()
+# Clients and other objects shared by every module of the process, built on first use
+shared_objects = {}
+shared_objects_lock = threading.RLock()
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def lookup(config_: dict, path: tuple):
+    value = config_
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def validate_config(config_: dict) -> dict:
+    """
+    Check the settings the app modules read, so a bad value fails at startup rather than on the first request
+    that needs it.
+    :return: The config
+    :raise ConfigError: Listing every problem found
+    """
+    if not isinstance(config_, dict):
+        raise ConfigError(f'{CONFIG_FILE} must hold a mapping')
+    required = [('jumpstart', 'text_gen_endpoint_name'), ('jumpstart', 'text_embed_endpoint_name')]
+    if lookup(config_, ('retrieval', 'backend')) == 'local':
+        required.append(('retrieval', 'local_dir'))
+    else:
+        required.extend([('opensearch', 'domain', 'endpoint'), ('opensearch', 'credentials', 'username'),
+                         ('opensearch', 'credentials', 'password')])
+    problems = [f'{".".join(path)} is required' for path in required if not lookup(config_, path)]
+    for path, choices in CHOICES.items():
+        value = lookup(config_, path)
+        if value is not None and value not in choices:
+            problems.append(f'{".".join(path)} must be one of {", ".join(choices)}, not {value!r}')
+    for path in POSITIVE:
+        value = lookup(config_, path)
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+            problems.append(f'{".".join(path)} must be a positive number, not {value!r}')
+    if problems:
+        raise ConfigError(f'Invalid {CONFIG_FILE}: {"; ".join(problems)}')
+    return config_
+
+
+def get_config() -> dict:
+    """
+    The validated config, read from CONFIG_FILE once per process.
+    """
+    global config
+    if config is None:
+        with config_lock:
+            if config is None:
+                with open(CONFIG_FILE, 'r') as f:
+                    config = validate_config(yaml.safe_load(f))
+    return config
+
+
+def config_section(*path) -> dict:
+    """
+    The config section at `path`, e.g. `config_section('retrieval', 'passages')`, or {} when it is not set.
+    """
+    return lookup(get_config(), path) or {}
+
+
+def shared(name: str, factory):
+    """
+    The process-wide object registered under `name`, built with `factory()` by the first caller.
+    """
+    if name not in shared_objects:
+        with shared_objects_lock:
+            if name not in shared_objects:
+                shared_objects[name] = factory()
+    return shared_objects[name]
+
+
+def install(name: str, value) -> None:
+    """
+    Register `value` under `name` in place of what its factory would build, e.g. a fake client.
+    """
+    with shared_objects_lock:
+        shared_objects[name] = value
+
+
+def get_client(service_name: str):
+    """
+    The shared boto3 client of `service_name`. boto3 is only imported, and the client only built, on first use.
+    """
+    def new_client():
+        import boto3
+        return boto3.client(service_name)
+    return shared(f'client:{service_name}', new_client)
+
+
+def install_client(service_name: str, client) -> None:
+    install(f'client:{service_name}', client)
+
+
+def get_resource(service_name: str):
+    """
+    The shared boto3 resource of `service_name`, built on first use.
+    """
+    def new_resource():
+        import boto3
+        return boto3.resource(service_name)
+    return shared(f'resource:{service_name}', new_resource)
+
+
+if __name__ == '__main__':
+    logger.info(f'{CONFIG_FILE} is valid: {", ".join(sorted(get_config()))}')
@@ -0,0 +1,80 @@
+from collections import Counter
+import logging
+import math
+import re
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def reciprocal_rank_fusion(result_lists: list, rrf_k: int = 60) -> list:
+    """
+    Fuse ranked hit lists by summing 1 / (rrf_k + rank) per document id.
+    :return: Hits ordered by fused score, each carrying it as `_score`
+    """
+    fused = {}
+    for hits in result_lists:
+        for rank, hit in enumerate(hits, start=1):
+            if hit['_id'] not in fused:
+                fused[hit['_id']] = dict(hit, _score=0.0)
+            fused[hit['_id']]['_score'] += 1 / (rrf_k + rank)
+    return sorted(fused.values(), key=lambda hit: hit['_score'], reverse=True)
+
+
+class OverlapScorer:
+    """
+    Cheap local relevance score: the fraction of query terms (IDF-weighted over the candidate pool) that appear in
+    the passage, in [0, 1].
+    """
+
+    def score(self, query: str, passages: list) -> list:
+        query_terms = set(WORD_PATTERN.findall(query.lower()))
+        passage_terms = [set(WORD_PATTERN.findall(passage.lower())) for passage in passages]
+        document_frequency = Counter(term for terms in passage_terms for term in terms & query_terms)
+        weights = {term: math.log(1 + (len(passages) + 1) / (document_frequency[term] + 1)) for term in query_terms}
+        total = sum(weights.values())
+        if not total:
+            return [0.0] * len(passages)
+        return [sum(weights[term] for term in query_terms & terms) / total for terms in passage_terms]
+
+
+class CrossEncoderScorer:
+    """
+    Relevance from a local cross-encoder (sentence-transformers), e.g. cross-encoder/ms-marco-MiniLM-L-6-v2.
+    """
+
+    def __init__(self, model_name: str):
+        # Imported here: sentence-transformers loads torch, seconds of startup that other rerankers do not need
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError:
+            raise ImportError('CrossEncoderScorer requires sentence-transformers')
+        self.model = CrossEncoder(model_name)
+
+    def score(self, query: str, passages: list) -> list:
+        return [float(score) for score in self.model.predict([(query, passage) for passage in passages])]
+
+
+def get_reranker(name: str, model_name: str = None):
+    if not name or name == 'none':
+        return None
+    if name == 'overlap':
+        return OverlapScorer()
+    if name == 'cross-encoder':
+        return CrossEncoderScorer(model_name)
+    raise ValueError(f'Unsupported reranker: {name}')
+
+
+def rerank(reranker, query: str, hits: list, text_field: str) -> list:
+    """
+    Re-score hits with the reranker.
+    :return: Hits ordered by reranker score, each carrying it as `_score`
+    """
+    scores = reranker.score(query, [hit['_source'][text_field] for hit in hits])
+    rescored = [dict(hit, _score=score) for hit, score in zip(hits, scores)]
+    return sorted(rescored, key=lambda hit: hit['_score'], reverse=True)
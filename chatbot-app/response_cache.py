@@ -0,0 +1,255 @@
+from registry import config_section
+from collections import OrderedDict
+from registry import get_resource
+from array import array
+import threading
+import hashlib
+import logging
+import math
+import time
+import uuid
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+def context_fingerprint(*parts) -> str:
+    """
+    Fingerprint of everything besides the query that shapes an answer (task, history, passages, model).
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def normalize(embedding: list) -> array:
+    norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+    return array('f', (x / norm for x in embedding))
+
+
+def cosine_similarity(a: array, b: array) -> float:
+    return sum(x * y for x, y in zip(a, b))
+
+
+def most_similar(query: array, entries: list) -> tuple:
+    """
+    The entry whose (normalized) embedding is closest to `query`, scored in one matrix product when numpy is
+    available.
+    :return: The entry and its cosine similarity, or (None, None) without entries
+    """
+    if not entries:
+        return None, None
+    if np is not None:
+        similarities = np.stack([np.frombuffer(entry['embedding'], dtype=np.float32) for entry in entries]) @ \
+            np.frombuffer(query, dtype=np.float32)
+        best = int(np.argmax(similarities))
+        return entries[best], float(similarities[best])
+    return max(((entry, cosine_similarity(query, entry['embedding'])) for entry in entries),
+               key=lambda scored: scored[1])
+
+
+class LocalResponseCacheBackend:
+    """
+    In-process entries indexed by context fingerprint, evicted least-recently-used beyond `max_entries`, and
+    beyond `max_entries_per_context` for one fingerprint. Every session's first turn shares a fingerprint (no
+    history), so without the second bound a lookup would scan most of the cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_entries_per_context: int = 32):
+        self.max_entries = max_entries
+        self.max_entries_per_context = max_entries_per_context
+        self._entries = OrderedDict()
+        # Entry ids per fingerprint, least recently used first
+        self._by_fingerprint = {}
+        self._lock = threading.Lock()
+
+    def candidates(self, fingerprint: str) -> list:
+        with self._lock:
+            return [self._entries[entry_id] for entry_id in self._by_fingerprint.get(fingerprint, ())]
+
+    def touch(self, entry: dict) -> None:
+        with self._lock:
+            if entry['entry_id'] in self._entries:
+                self._entries.move_to_end(entry['entry_id'])
+                self._by_fingerprint[entry['fingerprint']].move_to_end(entry['entry_id'])
+
+    def put(self, entry: dict) -> None:
+        with self._lock:
+            self._entries[entry['entry_id']] = entry
+            entry_ids = self._by_fingerprint.setdefault(entry['fingerprint'], OrderedDict())
+            entry_ids[entry['entry_id']] = None
+            if len(entry_ids) > self.max_entries_per_context:
+                self._unindex(self._entries.pop(next(iter(entry_ids))))
+            while len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._unindex(evicted)
+
+    def delete(self, entry: dict) -> None:
+        with self._lock:
+            if self._entries.pop(entry['entry_id'], None) is not None:
+                self._unindex(entry)
+
+    def _unindex(self, entry: dict) -> None:
+        entry_ids = self._by_fingerprint.get(entry['fingerprint'])
+        entry_ids.pop(entry['entry_id'], None)
+        if not entry_ids:
+            del self._by_fingerprint[entry['fingerprint']]
+
+
+class DynamoDBResponseCacheBackend:
+    """
+    Entries in a DynamoDB table keyed by `fingerprint` (HASH) and `entry_id` (RANGE), shared by every app process.
+    Embeddings are stored as float32 binary. Enable DynamoDB TTL on `expires_at` to have expired entries purged;
+    at most `max_entries_per_context` entries are kept per fingerprint, oldest removed first. The entries a put
+    trims are those the lookup before it read, so storing an answer does not read the fingerprint again.
+    """
+
+    def __init__(self, table, max_entries_per_context: int = 32, max_known_contexts: int = 1024):
+        self.table = table
+        self.max_entries_per_context = max_entries_per_context
+        self.max_known_contexts = max_known_contexts
+        # entry_id -> created_at of the entries last read per fingerprint, least recently read dropped first
+        self._known = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _query(self, fingerprint: str, **kwargs) -> list:
+        # Imported here so that the local backend, the default, never loads boto3
+        from boto3.dynamodb.conditions import Key
+        kwargs['KeyConditionExpression'] = Key('fingerprint').eq(fingerprint)
+        items = []
+        # About 16 KB per 4096-d entry, so a fingerprint's entries can span several 1 MB pages
+        while True:
+            response = self.table.query(**kwargs)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                return items
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _remember(self, fingerprint: str, known: dict) -> None:
+        with self._lock:
+            self._known[fingerprint] = known
+            self._known.move_to_end(fingerprint)
+            while len(self._known) > self.max_known_contexts:
+                self._known.popitem(last=False)
+
+    def candidates(self, fingerprint: str) -> list:
+        items = self._query(fingerprint)
+        self._remember(fingerprint, {item['entry_id']: int(item['created_at']) for item in items})
+        entries = []
+        for item in items:
+            embedding = array('f')
+            embedding.frombytes(item['embedding'].value)
+            entries.append({'entry_id': item['entry_id'],
+                            'fingerprint': item['fingerprint'],
+                            'embedding': embedding,
+                            'answer': item['answer'],
+                            'created_at': int(item['created_at']),
+                            'expires_at': int(item['expires_at'])})
+        return entries
+
+    def touch(self, entry: dict) -> None:
+        pass
+
+    def put(self, entry: dict) -> None:
+        self.table.put_item(Item={'fingerprint': entry['fingerprint'],
+                                  'entry_id': entry['entry_id'],
+                                  'embedding': entry['embedding'].tobytes(),
+                                  'answer': entry['answer'],
+                                  'created_at': entry['created_at'],
+                                  'expires_at': entry['expires_at']})
+        with self._lock:
+            known = self._known.pop(entry['fingerprint'], None)
+        if known is None:
+            # Stored without a lookup first: list the fingerprint's entries, without their embeddings
+            known = {item['entry_id']: int(item['created_at'])
+                     for item in self._query(entry['fingerprint'], ProjectionExpression='entry_id, created_at')}
+        known[entry['entry_id']] = entry['created_at']
+        if len(known) > self.max_entries_per_context:
+            for entry_id in sorted(known, key=known.get)[:len(known) - self.max_entries_per_context]:
+                self.delete({'fingerprint': entry['fingerprint'], 'entry_id': entry_id})
+                del known[entry_id]
+        self._remember(entry['fingerprint'], known)
+
+    def delete(self, entry: dict) -> None:
+        self.table.delete_item(Key={'fingerprint': entry['fingerprint'], 'entry_id': entry['entry_id']})
+        with self._lock:
+            self._known.get(entry['fingerprint'], {}).pop(entry['entry_id'], None)
+
+
+class SemanticResponseCache:
+    """
+    Answer cache keyed by query embedding plus context fingerprint: a lookup hits when an unexpired entry with the
+    same fingerprint has a query embedding whose cosine similarity reaches `threshold`.
+    """
+
+    def __init__(self, backend, threshold: float = 0.95, ttl: int = 24 * 3600):
+        self.backend = backend
+        self.threshold = threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def lookup(self, embedding: list, fingerprint: str):
+        query = normalize(embedding)
+        now = int(time.time())
+        live = []
+        for entry in self.backend.candidates(fingerprint):
+            if entry['expires_at'] <= now:
+                self.backend.delete(entry)
+            else:
+                live.append(entry)
+        best, best_similarity = most_similar(query, live)
+        if best is not None and best_similarity < self.threshold:
+            best = None
+        with self._lock:
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.backend.touch(best)
+        logger.info(f'Response cache hit (similarity = {best_similarity:.3f})')
+        return best['answer']
+
+    def store(self, embedding: list, fingerprint: str, answer: str) -> None:
+        now = int(time.time())
+        self.backend.put({'entry_id': str(uuid.uuid4()),
+                          'fingerprint': fingerprint,
+                          'embedding': normalize(embedding),
+                          'answer': answer,
+                          'created_at': now,
+                          'expires_at': now + self.ttl})
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+def response_cache_from_config(cache_config: dict):
+    """
+    :return: The configured SemanticResponseCache, or None when the cache is disabled
+    """
+    cache_config = cache_config or {}
+    if not cache_config.get('enabled'):
+        return None
+    if cache_config.get('backend', 'local') == 'dynamodb':
+        table = get_resource('dynamodb').Table(cache_config.get('table_name', 'response-cache'))
+        backend = DynamoDBResponseCacheBackend(table, cache_config.get('max_entries_per_context', 32))
+    else:
+        backend = LocalResponseCacheBackend(cache_config.get('max_entries', 1024),
+                                            cache_config.get('max_entries_per_context', 32))
+    return SemanticResponseCache(backend, threshold=cache_config.get('threshold', 0.95),
+                                 ttl=cache_config.get('ttl', 24 * 3600))
+
+
+response_cache = response_cache_from_config(config_section('response_cache'))
@@ -1,10 +1,26 @@
-from requests.auth import HTTPBasicAuth
+from concurrent.futures import ThreadPoolExecutor
+from embedding_codec import codec_from_config
+from embedding_batcher import EmbeddingBatcher, batcher_settings
+from ltm_prefetch import BackgroundLTMPrefetcher, prefetcher_settings
+from embedding_cache import EmbeddingCache
+from vector_store import OpenSearchVectorStore
+from rerank import reciprocal_rank_fusion
+from vector_store import LocalVectorStore
+from registry import config_section
+from vector_store import get_es_query
+from registry import get_client
+from tracing import with_trace
+from rerank import get_reranker
+from tracing import annotate
+from registry import shared
+from tracing import traced
+from rerank import rerank
+from tracing import span
 import datetime
-import requests
 import logging
-import boto3
-import yaml
+import time
 import json
+import os
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -12,54 +28,227 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger('log')
 
 
-with open('./config/config.yml', 'r') as file:
-    config = yaml.safe_load(file)
-
-os_username = config['opensearch']['credentials']['username']
-os_password = config['opensearch']['credentials']['password']
-domain_endpoint = config['opensearch']['domain']['endpoint']
-text_embedding_model_endpoint_name = config['jumpstart']['text_embed_endpoint_name']
+text_embedding_model_endpoint_name = config_section('jumpstart')['text_embed_endpoint_name']
 CONTENT_TYPE = 'application/json'
 
-sagemaker_client = boto3.client('runtime.sagemaker')
+retrieval_config = config_section('retrieval')
+RETRIEVAL_BACKEND = retrieval_config.get('backend', 'opensearch')
+vector_stores = {}
+
+passages_config = config_section('retrieval', 'passages')
+PASSAGES_MODE = passages_config.get('mode', 'knn')
+PASSAGES_K = passages_config.get('k', 3)
+PASSAGES_CANDIDATES = passages_config.get('candidates', 20)
+RRF_K = passages_config.get('rrf_k', 60)
+PASSAGES_MIN_SCORE = passages_config.get('min_score')
+if PASSAGES_MODE == 'hybrid' and RETRIEVAL_BACKEND == 'local':
+    logger.warning('Hybrid passage retrieval needs OpenSearch, the local backend serves k-NN only')
+PASSAGES_HYBRID = PASSAGES_MODE == 'hybrid' and RETRIEVAL_BACKEND != 'local'
+if PASSAGES_MIN_SCORE is not None and PASSAGES_HYBRID and passages_config.get('reranker', 'none') == 'none':
+    logger.warning('Passage min_score is not applied to hybrid results without a reranker')
+
+past_config = config_section('retrieval', 'past')
+PAST_K = past_config.get('k', 3)
+PAST_CANDIDATES = past_config.get('candidates', 20)
+PAST_HALF_LIFE_DAYS = past_config.get('half_life_days')
+PAST_WINDOW_DAYS = past_config.get('window_days')
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Per-index projection/quantization, which must match what the writer of the index applied
+embedding_codecs = {index: codec_from_config(codec_config)
+                    for index, codec_config in config_section('embedding_codecs').items()}
+identity_codec = codec_from_config({})
+
+cache_config = config_section('embedding_cache')
+embedding_cache = EmbeddingCache(max_bytes=cache_config.get('max_bytes', 64 * 1024 * 1024),
+                                 disk_dir=cache_config.get('disk_dir'),
+                                 namespace=text_embedding_model_endpoint_name)
+# Keyword arguments of the embedding batchers, None when concurrent queries are embedded one call each
+EMBEDDING_BATCHER_SETTINGS = batcher_settings(config_section('embedding_batcher'))
+# Keyword arguments of the LTM prefetchers, None when /past and /verified only search once they arrive
+LTM_PREFETCH_SETTINGS = prefetcher_settings(config_section('ltm_prefetch'))
+
+
+def new_search_client():
+    # Imported here so that deployments on the local backend never load requests
+    from search_client import OpenSearchClient
+    opensearch_config = config_section('opensearch')
+    connection_config = opensearch_config.get('connection') or {}
+    return OpenSearchClient(opensearch_config['domain']['endpoint'],
+                            opensearch_config['credentials']['username'],
+                            opensearch_config['credentials']['password'],
+                            pool_size=connection_config.get('pool_size', 10),
+                            max_retries=connection_config.get('max_retries', 3),
+                            backoff_factor=connection_config.get('backoff_factor', 0.2),
+                            timeout=connection_config.get('timeout', 10))
+
+
+def get_search_client():
+    """
+    The pooled OpenSearch client shared by every search of the process, connected on first use.
+    """
+    return shared('opensearch', new_search_client)
+
+
+def get_passage_reranker():
+    """
+    The configured passage reranker, or None. A cross-encoder model is only loaded by the first reranked query.
+    """
+    return shared('passage_reranker', lambda: get_reranker(passages_config.get('reranker'),
+                                                           passages_config.get('cross_encoder_model')))
+
 
+def get_embedding_batcher():
+    """
+    The embedding batcher shared by every session of the process, or None when `embedding_batcher` is disabled.
+    """
+    if EMBEDDING_BATCHER_SETTINGS is None:
+        return None
+    return shared('embedding_batcher', lambda: EmbeddingBatcher(invoke_text_embedding_batch,
+                                                                **EMBEDDING_BATCHER_SETTINGS))
 
+
+def get_ltm_prefetcher():
+    """
+    The LTM prefetcher shared by every session of the process, or None when `ltm_prefetch` is disabled.
+    """
+    if LTM_PREFETCH_SETTINGS is None:
+        return None
+    return shared('ltm_prefetcher', lambda: BackgroundLTMPrefetcher(prefetch_ltm, **LTM_PREFETCH_SETTINGS))
+
+
+@traced('retrieve.encode_query')
 def encode_query(query: str) -> list:
-    payload = {'text_inputs': [query]}
-    payload = json.dumps(payload).encode('utf-8')
-    response = sagemaker_client.invoke_endpoint(EndpointName=text_embedding_model_endpoint_name,
-                                                ContentType='application/json',
-                                                Body=payload)
-    body = json.loads(response['Body'].read())
-    embedding = body['embedding'][0]
-    return embedding
+    batcher = get_embedding_batcher()
+    return embedding_cache.get_or_compute(query, batcher.embed if batcher else invoke_text_embedding_endpoint)
+
+
+def encode_query_in_background(query: str):
+    """
+    Start embedding `query` on a worker thread shared by every session, so that it overlaps the turn's other I/O.
+    :return: Future of the embedding
+    """
+    executor = shared('query_encoder', lambda: ThreadPoolExecutor(max_workers=8, thread_name_prefix='encode-query'))
+    return executor.submit(with_trace(encode_query), query)
+
+
+def build_embedding_payload(texts: list) -> bytes:
+    payload = {'text_inputs': texts}
+    return json.dumps(payload).encode('utf-8')
+
+
+def invoke_text_embedding_endpoint(query: str) -> list:
+    return invoke_text_embedding_batch([query])[0]
+
+
+def invoke_text_embedding_batch(texts: list) -> list:
+    """
+    :return: Embeddings of `texts`, in order, from one endpoint invocation
+    """
+    payload = build_embedding_payload(texts)
+    client = get_client('sagemaker-runtime')
+    with span('sagemaker.embed', request_bytes=len(payload), items=len(texts)) as call:
+        response = client.invoke_endpoint(EndpointName=text_embedding_model_endpoint_name,
+                                          ContentType='application/json',
+                                          Body=payload)
+        body = response['Body'].read()
+        call.set(response_bytes=len(body))
+    return json.loads(body)['embedding']
+
 
+def get_embedding_codec(index: str):
+    return embedding_codecs.get(index, identity_codec)
 
-def get_es_query(embedding: list, k) -> dict:
+
+def get_vector_store(index: str):
+    """
+    Return the k-NN backend configured under `retrieval` for the index, creating it on first use.
+    """
+    if index not in vector_stores:
+        if RETRIEVAL_BACKEND == 'local':
+            codec = get_embedding_codec(index)
+            vector_stores[index] = LocalVectorStore(os.path.join(retrieval_config['local_dir'], index),
+                                                    dimension=codec.dimension or retrieval_config.get('dimension',
+                                                                                                      4096),
+                                                    space=retrieval_config.get('space', 'l2'),
+                                                    nprobe=retrieval_config.get('nprobe', 8),
+                                                    dtype=codec.dtype)
+        else:
+            vector_stores[index] = OpenSearchVectorStore(get_search_client(), index)
+    return vector_stores[index]
+
+
+def strip_task_prefix(query: str) -> str:
+    for prefix in ('/verified', '\\verified', '/past', '\\past'):
+        if query.startswith(prefix):
+            return query[len(prefix):].strip()
+    return query
+
+
+def get_bm25_query(text: str, k, field: str) -> dict:
     query = {
         'size': k,
         'query': {
-            'knn': {
-                'embedding': {
-                    'vector': embedding,
-                    'k': k
-                }
+            'match': {
+                field: text
             }
         }
     }
     return query
 
 
+def search_hybrid(index: str, text: str, embedding: list, k) -> list:
+    """
+    Run the k-NN and BM25 queries in one _msearch round trip and fuse their rankings with RRF.
+    """
+    responses = get_search_client().msearch([(index, get_es_query(embedding, k)),
+                                             (index, get_bm25_query(text, k, 'passage'))])
+    result_lists = []
+    for response in responses:
+        if 'error' in response:
+            logger.error(f'Hybrid search leg failed: {response["error"]}')
+            continue
+        result_lists.append(response['hits']['hits'])
+    return reciprocal_rank_fusion(result_lists, RRF_K)
+
+
+@traced('retrieve.retrieve_top_matching_passages')
 def retrieve_top_matching_passages(query: str, index: str) -> list:
+    """
+    Retrieve passages by k-NN or, in hybrid mode, by fused k-NN + BM25, optionally rerank a larger candidate pool,
+    and drop passages scoring below `min_score` (see select_passages) so they never reach answer generation.
+    """
+    text = strip_task_prefix(query)
+    passages = select_passages(text, search_passages(index, text, encode_query(query)))
+    annotate(items=len(passages))
+    return passages
+
+
+def search_passages(index: str, text: str, embedding: list) -> list:
+    """
+    The candidate pool of passages for a /verified query, before selection.
+    """
+    embedding = get_embedding_codec(index).encode(embedding)
+    reranked = get_passage_reranker() is not None
+    pool_size = max(PASSAGES_K, PASSAGES_CANDIDATES) if PASSAGES_HYBRID or reranked else PASSAGES_K
+    if PASSAGES_HYBRID:
+        return search_hybrid(index, text, embedding, pool_size)
+    return get_vector_store(index).search(embedding, pool_size)
+
+
+def select_passages(text: str, hits: list) -> list:
+    """
+    Rerank candidate hits if configured, drop those below `min_score` and keep the top `k` as
+    [passage, doc_id, passage_id] lists. `min_score` filters reranker scores or, without a reranker, k-NN scores;
+    hybrid results that are not reranked are kept whatever their score, since RRF scores only reflect ranks.
+    """
     passages = []
-    embedding = encode_query(query)
-    query = get_es_query(embedding, 3)
-    url = f'{domain_endpoint}/{index}/_search'
-    response = requests.post(url, auth=HTTPBasicAuth(os_username, os_password), json=query)
-    response_json = response.json()
-    hits = response_json['hits']['hits']
-    for hit in hits:
-        # score = hit['_score']
+    passage_reranker = get_passage_reranker()
+    if passage_reranker is not None and hits:
+        hits = rerank(passage_reranker, text, hits, 'passage')
+    if PASSAGES_MIN_SCORE is not None and (passage_reranker is not None or not PASSAGES_HYBRID):
+        hits = [hit for hit in hits if hit['_score'] >= PASSAGES_MIN_SCORE]
+    for hit in hits[:PASSAGES_K]:
         passage = hit['_source']['passage']
         doc_id = hit['_source']['doc_id']
         passage_id = hit['_source']['passage_id']
@@ -67,33 +256,110 @@ def retrieve_top_matching_passages(query: str, index: str) -> list:
     return passages
 
 
-def retrieve_top_matching_past_conversations(query: str, index: str) -> list:
-    past_conversations = {}
-    embedding = encode_query(query)
-    query = get_es_query(embedding, 3)
-    url = f'{domain_endpoint}/{index}/_search'
-    response = requests.post(url, auth=HTTPBasicAuth(os_username, os_password), json=query)
-    response_json = response.json()
-    hits = response_json['hits']['hits']
+def past_conversations_filters(user_id: str = None, since: int = None, until: int = None) -> list:
+    """
+    k-NN filter clauses for /past: the conversations of `user_id` (all of them when None) that ended between
+    `since` and `until` (epoch ms). Without `since`, the last `window_days` are searched when configured.
+    """
+    filters = []
+    if user_id is not None:
+        filters.append({'term': {'user_id': user_id}})
+    if since is None and PAST_WINDOW_DAYS:
+        since = int(time.time() * 1000) - int(PAST_WINDOW_DAYS * DAY_MS)
+    window = {bound: limit for bound, limit in (('gte', since), ('lte', until)) if limit is not None}
+    if window:
+        filters.append({'range': {'created_at': window}})
+    return filters
+
+
+def past_conversations_decay(now_ms: int = None):
+    """
+    Recency decay for /past: a conversation's score halves with every `half_life_days` of age. None when disabled.
+    """
+    if not PAST_HALF_LIFE_DAYS:
+        return None
+    return {'exp': {'created_at': {'origin': now_ms or int(time.time() * 1000),
+                                   'scale': int(PAST_HALF_LIFE_DAYS * DAY_MS),
+                                   'decay': 0.5}}}
+
+
+def past_conversations_search(user_id: str = None, since: int = None, until: int = None) -> dict:
+    """
+    Keyword arguments of VectorStore.search (and get_es_query) for /past. With the recency decay, the nearest
+    `candidates` are rescored so an older close match can give way to a recent one.
+    """
+    decay = past_conversations_decay()
+    return {'k': max(PAST_K, PAST_CANDIDATES) if decay else PAST_K,
+            'filters': past_conversations_filters(user_id, since, until),
+            'decay': decay,
+            'size': PAST_K}
+
+
+@traced('retrieve.retrieve_top_matching_past_conversations')
+def retrieve_top_matching_past_conversations(query: str, index: str, user_id: str = None, since: int = None,
+                                             until: int = None) -> list:
+    embedding = get_embedding_codec(index).encode(encode_query(query))
+    hits = get_vector_store(index).search(embedding, **past_conversations_search(user_id, since, until))
+    annotate(items=len(hits))
+    return format_past_conversations(hits)
+
+
+def iter_past_conversation_pages(query: str, index: str, k: int, page_size: int = None, user_id: str = None,
+                                 since: int = None, until: int = None):
+    """
+    Page through the `k` best matching past conversations, `page_size` (default `k` of the config) at a time.
+    Each page continues with search_after from the last hit of the previous one, so deep pages cost no more than
+    the first rather than re-fetching every hit before them.
+    :return: Iterator of pages of formatted past conversations
+    """
+    embedding = get_embedding_codec(index).encode(encode_query(query))
+    search = past_conversations_search(user_id, since, until)
+    search.update(k=max(k, search['k']), tiebreaker='session_id')
+    page_size = page_size or PAST_K
+    search_after = None
+    # The k-NN `k` applies per shard, so more than `k` hits may match overall: stop once `k` are returned
+    remaining = k
+    while remaining > 0:
+        search['size'] = min(page_size, remaining)
+        hits = get_vector_store(index).search(embedding, search_after=search_after, **search)
+        if not hits:
+            return
+        yield format_past_conversations(hits)
+        remaining -= len(hits)
+        if len(hits) < search['size']:
+            return
+        search_after = hits[-1]['sort']
+
+
+def prefetch_ltm(session_id: str, text: str) -> dict:
+    """
+    What a /past or /verified follow-up on `text` would retrieve in the app, for its LTM prefetcher. Like the app's
+    /past, past conversations of every user are searched.
+    """
+    with span('ltm.prefetch') as call:
+        cached = embedding_cache.get(text) is not None
+        embedding = encode_query(text)
+        past = get_vector_store('conversations').search(get_embedding_codec('conversations').encode(embedding),
+                                                        **past_conversations_search())
+        passages = search_passages('passages', text, embedding)
+        # The embedding, unless cached, and one search per index
+        calls = 2 if cached else 3
+        call.set(calls=calls)
+    return {'embedding': embedding, 'past': past, 'passages': passages, 'calls': calls}
+
 
-    for hit in hits:
-        # score = hit['_score']
+def format_past_conversations(hits: list) -> list:
+    """
+    Summaries of the past conversations, most recent first. Conversations that ended in the same millisecond are
+    all kept.
+    """
+    past_conversations = []
+    for hit in sorted(hits, key=lambda hit: int(hit['_source']['created_at']), reverse=True):
         conversation_summary = hit['_source']['conversation_summary']
-        created_at_ms = hit['_source']['created_at']
-        created_at = datetime.datetime.fromtimestamp(int(created_at_ms) / 1000.0)
-        created_at = created_at.strftime('%Y-%m-%d %H:%M:%S')
-        date, time = created_at.split(' ')
-        # session_id = hit['_source']['session_id']
-        summary = f'[{date}][{time}] {conversation_summary}'
-        past_conversations[int(created_at_ms)] = summary
-
-    sorted_past_conversations = {}
-    for key in sorted(past_conversations.keys()):
-        sorted_past_conversations[key] = past_conversations[key]
-
-    sorted_conversations = list(sorted_past_conversations.values())
-    sorted_conversations.reverse()
-    return sorted_conversations
+        created_at = datetime.datetime.fromtimestamp(int(hit['_source']['created_at']) / 1000.0)
+        date, time_of_day = created_at.strftime('%Y-%m-%d %H:%M:%S').split(' ')
+        past_conversations.append(f'[{date}][{time_of_day}] {conversation_summary}')
+    return past_conversations
 
 
 if __name__ == '__main__':
@@ -0,0 +1,121 @@
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+from tracing import payload_size
+from tracing import percentile
+from collections import deque
+from tracing import span
+import threading
+import requests
+import logging
+import json
+import time
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RequestMetrics:
+    """
+    Per-operation request counts, errors and latencies (a bounded window of recent samples for percentiles).
+    """
+
+    def __init__(self, window: int = 1024):
+        self.window = window
+        self._samples = {}
+        self._counts = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation: str, seconds: float, error: bool = False) -> None:
+        with self._lock:
+            self._samples.setdefault(operation, deque(maxlen=self.window)).append(seconds)
+            self._counts[operation] = self._counts.get(operation, 0) + 1
+            if error:
+                self._errors[operation] = self._errors.get(operation, 0) + 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {}
+            for operation, samples in self._samples.items():
+                ordered = sorted(samples)
+                stats[operation] = {
+                    'count': self._counts[operation],
+                    'errors': self._errors.get(operation, 0),
+                    'p50_ms': percentile(ordered, 0.50) * 1000,
+                    'p95_ms': percentile(ordered, 0.95) * 1000,
+                    'p99_ms': percentile(ordered, 0.99) * 1000,
+                    'max_ms': ordered[-1] * 1000
+                }
+            return stats
+
+
+class OpenSearchClient:
+    """
+    Thin OpenSearch HTTP client over one pooled keep-alive session, so queries reuse TLS connections instead of
+    handshaking per request. 429/5xx responses and connection errors are retried with exponential backoff.
+    """
+
+    def __init__(self, endpoint: str, username: str, password: str, pool_size: int = 10, max_retries: int = 3,
+                 backoff_factor: float = 0.2, timeout: float = 10.0):
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = timeout
+        self.metrics = RequestMetrics()
+        retry = Retry(total=max_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=None,  # searches and _id-keyed bulk writes are safe to repeat
+                      respect_retry_after_header=True,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(username, password)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method: str, path: str, operation: str = None, **kwargs) -> requests.Response:
+        operation = operation or f'{method} {path}'
+        kwargs.setdefault('timeout', self.timeout)
+        request_bytes = payload_size(kwargs.get('data', kwargs.get('json')))
+        start = time.perf_counter()
+        with span(f'opensearch.{operation}', request_bytes=request_bytes) as call:
+            try:
+                response = self.session.request(method, f'{self.endpoint}/{path.lstrip("/")}', **kwargs)
+            except requests.RequestException:
+                self.metrics.record(operation, time.perf_counter() - start, error=True)
+                raise
+            call.set(response_bytes=len(response.content), status=response.status_code)
+        self.metrics.record(operation, time.perf_counter() - start, error=response.status_code >= 400)
+        return response
+
+    def search(self, index: str, query: dict) -> dict:
+        response = self.request('POST', f'{index}/_search', operation='search', json=query)
+        response.raise_for_status()
+        return response.json()
+
+    def msearch(self, searches: list) -> list:
+        """
+        Run several (index, query) searches in one round trip.
+        :return: One response per search, in order; a failed search carries an `error` key instead of hits
+        """
+        lines = []
+        for index, query in searches:
+            lines.append(json.dumps({'index': index}))
+            lines.append(json.dumps(query))
+        body = '\n'.join(lines) + '\n'
+        response = self.request('POST', '_msearch', operation='msearch', data=body.encode('utf-8'),
+                                headers={'Content-Type': 'application/x-ndjson'})
+        response.raise_for_status()
+        return response.json()['responses']
+
+    def bulk(self, body: str) -> requests.Response:
+        return self.request('POST', '_bulk', operation='bulk', data=body.encode('utf-8'),
+                            headers={'Content-Type': 'application/x-ndjson'})
+
+    def close(self) -> None:
+        self.session.close()
@@ -0,0 +1,215 @@
+from ddb import history_buffers, history_buffers_lock, buffer_session, drop_session_buffer, buffered_turns
+from ddb import turn_counters_update, end_session_update, is_conditional_check_failure, new_session_item
+from ddb import HISTORY_BUFFER_TURNS, merge_queued_turns
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Key
+from prompt import count_tokens
+import asyncio
+import logging
+import time
+import uuid
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+class SessionNotFound(Exception):
+    """
+    The session is unknown, or already ended.
+    """
+
+
+def new_turn(session_id: str, user: str, bot: str) -> dict:
+    return {
+        'session_id': session_id,
+        'timestamp': int(time.time() * 1000),
+        'Me': user,
+        'AI': bot
+    }
+
+
+class SessionStore:
+    """
+    Where the async chat core keeps sessions and their turns. `cache_turn` runs inline when a turn completes so the
+    next turn sees it; `put_turn` is the durable write, which the core runs in the background.
+    """
+
+    async def create_session(self, user_id: str = None) -> str:
+        raise NotImplementedError
+
+    async def get_user_id(self, session_id: str):
+        """
+        :return: The user the session was opened for, or None if it was opened anonymously
+        :raise SessionNotFound: If the session is unknown or already ended
+        """
+        return None
+
+    async def get_history(self, session_id: str, num_turns: int) -> list:
+        raise NotImplementedError
+
+    def cache_turn(self, turn: dict) -> None:
+        pass
+
+    async def put_turn(self, turn: dict) -> None:
+        raise NotImplementedError
+
+    async def end_session(self, session_id: str) -> dict:
+        """
+        :return: The closed session's end_time, num_turns, user_tokens, bot_tokens and conversation_duration
+        :raise SessionNotFound: If the session is unknown or already ended
+        """
+        raise NotImplementedError
+
+
+def session_summary(session: dict) -> dict:
+    return {name: int(session[name]) for name in ('end_time', 'num_turns', 'user_tokens', 'bot_tokens',
+                                                  'conversation_duration')}
+
+
+class DynamoDBSessionStore(SessionStore):
+    """
+    The `sessions` and `conversations` tables, read through the process-wide rolling history buffer of ddb.py.
+    Tables must be awaitable (aioboto3, or blocking ones wrapped in async_chat.Threaded). With a
+    `write_buffer.TurnWriteBuffer`, turns are queued for batched writes and flushed when their session ends.
+    """
+
+    def __init__(self, sessions_table, conversations_table, write_buffer=None):
+        self.sessions_table = sessions_table
+        self.conversations_table = conversations_table
+        self.write_buffer = write_buffer
+        # Users of the open sessions this process created or looked up, until they end
+        self.user_ids = {}
+
+    async def create_session(self, user_id: str = None) -> str:
+        session_id = str(uuid.uuid4())
+        await self.sessions_table.put_item(Item=new_session_item(session_id, int(time.time() * 1000), user_id))
+        self.user_ids[session_id] = user_id
+        buffer_session(session_id)
+        return session_id
+
+    async def get_user_id(self, session_id: str):
+        if session_id not in self.user_ids:
+            response = await self.sessions_table.get_item(Key={'session_id': session_id},
+                                                          ProjectionExpression='user_id, end_time')
+            item = response.get('Item')
+            if item is None or item.get('end_time') is not None:
+                raise SessionNotFound(f'Session {session_id} is not open')
+            self.user_ids[session_id] = item.get('user_id')
+        return self.user_ids[session_id]
+
+    async def get_history(self, session_id: str, num_turns: int) -> list:
+        # Like the memory store, reject unknown and ended sessions; one read per session and process
+        await self.get_user_id(session_id)
+        num_turns = min(num_turns, HISTORY_BUFFER_TURNS)
+        if num_turns <= 0:
+            return []
+        turns = buffered_turns(session_id, num_turns)
+        if turns is not None:
+            return turns
+        kwargs = {
+            'KeyConditionExpression': Key('session_id').eq(session_id),
+            'ScanIndexForward': False,
+            'Limit': num_turns
+        }
+        turns = []
+        while len(turns) < num_turns:
+            response = await self.conversations_table.query(**kwargs)
+            turns.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response:
+                break
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            kwargs['Limit'] = num_turns - len(turns)
+        turns.reverse()
+        complete = len(turns) < num_turns
+        if self.write_buffer is not None:
+            turns = merge_queued_turns(turns, self.write_buffer.queued_turns(session_id))
+        buffer_session(session_id, turns, complete)
+        return turns[len(turns) - min(num_turns, len(turns)):]
+
+    def cache_turn(self, turn: dict) -> None:
+        with history_buffers_lock:
+            if turn['session_id'] in history_buffers:
+                history_buffers[turn['session_id']].append(turn)
+
+    async def put_turn(self, turn: dict) -> None:
+        # A turn of an unknown or ended session would be left in `conversations` without a session to summarize it
+        await self.get_user_id(turn['session_id'])
+        if self.write_buffer is not None:
+            self.write_buffer.add(turn)
+            return
+
+        async def count():
+            try:
+                await self.sessions_table.update_item(**turn_counters_update(turn))
+            except ClientError as e:
+                if not is_conditional_check_failure(e):
+                    raise
+                logger.warning(f'Turn stored for unknown or closed session {turn["session_id"]}, its counters were '
+                               f'not updated')
+        await asyncio.gather(self.conversations_table.put_item(Item=turn), count())
+
+    async def end_session(self, session_id: str) -> dict:
+        if self.write_buffer is not None:
+            # The session's turns and counters must land before the close the session-end Lambda reacts to
+            await asyncio.to_thread(self.write_buffer.flush)
+        try:
+            response = await self.sessions_table.update_item(**end_session_update(session_id,
+                                                                                   int(time.time() * 1000)))
+        except ClientError as e:
+            if not is_conditional_check_failure(e):
+                raise
+            raise SessionNotFound(f'Session {session_id} is not open')
+        finally:
+            drop_session_buffer(session_id)
+            self.user_ids.pop(session_id, None)
+        return session_summary(response['Attributes'])
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions held in this process only, for load tests and single-node deployments that do not need the session-end
+    Lambda. Ended sessions are forgotten.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+
+    async def create_session(self, user_id: str = None) -> str:
+        session_id = str(uuid.uuid4())
+        self.sessions[session_id] = {'start_time': int(time.time() * 1000), 'turns': [], 'user_tokens': 0,
+                                     'bot_tokens': 0, 'user_id': user_id}
+        return session_id
+
+    async def get_user_id(self, session_id: str):
+        return self._session(session_id)['user_id']
+
+    def _session(self, session_id: str) -> dict:
+        if session_id not in self.sessions:
+            raise SessionNotFound(f'Unknown session: {session_id}')
+        return self.sessions[session_id]
+
+    async def get_history(self, session_id: str, num_turns: int) -> list:
+        turns = self._session(session_id)['turns']
+        return turns[len(turns) - min(num_turns, len(turns)):]
+
+    def cache_turn(self, turn: dict) -> None:
+        session = self._session(turn['session_id'])
+        session['turns'].append(turn)
+        session['user_tokens'] += count_tokens(turn['Me'])
+        session['bot_tokens'] += count_tokens(turn['AI'])
+
+    async def put_turn(self, turn: dict) -> None:
+        pass
+
+    async def end_session(self, session_id: str) -> dict:
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            raise SessionNotFound(f'Unknown session: {session_id}')
+        end_time = int(time.time() * 1000)
+        return session_summary({'end_time': end_time,
+                                'num_turns': len(session['turns']),
+                                'user_tokens': session['user_tokens'],
+                                'bot_tokens': session['bot_tokens'],
+                                'conversation_duration': end_time - session['start_time']})
@@ -0,0 +1,254 @@
+from contextlib import contextmanager
+from collections import deque
+import contextvars
+import functools
+import threading
+import logging
+import time
+import uuid
+import math
+import json
+import sys
+import os
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+# Numeric span attributes published as metrics, with their CloudWatch unit; any other attribute is a property
+METRIC_UNITS = {
+    'duration_ms': 'Milliseconds',
+    'first_token_ms': 'Milliseconds',
+    'request_bytes': 'Bytes',
+    'response_bytes': 'Bytes',
+    'prompt_tokens': 'Count',
+    'completion_tokens': 'Count',
+    'items': 'Count'
+}
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+current_span = contextvars.ContextVar('current_span', default=None)
+sinks = []
+
+
+class Span:
+    """
+    One timed operation: its name, the trace and session it belongs to, the wall time it took and whatever was
+    attached with `set` (payload bytes, token counts, ...).
+    """
+
+    def __init__(self, name: str, attributes: dict):
+        trace = current_trace.get() or {}
+        self.name = name
+        self.trace_id = trace.get('trace_id')
+        self.session_id = trace.get('session_id')
+        self.attributes = attributes
+        self.error = None
+        self.timestamp = time.time()
+        self.duration_ms = None
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {'name': self.name,
+                'trace_id': self.trace_id,
+                'session_id': self.session_id,
+                'timestamp': self.timestamp,
+                'duration_ms': self.duration_ms,
+                'error': self.error,
+                **self.attributes}
+
+
+@contextmanager
+def trace(trace_id: str = None, session_id: str = None):
+    """
+    Tag every span recorded inside the block (including in worker threads started through `with_trace`) with
+    one trace id, and the session id when given. Without a `trace_id` the enclosing trace is continued, or a new
+    one is started at the top level.
+    """
+    enclosing = current_trace.get() or {}
+    token = current_trace.set({'trace_id': trace_id or enclosing.get('trace_id') or uuid.uuid4().hex,
+                               'session_id': session_id or enclosing.get('session_id')})
+    try:
+        yield current_trace.get()['trace_id']
+    finally:
+        current_trace.reset(token)
+
+
+def with_trace(function):
+    """
+    Bind `function` to the trace active where this is called, for running it on another thread.
+    """
+    trace_context = current_trace.get()
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        token = current_trace.set(trace_context)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_trace.reset(token)
+    return run
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Time the block as a span named `name` and hand it to every sink. Attach payload sizes and token counts with
+    `span.set(...)` on the yielded span, or `annotate(...)` from code further down the call.
+    """
+    recorded = Span(name, attributes)
+    token = current_span.set(recorded)
+    start = time.perf_counter()
+    try:
+        yield recorded
+    except BaseException as e:
+        recorded.error = type(e).__name__
+        raise
+    finally:
+        recorded.duration_ms = (time.perf_counter() - start) * 1000
+        current_span.reset(token)
+        emit(recorded)
+
+
+def traced(name: str = None, **attributes):
+    """
+    Decorator form of `span`, named after the function unless `name` is given.
+    """
+    def decorate(function):
+        span_name = name or f'{function.__module__}.{function.__name__}'
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attributes):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def annotate(**attributes) -> None:
+    """
+    Attach attributes to the innermost open span, if any.
+    """
+    recorded = current_span.get()
+    if recorded is not None:
+        recorded.set(**attributes)
+
+
+def payload_size(payload) -> int:
+    if payload is None:
+        return 0
+    if isinstance(payload, (bytes, bytearray)):
+        return len(payload)
+    if isinstance(payload, str):
+        return len(payload.encode('utf-8'))
+    return len(json.dumps(payload, default=str).encode('utf-8'))
+
+
+def emit(recorded: Span) -> None:
+    for sink in sinks:
+        try:
+            sink.record(recorded)
+        except Exception as e:
+            # Instrumentation must never fail the call it measures
+            logger.warning(f'Tracing sink {type(sink).__name__} failed: {e}')
+
+
+def percentile(ordered: list, fraction: float):
+    """
+    Nearest-rank percentile of sorted samples: never below the median, however few samples there are.
+    """
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+class InMemorySink:
+    """
+    Keeps the most recent `max_spans` spans, for tests, benchmarks and ad-hoc inspection.
+    """
+
+    def __init__(self, max_spans: int = 10000):
+        self.spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def record(self, recorded: Span) -> None:
+        with self._lock:
+            self.spans.append(recorded)
+
+    def find(self, name: str = None, trace_id: str = None) -> list:
+        with self._lock:
+            return [s for s in self.spans
+                    if (name is None or s.name == name) and (trace_id is None or s.trace_id == trace_id)]
+
+    def summary(self) -> dict:
+        """
+        :return: Per span name: count, errors and duration percentiles in milliseconds
+        """
+        with self._lock:
+            durations = {}
+            errors = {}
+            for s in self.spans:
+                durations.setdefault(s.name, []).append(s.duration_ms)
+                errors[s.name] = errors.get(s.name, 0) + (s.error is not None)
+        summary = {}
+        for name, samples in durations.items():
+            ordered = sorted(samples)
+            summary[name] = {'count': len(ordered),
+                             'errors': errors[name],
+                             'p50_ms': percentile(ordered, 0.50),
+                             'p95_ms': percentile(ordered, 0.95),
+                             'p99_ms': percentile(ordered, 0.99),
+                             'max_ms': ordered[-1]}
+        return summary
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
+
+
+class EMFSink:
+    """
+    Writes each span as one CloudWatch Embedded Metric Format line on stdout, which Lambda and the CloudWatch
+    agent turn into metrics dimensioned by operation; trace and session ids ride along as searchable properties.
+    """
+
+    def __init__(self, namespace: str = 'ai-assistant', stream=None):
+        self.namespace = namespace
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def record(self, recorded: Span) -> None:
+        document = recorded.to_dict()
+        metrics = [{'Name': name, 'Unit': unit} for name, unit in METRIC_UNITS.items()
+                   if isinstance(document.get(name), (int, float)) and not isinstance(document.get(name), bool)]
+        document['Operation'] = document.pop('name')
+        document['_aws'] = {'Timestamp': int(recorded.timestamp * 1000),
+                            'CloudWatchMetrics': [{'Namespace': self.namespace,
+                                                   'Dimensions': [['Operation']],
+                                                   'Metrics': metrics}]}
+        line = json.dumps(document, default=str) + '\n'
+        with self._lock:
+            stream = self.stream or sys.stdout
+            stream.write(line)
+            stream.flush()
+
+
+def sinks_from_names(names: str, namespace: str = 'ai-assistant') -> list:
+    """
+    Build sinks from a comma-separated list of `emf` and `memory`.
+    """
+    built = []
+    for name in filter(None, (name.strip() for name in (names or '').split(','))):
+        if name == 'emf':
+            built.append(EMFSink(namespace))
+        elif name == 'memory':
+            built.append(InMemorySink())
+        else:
+            raise ValueError(f'Unsupported tracing sink: {name}')
+    return built
+
+
+# Configured from the environment so the app, the chat service and the Lambda are all switched on the same way
+sinks.extend(sinks_from_names(os.environ.get('TRACING_SINKS'), os.environ.get('TRACING_NAMESPACE', 'ai-assistant')))
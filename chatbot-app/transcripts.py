@@ -0,0 +1,244 @@
+from boto3.dynamodb.conditions import Key
+import threading
+import argparse
+import logging
+import struct
+import zlib
+import io
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+# A blob is MAGIC, one codec byte, then one compressed stream of records: timestamp, byte lengths of the user and
+# bot utterances (big-endian uint64, uint32, uint32), then the two UTF-8 utterances
+MAGIC = b'TRN1'
+CODECS = {'gzip': b'g', 'zstd': b'z'}
+HEADER_BYTES = len(MAGIC) + 1
+RECORD_HEADER = struct.Struct('>QII')
+READ_CHUNK_BYTES = 64 * 1024
+# DynamoDB items are capped at 400 KB, leave room for the key and attribute names
+PART_BYTES = 350 * 1024
+
+
+def new_compressor(codec: str, level: int = None):
+    if codec == 'gzip':
+        return zlib.compressobj(level if level is not None else 6, zlib.DEFLATED, 31)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd transcripts require zstandard')
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+    raise ValueError(f'Unsupported transcript codec: {codec}')
+
+
+def new_decompressor(codec_id: bytes):
+    if codec_id == CODECS['gzip']:
+        return zlib.decompressobj(31)
+    if codec_id == CODECS['zstd']:
+        if zstandard is None:
+            raise ImportError('zstd transcripts require zstandard')
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f'Unsupported transcript codec id: {codec_id!r}')
+
+
+def encode_transcript(turns, codec: str = 'gzip', level: int = None) -> bytes:
+    """
+    Pack turns (dicts with `timestamp`, `Me` and `AI`, in chronological order) into one compressed blob.
+    """
+    compressor = new_compressor(codec, level)
+    blob = io.BytesIO()
+    blob.write(MAGIC + CODECS[codec])
+    for turn in turns:
+        user = turn['Me'].encode('utf-8')
+        bot = turn['AI'].encode('utf-8')
+        blob.write(compressor.compress(RECORD_HEADER.pack(int(turn['timestamp']), len(user), len(bot))))
+        blob.write(compressor.compress(user))
+        blob.write(compressor.compress(bot))
+    blob.write(compressor.flush())
+    return blob.getvalue()
+
+
+def iter_transcript(chunks, session_id: str = None):
+    """
+    Decode a blob lazily, from the whole blob or any iterable of its consecutive byte chunks, so only the turns
+    not yet consumed and one chunk are held in memory.
+    :return: Iterator of turns shaped like `conversations` items
+    :raise ValueError: If the blob is not a transcript or is truncated
+    """
+    if isinstance(chunks, (bytes, bytearray, memoryview)):
+        chunks = [chunks]
+    header = bytearray()
+    decompressor = None
+    buffer = bytearray()
+    for chunk in chunks:
+        if decompressor is None:
+            header.extend(chunk)
+            if len(header) < HEADER_BYTES:
+                continue
+            if header[:len(MAGIC)] != MAGIC:
+                raise ValueError('Not a transcript blob')
+            decompressor = new_decompressor(bytes(header[len(MAGIC):HEADER_BYTES]))
+            chunk = bytes(header[HEADER_BYTES:])
+        buffer.extend(decompressor.decompress(chunk))
+        position = 0
+        while len(buffer) - position >= RECORD_HEADER.size:
+            timestamp, user_bytes, bot_bytes = RECORD_HEADER.unpack_from(buffer, position)
+            start = position + RECORD_HEADER.size
+            end = start + user_bytes + bot_bytes
+            if len(buffer) < end:
+                break
+            yield {'session_id': session_id,
+                   'timestamp': timestamp,
+                   'Me': buffer[start:start + user_bytes].decode('utf-8'),
+                   'AI': buffer[start + user_bytes:end].decode('utf-8')}
+            position = end
+        del buffer[:position]
+    # A blob cut on a record boundary (a lost trailer or last part) only shows in the stream never ending
+    if decompressor is None or buffer or not decompressor.eof:
+        raise ValueError('Truncated transcript blob')
+
+
+class TranscriptStore:
+    """
+    Where packed transcripts of closed sessions are kept, one blob per session.
+    """
+
+    def put(self, session_id: str, blob: bytes) -> None:
+        raise NotImplementedError
+
+    def chunks(self, session_id: str):
+        """
+        :return: Iterator over the consecutive byte chunks of the session's blob, or None if it was not archived
+        """
+        raise NotImplementedError
+
+    def turns(self, session_id: str):
+        """
+        :return: Iterator decoding the session's turns lazily, or None if it was not archived
+        """
+        chunks = self.chunks(session_id)
+        return iter_transcript(chunks, session_id) if chunks is not None else None
+
+
+class LocalTranscriptStore(TranscriptStore):
+    """
+    One `<session_id>.trn` file per session, fanned out over sub-directories by id prefix.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, session_id[:2], f'{session_id}.trn')
+
+    def put(self, session_id: str, blob: bytes) -> None:
+        path = self._path(session_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        # Readers only ever see a complete blob
+        os.replace(tmp_path, path)
+
+    def chunks(self, session_id: str):
+        path = self._path(session_id)
+        if not os.path.exists(path):
+            return None
+
+        def read():
+            with open(path, 'rb') as f:
+                while True:
+                    chunk = f.read(READ_CHUNK_BYTES)
+                    if not chunk:
+                        return
+                    yield chunk
+        return read()
+
+
+class DynamoDBTranscriptStore(TranscriptStore):
+    """
+    Blobs in a table keyed by `session_id` (HASH, S) and `part` (RANGE, N), split into parts that fit the item
+    size limit. Part 0 is written last and records the number of parts, so a blob is only visible once complete.
+    """
+
+    def __init__(self, table, part_bytes: int = PART_BYTES):
+        self.table = table
+        self.part_bytes = part_bytes
+
+    def put(self, session_id: str, blob: bytes) -> None:
+        parts = [blob[start:start + self.part_bytes] for start in range(0, len(blob), self.part_bytes)] or [b'']
+        with self.table.batch_writer() as batch:
+            for number, part in enumerate(parts[1:], start=1):
+                batch.put_item(Item={'session_id': session_id, 'part': number, 'data': part})
+        self.table.put_item(Item={'session_id': session_id, 'part': 0, 'data': parts[0], 'parts': len(parts)})
+
+    def chunks(self, session_id: str):
+        kwargs = {'KeyConditionExpression': Key('session_id').eq(session_id), 'Limit': 1}
+        response = self.table.query(**kwargs)
+        if not response['Items'] or 'parts' not in response['Items'][0]:
+            return None
+        first = response['Items'][0]
+
+        def read():
+            yield bytes(first['data'])
+            received = 1
+            page = response
+            while 'LastEvaluatedKey' in page and received < first['parts']:
+                # Parts are at most PART_BYTES each, so a page of a few keeps the memory held bounded
+                page = self.table.query(KeyConditionExpression=Key('session_id').eq(session_id),
+                                        ExclusiveStartKey=page['LastEvaluatedKey'], Limit=4)
+                for item in page['Items']:
+                    received += 1
+                    yield bytes(item['data'])
+            if received != first['parts']:
+                raise ValueError(f'Transcript of {session_id} has {received} of {first["parts"]} parts')
+        return read()
+
+
+def archive_turns(store: TranscriptStore, session_id: str, turns: list, codec: str = 'gzip',
+                  conversations_table=None) -> int:
+    """
+    Pack a closed session's turns into its blob and, given the conversations table, delete the per-turn items
+    once the blob is stored.
+    :return: Size of the blob in bytes
+    """
+    blob = encode_transcript(turns, codec)
+    store.put(session_id, blob)
+    if conversations_table is not None:
+        with conversations_table.batch_writer() as batch:
+            for turn in turns:
+                batch.delete_item(Key={'session_id': session_id, 'timestamp': turn['timestamp']})
+    return len(blob)
+
+
+def get_transcript_store(kind: str, table=None, directory: str = None):
+    """
+    :return: The transcript store of the given kind (`dynamodb` over `table`, or `local` under `directory`), or
+             None for `none`
+    """
+    if not kind or kind == 'none':
+        return None
+    if kind == 'dynamodb':
+        return DynamoDBTranscriptStore(table)
+    if kind == 'local':
+        return LocalTranscriptStore(directory)
+    raise ValueError(f'Unsupported transcript store: {kind}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the turns of a transcript blob file')
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    with open(args.path, 'rb') as f:
+        for turn_ in iter_transcript(iter(lambda: f.read(READ_CHUNK_BYTES), b'')):
+            logger.info(f"[{turn_['timestamp']}] Me: {turn_['Me']} | AI: {turn_['AI']}")
@@ -0,0 +1,339 @@
+import threading
+import argparse
+import operator
+import logging
+import json
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+
+VECTORS_FILE = 'vectors.bin'
+METADATA_FILE = 'metadata.jsonl'
+IVF_FILE = 'ivf.npz'
+RANGE_OPERATORS = {'gt': operator.gt, 'gte': operator.ge, 'lt': operator.lt, 'lte': operator.le}
+
+
+def get_es_query(embedding: list, k, filters: list = None, decay: dict = None, size: int = None,
+                 search_after: list = None, tiebreaker: str = None) -> dict:
+    """
+    k-NN query for the `k` nearest neighbours. `filters` (term and range clauses) are applied inside the k-NN search,
+    so all `k` hits match them (needs the lucene or faiss engine); `decay`, a function_score decay function, is
+    multiplied into the scores of those hits. With `tiebreaker`, hits are sorted by score then that field, and
+    `search_after` continues from the `sort` values of the last hit of a previous page of `size`.
+    """
+    knn = {
+        'vector': embedding,
+        'k': k
+    }
+    if filters:
+        knn['filter'] = {'bool': {'filter': filters}}
+    query = {
+        'knn': {
+            'embedding': knn
+        }
+    }
+    if decay:
+        query = {
+            'function_score': {
+                'query': query,
+                'functions': [decay],
+                'boost_mode': 'multiply'
+            }
+        }
+    body = {
+        'size': size or k,
+        'query': query
+    }
+    if tiebreaker:
+        body['sort'] = [{'_score': 'desc'}, {tiebreaker: 'asc'}]
+        if search_after is not None:
+            body['search_after'] = search_after
+    return body
+
+
+def matches_filters(source: dict, filters: list) -> bool:
+    """
+    Evaluate the term and range clauses of a k-NN filter against a document, as OpenSearch does.
+    """
+    for clause in filters or []:
+        (kind, condition), = clause.items()
+        (field, expected), = condition.items()
+        value = source.get(field)
+        if kind == 'term':
+            if value != expected:
+                return False
+        elif kind == 'range':
+            # Numeric fields only; documents indexed before created_at was numeric hold it as a string
+            if value is None or not all(RANGE_OPERATORS[bound](float(value), limit)
+                                        for bound, limit in expected.items()):
+                return False
+        else:
+            raise ValueError(f'Unsupported filter clause: {kind}')
+    return True
+
+
+def decay_multiplier(source: dict, decay: dict) -> float:
+    """
+    Value of a function_score `exp` decay function for a document: `decay` to the power of its distance from
+    `origin` (beyond `offset`) over `scale`. Documents without the field are not decayed.
+    """
+    (field, params), = decay['exp'].items()
+    value = source.get(field)
+    if value is None:
+        return 1.0
+    distance = max(0.0, abs(float(value) - params['origin']) - params.get('offset', 0))
+    return params.get('decay', 0.5) ** (distance / params['scale'])
+
+
+def page_hits(hits: list, size: int, search_after: list = None, tiebreaker: str = None) -> list:
+    """
+    With a `tiebreaker`, order hits by score then that field, attach their `sort` values and keep those after
+    `search_after`, as a sorted OpenSearch search does. Return the first `size`.
+    """
+    if tiebreaker:
+        for hit in hits:
+            hit['sort'] = [hit['_score'], hit['_source'].get(tiebreaker)]
+        hits = sorted(hits, key=lambda hit: (-hit['sort'][0], hit['sort'][1]))
+        if search_after is not None:
+            hits = [hit for hit in hits if (-hit['sort'][0], hit['sort'][1]) > (-search_after[0], search_after[1])]
+    return hits[:size]
+
+
+class VectorStore:
+    """
+    Interface of a k-NN backend. Hits are returned in the OpenSearch shape (`_id`, `_score`, `_source`) so that
+    callers parse every backend the same way.
+    """
+
+    def search(self, embedding: list, k: int, filters: list = None, decay: dict = None, size: int = None,
+               search_after: list = None, tiebreaker: str = None) -> list:
+        """
+        The `k` nearest neighbours among documents matching `filters`, rescored by `decay` and paged as described
+        in `get_es_query`.
+        """
+        raise NotImplementedError
+
+    def add(self, doc_id: str, embedding: list, source: dict) -> None:
+        self.add_many([(doc_id, embedding, source)])
+
+    def add_many(self, documents: list) -> None:
+        raise NotImplementedError
+
+
+class OpenSearchVectorStore(VectorStore):
+    """
+    k-NN search against an Amazon OpenSearch index.
+    """
+
+    def __init__(self, search_client, index: str):
+        self.search_client = search_client
+        self.index = index
+
+    def search(self, embedding: list, k: int, filters: list = None, decay: dict = None, size: int = None,
+               search_after: list = None, tiebreaker: str = None) -> list:
+        response_json = self.search_client.search(self.index, get_es_query(embedding, k, filters, decay, size,
+                                                                           search_after, tiebreaker))
+        return response_json['hits']['hits']
+
+    def add_many(self, documents: list) -> None:
+        lines = []
+        for doc_id, embedding, source in documents:
+            lines.append(json.dumps({'index': {'_index': self.index, '_id': doc_id}}))
+            lines.append(json.dumps(dict(source, embedding=embedding)))
+        response = self.search_client.bulk('\n'.join(lines) + '\n')
+        response.raise_for_status()
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Local k-NN backend: a memory-mapped float32, float16 or int8 matrix (one row per document, appended in place)
+    with a JSON lines metadata sidecar. Search is exact and vectorized unless an IVF index has been built with
+    `build_ivf`, in which case only the `nprobe` closest inverted lists are scanned. Re-adding an id supersedes
+    its old row. Scores follow the OpenSearch conventions for the configured space, higher is better.
+    """
+
+    def __init__(self, directory: str, dimension: int = 4096, space: str = 'l2', nprobe: int = 8,
+                 dtype: str = 'float32'):
+        if np is None:
+            raise ImportError('LocalVectorStore requires numpy')
+        if space not in ('l2', 'cosinesimil', 'innerproduct'):
+            raise ValueError(f'Unsupported space: {space}')
+        self.directory = directory
+        self.dimension = dimension
+        self.space = space
+        self.nprobe = nprobe
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self) -> None:
+        self.ids = []
+        self.sources = []
+        self.rows_by_id = {}
+        if os.path.exists(self._path(METADATA_FILE)):
+            with open(self._path(METADATA_FILE), 'r') as f:
+                for line in f:
+                    record = json.loads(line)
+                    self.rows_by_id[record['id']] = len(self.ids)
+                    self.ids.append(record['id'])
+                    self.sources.append(record['source'])
+        self.live = np.zeros(len(self.ids), dtype=bool)
+        self.live[list(self.rows_by_id.values())] = True
+        self.matrix = None
+        self.centroids = None
+        self.assignments = None
+        if os.path.exists(self._path(IVF_FILE)):
+            ivf = np.load(self._path(IVF_FILE))
+            self.centroids = ivf['centroids']
+            self.assignments = ivf['assignments']
+
+    def _vectors(self):
+        # Re-mapped lazily after appends, since a memmap cannot grow
+        if self.matrix is None or len(self.matrix) != len(self.ids):
+            if not self.ids:
+                return np.empty((0, self.dimension), dtype=self.dtype)
+            self.matrix = np.memmap(self._path(VECTORS_FILE), dtype=self.dtype, mode='r',
+                                    shape=(len(self.ids), self.dimension))
+        return self.matrix
+
+    def __len__(self) -> int:
+        return int(self.live.sum())
+
+    def add_many(self, documents: list) -> None:
+        if not documents:
+            return
+        vectors = np.asarray([embedding for _, embedding, _ in documents], dtype=self.dtype)
+        if vectors.shape[1] != self.dimension:
+            raise ValueError(f'Expected {self.dimension}-dim embeddings, got {vectors.shape[1]}')
+        with self._lock:
+            with open(self._path(VECTORS_FILE), 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self._path(METADATA_FILE), 'a') as f:
+                for doc_id, _, source in documents:
+                    f.write(json.dumps({'id': doc_id, 'source': source}) + '\n')
+            first_row = len(self.ids)
+            live = np.ones(len(documents), dtype=bool)
+            for offset, (doc_id, _, source) in enumerate(documents):
+                previous = self.rows_by_id.get(doc_id)
+                if previous is not None:
+                    if previous >= first_row:
+                        live[previous - first_row] = False
+                    else:
+                        self.live[previous] = False
+                self.rows_by_id[doc_id] = first_row + offset
+                self.ids.append(doc_id)
+                self.sources.append(source)
+            self.live = np.concatenate([self.live, live])
+            if self.centroids is not None:
+                nearest = self._nearest_centroids(vectors.astype(np.float32), 1)[:, 0]
+                self.assignments = np.concatenate([self.assignments, nearest])
+                self._save_ivf()
+
+    def _scores(self, vectors, query):
+        if self.space == 'l2':
+            distances = np.einsum('ij,ij->i', vectors, vectors) - 2 * vectors @ query + query @ query
+            return 1 / (1 + np.maximum(distances, 0))
+        if self.space == 'cosinesimil':
+            norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+            return (1 + (vectors @ query) / np.maximum(norms, 1e-12)) / 2
+        inner_products = vectors @ query
+        return np.where(inner_products >= 0, inner_products + 1, 1 / (1 - inner_products))
+
+    def _nearest_centroids(self, vectors, n: int):
+        distances = (np.einsum('ij,ij->i', vectors, vectors)[:, None] - 2 * vectors @ self.centroids.T
+                     + np.einsum('ij,ij->i', self.centroids, self.centroids)[None, :])
+        n = min(n, len(self.centroids))
+        nearest = np.argpartition(distances, n - 1, axis=1)[:, :n]
+        return nearest
+
+    def search(self, embedding: list, k: int, filters: list = None, decay: dict = None, size: int = None,
+               search_after: list = None, tiebreaker: str = None) -> list:
+        query = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            vectors = self._vectors()
+            candidates = np.flatnonzero(self.live)
+            if filters:
+                candidates = candidates[np.asarray([matches_filters(self.sources[row], filters)
+                                                    for row in candidates], dtype=bool)]
+            if self.centroids is not None and len(candidates):
+                probes = self._nearest_centroids(query[None, :], self.nprobe)[0]
+                candidates = candidates[np.isin(self.assignments[candidates], probes)]
+            if not len(candidates):
+                return []
+            scores = self._scores(vectors[candidates].astype(np.float32), query)
+            k = min(k, len(candidates))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            hits = [{'_id': self.ids[candidates[i]],
+                     '_score': float(scores[i]),
+                     '_source': self.sources[candidates[i]]} for i in top]
+        if decay:
+            for hit in hits:
+                hit['_score'] *= decay_multiplier(hit['_source'], decay)
+            hits.sort(key=lambda hit: -hit['_score'])
+        return page_hits(hits, size or k, search_after, tiebreaker)
+
+    def build_ivf(self, nlist: int = 64, iterations: int = 10, sample_size: int = 65536, seed: int = 0) -> None:
+        """
+        Train an inverted-file index: k-means centroids over a sample of the rows, then assign every row to its
+        nearest centroid. Later appends are assigned incrementally.
+        """
+        with self._lock:
+            vectors = self._vectors()
+            if not len(vectors):
+                raise ValueError('Cannot build an IVF index over an empty store')
+            rng = np.random.default_rng(seed)
+            sample = vectors[np.sort(rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False))]
+            sample = sample.astype(np.float32)
+            self.centroids = sample[rng.choice(len(sample), min(nlist, len(sample)), replace=False)].copy()
+            for _ in range(iterations):
+                nearest = self._nearest_centroids(sample, 1)[:, 0]
+                for c in range(len(self.centroids)):
+                    members = sample[nearest == c]
+                    if len(members):
+                        self.centroids[c] = members.mean(axis=0)
+            self.assignments = np.concatenate([self._nearest_centroids(vectors[start:start + 8192].astype(np.float32),
+                                                                       1)[:, 0]
+                                               for start in range(0, len(vectors), 8192)])
+            self._save_ivf()
+
+    def _save_ivf(self) -> None:
+        with open(self._path(IVF_FILE), 'wb') as f:
+            np.savez(f, centroids=self.centroids, assignments=self.assignments)
+
+    def drop_ivf(self) -> None:
+        with self._lock:
+            self.centroids = None
+            self.assignments = None
+            if os.path.exists(self._path(IVF_FILE)):
+                os.remove(self._path(IVF_FILE))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the IVF index of a local vector store')
+    parser.add_argument('directory')
+    parser.add_argument('--dimension', type=int, default=4096)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'int8'])
+    parser.add_argument('--nlist', type=int, default=64)
+    parser.add_argument('--drop', action='store_true', help='remove the IVF index and fall back to exact search')
+    args = parser.parse_args()
+
+    store = LocalVectorStore(args.directory, dimension=args.dimension, dtype=args.dtype)
+    if args.drop:
+        store.drop_ivf()
+    else:
+        store.build_ivf(nlist=args.nlist)
+        logger.info(f'Built IVF index with {len(store.centroids)} lists over {len(store)} documents')
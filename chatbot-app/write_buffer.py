@@ -0,0 +1,248 @@
+from concurrent.futures import ThreadPoolExecutor
+from ddb import turns_counters_update, is_conditional_check_failure
+from botocore.exceptions import BotoCoreError
+from botocore.exceptions import ClientError
+from registry import config_section
+from collections import OrderedDict
+from registry import get_resource
+from tracing import payload_size
+from tracing import annotate
+from tracing import traced
+import threading
+import logging
+import atexit
+import random
+import time
+
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger('log')
+
+# BatchWriteItem accepts at most 25 put or delete requests per call
+BATCH_WRITE_MAX_ITEMS = 25
+
+
+def turn_key(turn: dict) -> tuple:
+    return turn['session_id'], turn['timestamp']
+
+
+@traced('ddb.batch_put_items')
+def batch_put_items(dynamodb, table_name: str, items: list, max_retries: int = 8,
+                    backoff_factor: float = 0.05) -> list:
+    """
+    Put `items` into `table_name` with BatchWriteItem, 25 per call. Items DynamoDB hands back as unprocessed
+    (throttled partitions) are resent with exponential backoff and jitter.
+    :return: Items still unprocessed after `max_retries` retries, empty when everything was written
+    """
+    unwritten = []
+    for start in range(0, len(items), BATCH_WRITE_MAX_ITEMS):
+        requests = [{'PutRequest': {'Item': item}} for item in items[start:start + BATCH_WRITE_MAX_ITEMS]]
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(backoff_factor * 2 ** (attempt - 1) * random.uniform(0.5, 1.0))
+            response = dynamodb.batch_write_item(RequestItems={table_name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table_name, [])
+            if not requests:
+                break
+        unwritten.extend(request['PutRequest']['Item'] for request in requests)
+    annotate(items=len(items), request_bytes=payload_size(items))
+    return unwritten
+
+
+class TurnWriteBuffer:
+    """
+    Write-behind buffer for conversation turns. `add` only queues a turn; a background thread writes the queue
+    with BatchWriteItem every `flush_interval` seconds, or as soon as a full batch is waiting, then counts the
+    written turns into their sessions with one counter update per session.
+
+    Durability: a turn is in DynamoDB once a flush has written it, not when `add` returns. Turns queued by a
+    process that dies are lost, i.e. up to `flush_interval` seconds of turns, plus any held back by failing writes.
+    A clean interpreter exit flushes through `close`. Turns that are still unprocessed after the retries stay
+    queued for the next flush, and `flush` raises meanwhile. Counter updates that keep failing are likewise retried
+    by the next flush. `flush` returns only once every turn added before
+    it was called is written. ddb.end_session flushes before closing the session, so the stream record that
+    triggers the session-end Lambda always comes after the session's last turn.
+
+    Without `dynamodb`, the shared resource of the registry is used, built by the first flush.
+    """
+
+    def __init__(self, dynamodb=None, conversations_table: str = 'conversations', sessions_table: str = 'sessions',
+                 flush_interval: float = 0.2, max_pending: int = 1000, max_retries: int = 8,
+                 backoff_factor: float = 0.05, max_workers: int = 8):
+        self._dynamodb = dynamodb
+        self.conversations_table = conversations_table
+        self.sessions_table = sessions_table
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_workers = max_workers
+        self.written = 0
+        self.flushes = 0
+        self._pending = OrderedDict()
+        # Turns taken off the queue by the flush in progress, not known to be written yet
+        self._writing = []
+        # Turns written but not counted into their sessions yet, because the counter update failed; only used
+        # under the flush lock
+        self._uncounted = []
+        self._pending_changed = threading.Condition()
+        # Held for a whole flush, so a flush also waits for the one in flight on the background thread
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    @property
+    def dynamodb(self):
+        if self._dynamodb is None:
+            self._dynamodb = get_resource('dynamodb')
+        return self._dynamodb
+
+    def add(self, turn: dict) -> None:
+        with self._pending_changed:
+            if self._closed:
+                raise RuntimeError('Turn write buffer is closed')
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='turn-write-buffer', daemon=True)
+                self._thread.start()
+                atexit.register(self.close)
+            # A repeated key overwrites the queued turn, as a second put_item would
+            self._pending[turn_key(turn)] = turn
+            pending = len(self._pending)
+            if pending >= BATCH_WRITE_MAX_ITEMS:
+                self._pending_changed.notify()
+        if pending >= self.max_pending:
+            # Writes are falling behind or failing: push back on the caller instead of growing the queue
+            self.flush()
+
+    def pending(self) -> int:
+        with self._pending_changed:
+            return len(self._pending)
+
+    def queued_turns(self, session_id: str) -> list:
+        """
+        Turns of the session added but not written yet, which a read of the conversations table misses.
+        """
+        with self._pending_changed:
+            return [turn for turn in [*self._writing, *self._pending.values()] if turn['session_id'] == session_id]
+
+    @traced('ddb.flush_turns')
+    def flush(self) -> None:
+        """
+        Write every queued turn and count it into its session, blocking until done.
+        :raise RuntimeError: If some turns could not be written or counted; they stay queued for the next flush
+        """
+        with self._flush_lock:
+            with self._pending_changed:
+                turns = list(self._pending.values())
+                self._pending.clear()
+                self._writing = turns
+            uncounted, self._uncounted = self._uncounted, []
+            if not turns and not uncounted:
+                return
+            try:
+                unwritten = batch_put_items(self.dynamodb, self.conversations_table, turns, self.max_retries,
+                                            self.backoff_factor)
+            except Exception:
+                # Puts are idempotent, so turns of batches that did land are simply written again
+                self._requeue(turns)
+                self._uncounted = uncounted
+                raise
+            finally:
+                with self._pending_changed:
+                    self._writing = []
+            unwritten_keys = {turn_key(turn) for turn in unwritten}
+            written = [turn for turn in turns if turn_key(turn) not in unwritten_keys]
+            uncounted = self._count_into_sessions(uncounted + written)
+            self.written += len(written)
+            self.flushes += 1
+            annotate(items=len(written))
+            if unwritten:
+                self._requeue(unwritten)
+            if uncounted:
+                self._uncounted = uncounted
+            if unwritten or uncounted:
+                raise RuntimeError(f'{len(unwritten)} turns are still unprocessed and {len(uncounted)} uncounted '
+                                   f'after {self.max_retries} retries')
+
+    def _requeue(self, turns: list) -> None:
+        with self._pending_changed:
+            # Turns queued in the meantime go after, and win over, the ones put back
+            self._pending = OrderedDict([*((turn_key(turn), turn) for turn in turns), *self._pending.items()])
+
+    def _count_into_sessions(self, turns: list) -> list:
+        """
+        Count written turns into their sessions, one counter update per session, resending failed updates with
+        exponential backoff and jitter.
+        :return: Turns whose counter update still failed after `max_retries` retries
+        """
+        if not turns:
+            return []
+        sessions = OrderedDict()
+        for turn in turns:
+            sessions.setdefault(turn['session_id'], []).append(turn)
+        table = self.dynamodb.Table(self.sessions_table)
+
+        def count(session_turns):
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    time.sleep(self.backoff_factor * 2 ** (attempt - 1) * random.uniform(0.5, 1.0))
+                try:
+                    table.update_item(**turns_counters_update(session_turns))
+                    return []
+                except ClientError as e:
+                    if is_conditional_check_failure(e):
+                        logger.warning(f'Turns stored for unknown or closed session '
+                                       f'{session_turns[0]["session_id"]}, its counters were not updated')
+                        return []
+                    error = e
+                except BotoCoreError as e:
+                    error = e
+            logger.error(f'Counters of session {session_turns[0]["session_id"]} not updated: {error}')
+            return session_turns
+        if self._closed:
+            # The final flush may run from atexit, after executors stopped accepting work
+            return [turn for failed in map(count, sessions.values()) for turn in failed]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(sessions))) as executor:
+            return [turn for failed in executor.map(count, sessions.values()) for turn in failed]
+
+    def _run(self) -> None:
+        while True:
+            with self._pending_changed:
+                if not self._closed and len(self._pending) < BATCH_WRITE_MAX_ITEMS:
+                    self._pending_changed.wait(self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Background flush of conversation turns failed: {e}')
+                time.sleep(self.flush_interval)
+
+    def close(self) -> None:
+        """
+        Stop the background thread and write whatever is still queued.
+        """
+        with self._pending_changed:
+            self._closed = True
+            self._pending_changed.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+
+def write_buffer_from_config(buffer_config: dict, dynamodb=None):
+    """
+    :return: The configured TurnWriteBuffer, or None when turns are to be written synchronously
+    """
+    buffer_config = buffer_config or {}
+    if not buffer_config.get('enabled'):
+        return None
+    return TurnWriteBuffer(dynamodb,
+                           flush_interval=buffer_config.get('flush_interval', 0.2),
+                           max_pending=buffer_config.get('max_pending', 1000),
+                           max_retries=buffer_config.get('max_retries', 8),
+                           backoff_factor=buffer_config.get('backoff_factor', 0.05))
+
+
+turn_write_buffer = write_buffer_from_config(config_section('write_buffer'))